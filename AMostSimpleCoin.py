@@ -13,6 +13,7 @@ from message_handlers import set_message_handlers
 from control_loops import start_threads
 from database import Database
 from miner import Miner
+from getwork import WorkServer
 
 
 port = int(sys.argv[sys.argv.index("-port") + 1]) if "-port" in sys.argv else 2281
@@ -20,6 +21,8 @@ extra_seed = sys.argv[sys.argv.index("-seed") + 1].split(":") if "-seed" in sys.
 db_num = int(sys.argv[sys.argv.index("-db") + 1] if "-db" in sys.argv else 0)
 log_filename = sys.argv[sys.argv.index("-log") + 1] if "-log" in sys.argv else "AMSC.log"
 coinbase_se = int(sys.argv[sys.argv.index("-coinbase_se") + 1] if "-coinbase_se" in sys.argv else 1)
+mining_workers = int(sys.argv[sys.argv.index("-workers") + 1] if "-workers" in sys.argv else 1)
+getwork_port = int(sys.argv[sys.argv.index("-getwork") + 1]) if "-getwork" in sys.argv else None
 
 # Create DB
 
@@ -35,33 +38,46 @@ p2p = Network(seeds=seeds, address=('0.0.0.0', port), debug=True)
 
 # Chain
 
-root_block = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=1412226468, nonce=529437, coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=110737787655952643436062828845269098869204940693353997171788395014951100605706)
+# The genesis state_hash is the merkle root of the genesis state; changing it changes the root block and so forks
+# the network. Re-mine the nonce with -create_root whenever the root's header changes.
+genesis_state_hash = 90779242591341009434440006707169810383414749404247622347970984999156439389017
+root_block = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=1412226468, nonce=529437, coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=genesis_state_hash)
+if not root_block.acceptable_work and "-create_root" not in sys.argv:
+    raise ValueError('root_block does not meet its work target, re-mine it with -create_root')
 chain = Chain(root_block, db, p2p)
 
 # Handlers
 
-set_message_handlers(chain, p2p)
+set_message_handlers(chain, p2p, headers_first="-legacy_sync" not in sys.argv, snapshot_sync="-snapshot_sync" in sys.argv)
 
 # inbuilt miner
 
 coinbase_miner = pubkey_for_secret_exponent(coinbase_se)[0]  # get x coord
 
-miner = Miner(chain, p2p, coinbase_miner)
+miner = Miner(chain, p2p, coinbase_miner, workers=mining_workers)
 
 logging.basicConfig(filename=log_filename, level=logging.DEBUG)
 
 # Create root
 if "-create_root" in sys.argv:
-    root = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=int(time.time()), nonce=miner._special_nonce, coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=110737787655952643436062828845269098869204940693353997171788395014951100605706)
+    root = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=int(time.time()), nonce=miner._special_nonce, coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=genesis_state_hash)
     print(miner.mine_this_block(root).to_json())
     sys.exit()
 
+# Compare the mining kernel with a naive loop
+if "-benchmark" in sys.argv:
+    candidate = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=int(time.time()), nonce=miner._special_nonce, coinbase=coinbase_miner)
+    results = miner.benchmark(candidate)
+    print('naive: %(naive).0f H/s, kernel: %(kernel).0f H/s, speedup: %(speedup).2fx' % results)
+    sys.exit()
+
 # Go time!
 
 try:
     start_threads(chain, p2p)
     if "-fast" in sys.argv: miner.mine_fast()
     if "-mine" in sys.argv: fire(miner.run)
+    if getwork_port is not None: WorkServer(chain, p2p, miner, ('127.0.0.1', getwork_port)).start()
     p2p.run()
 except KeyboardInterrupt:
     pass
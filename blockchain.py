@@ -1,17 +1,30 @@
 from copy import deepcopy
 import traceback
 import asyncio
-import random
+import heapq
 
 from WSSTT import Network
 
 from structs import *
 from helpers import *
 from seeker import Seeker
-from database import Database, RedisFlag, RedisHashMap, RedisSet, State, Orphanage, PrimaryChain
+from database import Database, RedisFlag, RedisHashMap, RedisSet, InventoryIndex, State, StateOverlay, Orphanage, PrimaryChain, \
+    AncestorIndex, ReorgCommit, StateSnapshots, StateMerkleTree
 
 # TODO : figure out best where to hook DB in
 TOP_BLOCK = 'top_block'
+SNAPSHOT_BASE = 'snapshot_base'  # height of the state snapshot the chain started from, if it did
+
+BLOCK_CACHE_SIZE = 32 * 1024 * 1024  # bytes of encoded blocks
+HEADER_CACHE_SIZE = 100000  # headers
+MAX_ORPHAN_ROOTS_SOUGHT = 100  # missing roots of orphan chains asked for at once
+SNAPSHOT_INTERVAL = 1000  # the state is snapshotted each time the head passes a multiple of this
+
+def snapshot_due(pivot_height, height):
+    """ Whether to snapshot the state on moving the head to height from a fork at pivot_height: once the blocks
+    after the pivot pass a multiple of SNAPSHOT_INTERVAL. """
+    return pivot_height // SNAPSHOT_INTERVAL < height // SNAPSHOT_INTERVAL
+
 
 class Chain:
     def __init__(self, root: SimpleBlock, db: Database, p2p: Network):
@@ -20,66 +33,112 @@ class Chain:
         self.root = root
 
         self._state = State(self._db)
+        self._state.discard_stale_journals()
+        self._snapshots = StateSnapshots(self._db)
 
         self._orphans = Orphanage(self._db)
         self.current_node_hashes = RedisSet(db, 'all_nodes')
-        self._block_index = RedisHashMap(db, 'block_index', int, SimpleBlock)
+        self._inventory = InventoryIndex(db, 'all_nodes.inv')  # current_node_hashes by height range, for INV
+        self._block_index = RedisHashMap(db, 'block_index', int)  # serialized blocks, binary or (legacy) JSON
+        self._block_cache = LRUCache(BLOCK_CACHE_SIZE)  # block_hash -> SimpleBlock, sized by encoded length
+        self._headers = RedisHashMap(db, 'block_headers', int)  # fixed width BlockHeader records
+        self._header_cache = LRUCache(HEADER_CACHE_SIZE)
         self._block_heights = RedisHashMap(db, 'block_heights', int, int)
         self._heights = RedisHashMap(db, 'heights', int)
+        self._ancestors = AncestorIndex(db, 'ancestors')
         self._initialized = RedisFlag(db, 'initialized')
 
+        self._head = None
+        self._head_listeners = []
         self.head = self._get_top_block()
 
-        self._seeker = Seeker(self, self._p2p)  # format: (total_work, block_hash) - get early blocks first
-        self.currently_seeking = set()
+        self._loop = asyncio.get_event_loop()
+        self._seeker = Seeker(self, self._p2p)  # downloads missing blocks, least total work first
 
         # todo: temp till primary chain is done in redis so queries are quick
         self._primary_chain = PrimaryChain(self._db, 'primary_chain')
+        self._commit_reorg = ReorgCommit(self._db, self._state, self._primary_chain, TOP_BLOCK)
 
         if not self._initialized.is_true:
             self._first_initialize()
             self._initialized.set_true()
+        else:
+            self._upgrade_indexes()
 
     def _first_initialize(self):
         self._heights[0] = self.root.hash
         self._block_heights[self.root.hash] = 0
-        self._block_index[self.root.hash] = self.root
-        self.current_node_hashes.add(self.root.hash)
+        self._store_header(BlockHeader.from_block(self.root, 0))
+        self._ancestors.add(self.root.hash)
+        self._store_block(self.root)
+        self._add_node_hash(self.root.hash, 0)
         self._state.reset()
         self._apply_to_state(self.root)
-        self._primary_chain.append_hashes([self.root.hash])
+        self._primary_chain.append_hashes([self.root.hash], [self.root.total_work])
+
+    @property
+    def head(self):
+        return self._head
 
-    def _back_up_state(self, backup_path):
-        self._state.backup_to(backup_path)
+    @head.setter
+    def head(self, block):
+        changed = self._head is None or self._head.hash != block.hash
+        self._head = block
+        if changed:
+            for callback in list(self._head_listeners):
+                callback(block)
 
-    def _restore_backed_up_state(self, backup_path):
-        self._state.restore_backup_from(backup_path)
+    def subscribe_head_change(self, callback):
+        """ callback(new_head) is called, on whichever thread changed the head, every time the head changes. """
+        self._head_listeners.append(callback)
 
     @property
     def primary_chain(self):
         return self._primary_chain.get_all()
 
+    def primary_chain_range(self, start, stop):
+        """ :return: list of (block_hash, total_work) on the primary chain from height start to stop (exclusive) """
+        return self._primary_chain.get_range(start, stop)
+
+    def last_of_prefix_in_primary_chain(self, block_hashes):
+        """ :return: the last hash of the longest prefix of block_hashes that is on the primary chain, or None """
+        last = None
+        for block_hash, in_chain in zip(block_hashes, self._primary_chain.contains_many(block_hashes)):
+            if not in_chain:
+                break
+            last = block_hash
+        return last
+
+    def first_in_primary_chain(self, block_hashes):
+        """ :return: the first of block_hashes that is on the primary chain, or None """
+        for block_hash, in_chain in zip(block_hashes, self._primary_chain.contains_many(block_hashes)):
+            if in_chain:
+                return block_hash
+
     def _get_top_block(self):
         tb_hash = self._db.get_kv(TOP_BLOCK, int)
         if tb_hash is None:
             self._set_top_block(self.root)
             return self.root
-        return self._block_index[tb_hash]
+        return self.get_block(tb_hash)
 
     def _set_top_block(self, top_block):
         return self._db.set_kv(TOP_BLOCK, top_block.hash)
 
-    def seek_blocks(self, block_hashes):
-        self._seeker.put(*[h for h in block_hashes if not self.has_block(h)])
+    @property
+    def seeker(self):
+        return self._seeker
+
+    # The seeker lives on the event loop; blocks may be added on another thread (see ingestor.BlockIngestor)
 
     def seek_blocks(self, block_hashes):
-        self._seeker.put(*[h for h in block_hashes if not self.has_block(h)])
+        self._loop.call_soon_threadsafe(self._seeker.put, *[h for h in block_hashes if not self.has_block(h)])
 
     def seek_blocks_with_total_work(self, pairs):
-        self._seeker.put_with_work(*pairs)
+        self._loop.call_soon_threadsafe(self._seeker.put_with_work, *pairs)
 
     def height_of_block(self, block_hash):
-        return self._block_heights[block_hash]
+        return self.get_header(block_hash).height
 
     def has_block(self, block_hash):
         return block_hash in self.current_node_hashes or self._orphans.contains_block_hash(block_hash)
@@ -87,56 +146,154 @@ class Chain:
     def contains_block(self, block_hash):
         return block_hash in self.current_node_hashes
 
+    def _add_node_hash(self, block_hash, height):
+        self.current_node_hashes.add(block_hash)
+        self._inventory.add((block_hash, height))
+
+    def _all_headers(self, block_hashes):
+        return [header for i in range(0, len(block_hashes), 1000)
+                for header in self.get_headers(block_hashes[i:i + 1000])]
+
+    def _upgrade_indexes(self):
+        # databases from before these indexes were kept are brought up to date, once
+        if not self._primary_chain.indexed:
+            print('Indexing the primary chain by height')
+            headers = self._all_headers(list(self._primary_chain.get_all()))
+            for i in range(0, len(headers), 1000):
+                self._primary_chain.index(i, [h.total_work for h in headers[i:i + 1000]])
+        if not self._ancestors.contains(self.head.hash) or not self._inventory.exists:
+            print('Indexing ancestors and inventory')
+            headers = self._all_headers(list(map(int, self.current_node_hashes.members())))
+            headers = [h for h in headers if h is not None]
+            for header in sorted(headers, key=lambda h: h.height):  # parents before children
+                if not self._ancestors.contains(header.hash):
+                    self._ancestors.add(header.hash, None if header.hash == self.root.hash else header.parent)
+            self._inventory.add(*[(h.hash, h.height) for h in headers])
+
+    def inventory_digests(self):
+        """ :return: {range: digest} of the blocks we have (see InventoryIndex), for an INV_REQUEST """
+        return self._inventory.digests()
+
+    @property
+    def inventory_start(self):
+        """ The first range we want blocks in: the one after our state snapshot's, if we started from one (there's no
+        replaying blocks before it) """
+        base = self._db.get_kv(SNAPSHOT_BASE, int)
+        return 0 if base is None else base // INV_RANGE + 1
+
+    def inventory_missing_from(self, their_digests, start):
+        """ :return: hashes of the blocks we have in the height ranges (from start) where a peer's inventory_digests()
+        differ from ours, lowest ranges first and at most INV_MAX_HASHES. Only those ranges are read, so this scales
+        with the difference. """
+        return self._inventory.missing_from(their_digests, start, INV_MAX_HASHES)
+
     def get_block(self, block_hash):
-        return self._block_index[block_hash]
+        block = self._block_cache.get(block_hash)
+        if block is None:
+            serialized = self._block_index.get_serialized(block_hash)
+            if serialized is None:
+                return None
+            block = SimpleBlock.from_serialized(serialized)
+            self._block_cache.put(block_hash, block, len(serialized))
+        return block
+
+    def _store_block(self, block):
+        serialized = block.to_bytes()
+        self._block_index[block.hash] = serialized
+        self._block_cache.put(block.hash, block, len(serialized))
 
-    def add_blocks(self, blocks):
-        # todo : design some better sorting logic.
+    @property
+    def block_cache_stats(self):
+        return self._block_cache.stats()
+
+    # Headers: traversal reads these, never block bodies
+
+    def get_header(self, block_hash):
+        return self.get_headers([block_hash])[0]
+
+    def get_headers(self, block_hashes):
+        """ :return: a BlockHeader (or None if we don't have the block) for each hash, with one redis call at most """
+        headers = [self._header_cache.get(h) for h in block_hashes]
+        missing = [h for h, header in zip(block_hashes, headers) if header is None]
+        found = dict(zip(missing, self._headers.get_many_serialized(missing)))
+        for i, block_hash in enumerate(block_hashes):
+            if headers[i] is None:
+                serialized = found[block_hash]
+                if serialized is None:
+                    headers[i] = self._header_from_block(block_hash)
+                else:
+                    headers[i] = BlockHeader.from_bytes(serialized)
+                    self._header_cache.put(block_hash, headers[i])
+        return headers
+
+    def _header_from_block(self, block_hash):
+        # blocks accepted before the header index existed
+        if block_hash not in self._block_heights:
+            return None
+        header = BlockHeader.from_block(self.get_block(block_hash), self._block_heights[block_hash])
+        self._store_header(header)
+        return header
+
+    def _store_header(self, header: BlockHeader):
+        self._headers[header.hash] = header.to_bytes()
+        self._header_cache.put(header.hash, header)
+
+    def add_blocks(self, blocks, sources=None):
+        """ :param sources: optional dict of block_hash -> the peer it came from, for the orphanage's per-peer quota """
         # we should check if orphan chains match up with what we've added, if so add the orphan chain.
         rejects = []
         # todo: major bug - if blocks are added in the order [good, good, bad], say, and blocks 1 and 2 cause a reorg
         # then when block 3 causes an exception the state will revert but the head is still on block 2, which doesn't
         # match the state.  - I think this is fixed now
-        some_path = str(random.randint(1000,1000000))
-        self._back_up_state(some_path)
+        journal = self._state.begin_journal()
 
-        total_works = [(b.total_work, b) for b in blocks]
-        total_works.sort()
+        # least total work first, so parents come before children; unorphaned descendants join the heap
+        queued = {b.hash: b for b in blocks}
+        heap = [(b.total_work, b.hash) for b in queued.values()]
+        heapq.heapify(heap)
+        from_orphanage = set()  # their descendants were fetched with them, no need to look again
 
         most_recent_block = None
 
         try:
-            while True:
-                if len(total_works) == 0:
-                    break
-                tw, block = total_works.pop(0)
-                most_recent_block = block
-                r = self._add_block(block)
+            while len(heap) > 0:
+                tw, block_hash = heapq.heappop(heap)
+                block = most_recent_block = queued[block_hash]
+                r = self._add_block(block, resolve_orphans=block_hash not in from_orphanage)
                 if isinstance(r, list):
-                    total_works.extend([(b.total_work, b) for b in r])
+                    for descendant in r:
+                        from_orphanage.add(descendant.hash)
+                        if descendant.hash not in queued:
+                            queued[descendant.hash] = descendant
+                            heapq.heappush(heap, (descendant.total_work, descendant.hash))
                 elif isinstance(r, Encodium):
                     rejects.append(r)
             print('rejects', rejects)
             for r in rejects:
-                self._orphans.add(r)
+                # its claimed work isn't checked until it connects, so it's credited with one block past our head
+                self._orphans.add(r, None if sources is None else sources.get(r.hash),
+                                  max_work=self.head.total_work + r.work_target)
+            if len(rejects) > 0:
+                self.seek_orphan_roots()
+            journal.commit()
         except Exception as e:
-            self._restore_backed_up_state(some_path)
+            with self._state.lock:
+                journal.rollback()
             traceback.print_exc()
             print('EXCEPTION CAPTURED WHILE ADDING BLOCK', most_recent_block.to_json())
 
-    def _add_block(self, block: SimpleBlock):
+    def _add_block(self, block: SimpleBlock, resolve_orphans=True):
         """
         :param block: QuantaBlock instance
-        :return: None on success, block if parent missing
+        :param resolve_orphans: look up the orphans descending from block
+        :return: None on success, block if parent missing, list of orphaned descendants if there are any
         """
         print('_add_block', block.hash)
         if block.hash in self.current_node_hashes: return None
         if not block.acceptable_work: raise InvalidBlockException('Unacceptable work')
         if not all_true(self.contains_block, block.links):
             print('Rejecting block: don\'t have all links')
-            # don't just look for children, get a primary chain
-            self.seek_blocks({i for i in block.links if not self._orphans.contains_block_hash(i)})
-            return block
+            return block  # add_blocks seeks the missing root of its orphan chain
 
         # success, lets add it
         self._update_metadata(block)
@@ -144,138 +301,199 @@ class Chain:
         if self.better_than_head(block):
             print('COINBASE _add_blk', block.coinbase)
             self._reorganize_to(block)
-        self.current_node_hashes.add(block.hash)
-        self._block_index[block.hash] = block
+        self._add_node_hash(block.hash, self.height_of_block(block.hash))
+        self._store_block(block)
         print("Chain._add_block - processed", block.hash)
-        orphaned_children = self._orphans.children_of(block.hash)
-        self._orphans.remove(block)
-        if len(orphaned_children) > 0:
-            print([self._orphans.get(h) for h in orphaned_children])
-            return [self._orphans.get(h) for h in orphaned_children]
         self._orphans.remove(block)
+        if resolve_orphans:
+            descendants = self._orphans.descendants_of(block.hash)
+            if len(descendants) > 0:
+                print('Unorphaning %d blocks' % len(descendants))
+                return descendants
         return None
 
+    def sweep_orphans(self):
+        expired, cleaned = self._orphans.sweep()
+        if expired + cleaned > 0:
+            print('Orphanage swept: %d expired, %d stale links' % (expired, cleaned))
+        self.seek_orphan_roots()
+
+    def seek_orphan_roots(self):
+        """ Seek the blocks orphan chains are waiting on, the one under the heaviest chain first; each connects its
+        whole chain. """
+        needs = self._orphans.needs(MAX_ORPHAN_ROOTS_SOUGHT)
+        if len(needs) > 0:
+            self._loop.call_soon_threadsafe(self._seeker.put_orphan_roots, *needs)
+
     def _set_height_metadata(self, block):
-        height = self._block_heights[block.links[0]] + 1
+        height = self.height_of_block(block.links[0]) + 1
         self._block_heights[block.hash] = height
         self._heights[height] = block.hash
+        self._store_header(BlockHeader.from_block(block, height))
 
     def _update_metadata(self, block):
         self._set_height_metadata(block)
-
-    def _mass_primary_chain_apply(self, path):
-        self._primary_chain.append_hashes([b.hash for b in path])
-
-    def _mass_primary_chain_unapply(self, path):
-        self._primary_chain.remove_hashes([b.hash for b in path])
+        self._ancestors.add(block.hash, block.links[0])
 
     def _reorganize_to(self, block):
-        print('reorg from %064x\nto         %064x\nheight of  %d' % (self.head.hash, block.hash, self._block_heights[block.hash]))
+        print('reorg from %064x\nto         %064x\nheight of  %d' % (self.head.hash, block.hash, self.height_of_block(block.hash)))
         pivot = self.find_pivot(self.head, block)
-        unapply_path = self.order_from(pivot, self.head)
-        self._mass_unapply(unapply_path)
-        self._mass_primary_chain_unapply(unapply_path)
+        # only the blocks whose state changes we need are read in full; block itself isn't stored yet
+        unapply_path = [self.get_block(h.hash) for h in self.order_from(pivot, self.head)]
+        apply_path = [self.get_block(h.hash) for h in self.order_from(pivot, block)[:-1]] + [block]
         print('COINBASE _re_org_', block.coinbase)
-        apply_path = self.order_from(pivot, block)
-        self._mass_apply(apply_path)
-        self._mass_primary_chain_apply(apply_path)
-        print('Current State')
-        pp(self._state.full_state())
+
+        # fold both paths into one net change per account, checking every block against the overlay as we go,
+        # then commit balances, primary chain and top block in one call
+        with self._state.lock:
+            overlay = StateOverlay(self._state, cache_reads=True)
+            overlay.prefetch(self._accounts_touched_by(unapply_path + apply_path))
+            for b in unapply_path[::-1]:
+                self._modify_state(b, -1, overlay)
+            for b in apply_path:
+                assert self._valid_for_state(b, overlay)
+            self._commit_reorg(overlay.deltas, [b.hash for b in unapply_path], apply_path, block.hash)
+            assert_equal(block.state_hash, self._state.hash)  # commits the merkle tree, so .dirty stays small
+            self._snapshot_if_due(pivot, block)
+
+        for b in apply_path:
+            if b in self._orphans:
+                self._orphans.remove(b)
+        self.head = block
+
+    # State snapshots
+
+    def _snapshot_if_due(self, pivot, block):
+        # under the state lock, with the state as of block; the state at the multiple itself is gone if a reorg (or
+        # blocks applied together) went past it, so the snapshot is of block
+        height = self.height_of_block(block.hash)
+        if snapshot_due(self.height_of_block(pivot.hash), height):
+            print('Snapshotting state at height', height)
+            self._snapshots.take(height, block.hash, self._state.full_state())
+
+    def latest_snapshot(self):
+        """ :return: (height, block, number of chunks) of the latest state snapshot we can serve, or None """
+        latest = self._snapshots.latest()
+        if latest is None:
+            return None
+        height, block_hash, n_chunks = latest
+        return height, self.get_block(block_hash), n_chunks
+
+    def snapshot_chunk(self, block_hash, index):
+        return self._snapshots.get_chunk(block_hash, index)
+
+    def load_snapshot(self, headers, block, balances):
+        """ Start a fresh chain (at the root) from a state snapshot, so only blocks after it have to be replayed.
+        Block bodies before it are never fetched, and so can't be served or reorganised away from.
+        :param headers: headers from the root's child up to and including block, validated against their blocks (see
+        HeaderSync), with block buried under more of them
+        :param balances: dict of pub_x -> balance, the state as of block
+        """
+        if self.head.hash != self.root.hash:
+            raise ValueError('Snapshots can only be loaded by a fresh chain')
+        if len(headers) == 0 or headers[0].parent != self.root.hash or headers[-1].hash != block.hash:
+            raise ValueError('Headers do not lead from the root to the snapshot')
+        header = headers[-1]
+        if block.links != [header.parent] or block.total_work != header.total_work \
+                or block.work_target != header.work_target:
+            raise ValueError('Snapshot block disagrees with its header')
+        if block.work_target <= 100000 or not block.acceptable_work:
+            raise ValueError('Snapshot block does not meet its work target')
+        if StateMerkleTree.root_of(balances) != block.state_hash:
+            raise ValueError('Snapshot does not match the state_hash of its block')
+
+        with self._state.lock:
+            self._state.load(balances)
+            assert_equal(block.state_hash, self._state.hash)
+        for h in headers:
+            self._block_heights[h.hash] = h.height
+            self._heights[h.height] = h.hash
+            self._store_header(h)
+            self._ancestors.add(h.hash, h.parent)
+        self._primary_chain.append_hashes([h.hash for h in headers], [h.total_work for h in headers])
+        self._store_block(block)
+        self._add_node_hash(block.hash, header.height)
+        self._db.set_kv(SNAPSHOT_BASE, header.height)
+        self._snapshots.take(header.height, block.hash, balances)  # so we can serve it too
+        self._set_top_block(block)
         self.head = block
-        self._set_top_block(self.head)
+        print('Loaded state snapshot at height', header.height)
+
+        descendants = self._orphans.descendants_of(block.hash)
+        if len(descendants) > 0:
+            self.add_blocks(descendants)
 
     # Coin & State methods
 
     def get_next_state_hash(self, block):
-        with self._state.lock:
-            state_hash = self._get_next_state_hash_not_threadsafe(block)
-        return state_hash
-
-    def _get_next_state_hash_not_threadsafe(self, block):
-        temp_path = str(random.randint(1000,1000000))
-        self._back_up_state(temp_path)
-        self._modify_state(block, 1)
-        state_hash = self._state.hash
-        self._restore_backed_up_state(temp_path)
-        return state_hash
-
-    def _valid_for_state(self, block):
-        state_hash = self._get_next_state_hash_not_threadsafe(block)
-        assert_equal(block.state_hash, state_hash)
+        # speculative: computed from an overlay, so it doesn't need the state lock
+        overlay = StateOverlay(self._state)
+        self._modify_state(block, 1, overlay)
+        return overlay.hash
+
+    def _valid_for_state(self, block, overlay=None):
+        """ Check block against the state (or an overlay, which block is then applied to). """
+        overlay = StateOverlay(self._state) if overlay is None else overlay
         if block.tx is not None:
-            assert self._state.get(block.tx.signature.pub_x) >= block.tx.total
+            assert overlay.get(block.tx.signature.pub_x) >= block.tx.total
+        self._modify_state(block, 1, overlay)
+        assert_equal(block.state_hash, overlay.hash)
         return True
 
     def _apply_to_state(self, block):
         with self._state.lock:
             print('COINBASE _aply_st', block.coinbase)
             assert self._valid_for_state(block)
-            assert self._valid_for_state(block)
             self._modify_state(block, 1)
+            assert_equal(block.state_hash, self._state.hash)  # commits the merkle tree, so .dirty stays small
 
-    def _unapply_to_state(self, block):
-        self._modify_state(block, -1)
-
-    def _modify_state(self, block, direction):
+    def _modify_state(self, block, direction, state=None):
         assert direction in [-1, 1]
+        state = self._state if state is None else state
         if block.tx is not None:
-            self._state.modify_balance(block.tx.recipient, direction * block.tx.value)
-            self._state.modify_balance(block.tx.signature.pub_x, -1 * direction * block.tx.value)
-        self._state.modify_balance(block.coinbase, direction * block.coins_generated)
+            state.modify_balance(block.tx.recipient, direction * block.tx.value)
+            state.modify_balance(block.tx.signature.pub_x, -1 * direction * block.tx.value)
+        state.modify_balance(block.coinbase, direction * block.coins_generated)
 
-    def _mass_unapply(self, path):
-        for block in path[::-1]:
-            self._unapply_to_state(block)
-
-    def _mass_apply(self, path):
-        print(path)
+    @staticmethod
+    def _accounts_touched_by(path):
+        accounts = set()
         for block in path:
-            print('COINBASE _ms_aply', block.coinbase)
-            self._apply_to_state(block)
-            if block in self._orphans:
-                self._orphans.remove(block)
+            accounts.add(block.coinbase)
+            if block.tx is not None:
+                accounts.update([block.tx.recipient, block.tx.signature.pub_x])
+        return accounts
 
     def better_than_head(self, block):
+        # block may be a BlockHeader
         return block.total_work > self.head.total_work
 
     def make_block_locator(self):
-        locator = []
+        heights = []
 
-        h = self._block_heights[self.head.hash]
+        h = self.height_of_block(self.head.hash)
         print(h, self.head.hash)
         i = 0
         c = 0
         while h - c >= 0:
-            locator.append(self.primary_chain[h - c])
+            heights.append(h - c)
             c = 2**i
             i += 1
 
-        return locator
-
-    def _order_from_alpha(self, early_node, late_node):
-        path = []
-        print(early_node.hash)
-        while early_node.hash != late_node.hash:
-            path = [late_node] + path
-            if late_node.is_root:
-                if early_node.is_root:
-                    return path
-                raise Exception("Root block encountered unexpectedly while ordering graph")
-            late_node = self.get_block(late_node.links[0])
-            #print('new_late_node')
-            #print(late_node.hash)
-        return path
+        return self._primary_chain.get_many(heights)
 
     def _order_from_beta(self, early_node, late_node):
-        pass
-
-    def order_from(self, early_node: SimpleBlock, late_node: SimpleBlock):
-        return self._order_from_alpha(early_node, late_node)
-
-    def find_pivot(self, b1: SimpleBlock, b2: SimpleBlock):
-        while b1.hash != b2.hash:
-            if b1.total_work >= b2.total_work:
-                b1 = self.get_block(b1.links[0])
-            else:
-                b2 = self.get_block(b2.links[0])
-        return b1 if b1 == b2 else None
+        # the ancestor index gives us all the hashes in one call, and the headers come in one more
+        return self.get_headers(self._ancestors.path_between(early_node.hash, late_node.hash))
+
+    def order_from(self, early_node, late_node):
+        """ :return: headers of the blocks after early_node up to and including late_node (blocks or headers) """
+        return self._order_from_beta(early_node, late_node)
+
+    def find_pivot(self, b1, b2):
+        """ :return: the header of the latest common ancestor of two blocks (or headers) """
+        pivot_hash = self._ancestors.common_ancestor(b1.hash, b2.hash)
+        return None if pivot_hash is None else self.get_header(pivot_hash)
+
+    def ancestor_at_height(self, block_hash, height):
+        return self._ancestors.ancestor_at_height(block_hash, height)
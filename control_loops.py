@@ -15,5 +15,23 @@ def watch_peer_top_blocks_loop(chain, p2p: Network):
         yield from asyncio.sleep(30)  # we don't want to piss people off if this is too frequent
 
 
+@asyncio.coroutine
+def inventory_loop(chain, p2p: Network):
+    # catches blocks that never made it to us some other way, e.g. side branches a peer saw while we were offline
+    while not p2p.is_shutdown:
+        yield from asyncio.sleep(300)
+        p2p.broadcast(INV_REQUEST, InvRequest.from_digests(chain.inventory_digests(), chain.inventory_start))
+
+
+@asyncio.coroutine
+def sweep_orphans_loop(chain, p2p: Network):
+    loop = asyncio.get_event_loop()
+    while not p2p.is_shutdown:
+        yield from asyncio.sleep(60)
+        yield from loop.run_in_executor(None, chain.sweep_orphans)
+
+
 def start_threads(chain, p2p):
     asyncio.async(watch_peer_top_blocks_loop(chain, p2p))
+    asyncio.async(inventory_loop(chain, p2p))
+    asyncio.async(sweep_orphans_loop(chain, p2p))
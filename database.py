@@ -1,3 +1,6 @@
+from collections import defaultdict
+import time
+
 from redis import Redis
 
 from helpers import *
@@ -158,6 +161,12 @@ class RedisHashMap(_RedisObject):
     def __getitem__(self, item):
         return parse_type_over(self._value_type, self._db.redis.hget(self._path, item))
 
+    def get_serialized(self, item):
+        return self._db.redis.hget(self._path, item)
+
+    def get_many_serialized(self, items):
+        return self._db.redis.hmget(self._path, items) if len(items) > 0 else []
+
     def __len__(self):
         return self._db.redis.hlen(self._path)
 
@@ -172,9 +181,238 @@ class RedisHashMap(_RedisObject):
         return set(map(lambda k : parse_type_over(self._key_type, k), self._db.redis.hkeys(self._path)))
 
 
+class InventoryIndex(_RedisObject):
+    """ Every block we have, grouped by height into ranges of INV_RANGE heights, with a digest of each range: how many
+    blocks it has and the sum of their hashes' low INV_DIGEST_BITS bits. Two nodes find the ranges they differ in
+    by comparing digests, so only those ranges' hashes are ever listed.
+
+    Redis Particulars:
+        {path}.n : hash_map(range -> number of blocks)
+        {path}.s : hash_map(range -> sum of the blocks' digest parts)
+        {path}.{range} : set(block_hash)
+    """
+    def __init__(self, db: Database, path=""):
+        super().__init__(db, path)
+        self._add = lua_helpers.get_inventory_add(self._r, path)
+
+    @property
+    def exists(self):
+        return self._r.exists(concat(self._path, 'n'))
+
+    def add(self, *pairs):
+        """ pairs are (block_hash, height) """
+        if len(pairs) == 0:
+            return
+        args = []
+        for block_hash, height in pairs:
+            args += [height // INV_RANGE, block_hash % 2 ** INV_DIGEST_BITS]
+        self._add(keys=[block_hash for block_hash, height in pairs], args=args)
+
+    def digests(self):
+        """ :return: {range: (number of blocks, sum)} """
+        pipe = self._r.pipeline()
+        pipe.hgetall(concat(self._path, 'n'))
+        pipe.hgetall(concat(self._path, 's'))
+        counts, sums = pipe.execute()
+        return {int(r): (int(n), int(sums[r])) for r, n in counts.items()}
+
+    def missing_from(self, their_digests, start, limit):
+        """ :return: up to limit hashes from the ranges (from start, lowest first) whose digests differ from
+        their_digests """
+        hashes = []
+        for r, digest in sorted(self.digests().items()):
+            if len(hashes) >= limit:
+                break
+            if r >= start and their_digests.get(r) != digest:
+                hashes += map(int, self._r.smembers(concat(self._path, r)))
+        return hashes[:limit]
+
+
 # State
 
 
+class StateMerkleTree:
+    """ A sparse merkle tree committing to the balances of a State.
+    Accounts are sorted into 2**DEPTH buckets by the top bits of their pub_x. A bucket's leaf is the hash of its
+    (pub_x, balance) pairs in order, and empty subtrees hash to 0 and are lifted past their parent. A balance change
+    therefore only rehashes its own bucket and the DEPTH nodes above it.
+
+    Redis Particulars:
+        {path}.idx : sorted_set(pub_x) scored by bucket
+        {path}.merkle : hash_map('level.index' -> node hash), empty nodes are absent
+        {path}.dirty : hash_map(bucket -> generation) of buckets modified since their nodes were written
+
+    The .idx and .dirty structures are maintained by the state's own lua (mod_balance).
+    """
+    DEPTH = 16
+
+    def __init__(self, db: Database, path="state"):
+        self._db = db
+        self._r = r = db.redis
+        self._path = path
+        self._nodes_path = concat(path, 'merkle')
+
+        self._dirty_buckets = lua_helpers.get_merkle_dirty_buckets(r, path)
+        self._snapshot = lua_helpers.get_merkle_snapshot(r, path)
+        self._commit = lua_helpers.get_merkle_commit(r, path)
+
+    @classmethod
+    def bucket_of(cls, pub_x):
+        return pub_x >> (256 - cls.DEPTH)
+
+    @staticmethod
+    def leaf_hash(pairs):
+        if len(pairs) == 0:
+            return 0
+        pair_to_bytes = lambda p : p[0].to_bytes(32, 'big') + p[1].to_bytes(8, 'big')
+        return global_hash(b''.join(map(pair_to_bytes, sorted(pairs))))
+
+    @staticmethod
+    def node_hash(left, right):
+        if left == 0:
+            return right
+        if right == 0:
+            return left
+        return global_hash(left.to_bytes(32, 'big') + right.to_bytes(32, 'big'))
+
+    @staticmethod
+    def node_id(level, index):
+        return concat(level, index)
+
+    @classmethod
+    def paths_and_siblings(cls, buckets):
+        """ Return the node ids on the paths from buckets to the root, and the ids of the siblings of those nodes that
+        are not themselves on a path.
+        """
+        paths, siblings = set(), set()
+        indices = set(buckets)
+        for level in range(cls.DEPTH, 0, -1):
+            paths.update(cls.node_id(level, i) for i in indices)
+            siblings.update(cls.node_id(level, i ^ 1) for i in indices if i ^ 1 not in indices)
+            indices = {i >> 1 for i in indices}
+        paths.add(cls.node_id(0, 0))
+        return paths, siblings
+
+    @classmethod
+    def recompute(cls, leaves, known_nodes):
+        """
+        :param leaves: dict of bucket -> leaf hash for every bucket that changed
+        :param known_nodes: dict of node_id -> node hash for (at least) the siblings of the changed paths
+        :return: dict of node_id -> node hash for every node on the changed paths, including the root '0.0'
+        """
+        changed = {}
+        current = dict(leaves)
+        for level in range(cls.DEPTH, 0, -1):
+            for i, h in current.items():
+                changed[cls.node_id(level, i)] = h
+            get = lambda i : current[i] if i in current else known_nodes.get(cls.node_id(level, i), 0)
+            current = {i >> 1: cls.node_hash(get(i & ~1), get(i | 1)) for i in current}
+        changed[cls.node_id(0, 0)] = current.get(0, known_nodes.get(cls.node_id(0, 0), 0))
+        return changed
+
+    @classmethod
+    def root_of(cls, balances):
+        """ Compute the root for a dict of pub_x -> balance from scratch, without touching redis.
+        """
+        buckets = defaultdict(list)
+        for pub_x, balance in balances.items():
+            buckets[cls.bucket_of(pub_x)].append((pub_x, balance))
+        leaves = {b: cls.leaf_hash(pairs) for b, pairs in buckets.items()}
+        return cls.recompute(leaves, {})[cls.node_id(0, 0)]
+
+    def get_nodes(self, node_ids):
+        node_ids = list(node_ids)
+        if len(node_ids) == 0:
+            return {}
+        return {n: zero_if_none(v and int(v)) for n, v in zip(node_ids, self._r.hmget(self._nodes_path, node_ids))}
+
+    def read_snapshot(self, buckets, snapshot=None):
+        """ Read the contents of buckets and of all dirty buckets, and the sibling nodes along their paths, in one
+        consistent call. Results are merged into snapshot, a dict of {'contents': {bucket: {pub_x: balance}},
+        'nodes': {node_id: node hash}}, which is returned.
+        """
+        if snapshot is None:
+            snapshot = {'contents': {}, 'nodes': {}}
+        flat_contents, node_ids, node_hashes = self._snapshot(keys=list(buckets), args=[self.DEPTH])
+
+        i = 0
+        while i < len(flat_contents):
+            bucket, n = int(flat_contents[i]), int(flat_contents[i + 1])
+            pairs = flat_contents[i + 2:i + 2 + 2 * n]
+            snapshot['contents'][bucket] = {int(pairs[j]): int(pairs[j + 1]) for j in range(0, len(pairs), 2)}
+            i += 2 + 2 * n
+
+        snapshot['nodes'].update((n.decode(), zero_if_none(v and int(v))) for n, v in zip(node_ids, node_hashes))
+        return snapshot
+
+    def root_with(self, changes, snapshot=None):
+        """ Compute the root the tree would have if changes were applied to the state. Nothing is written.
+        :param changes: dict of pub_x -> new balance, a balance of 0 removes the account
+        :param snapshot: optionally, a snapshot (see read_snapshot) to reuse; only buckets it lacks are read. This is
+        only correct while the state can't change underneath it.
+        """
+        touched = {self.bucket_of(pub_x) for pub_x in changes}
+        if snapshot is None:
+            snapshot = self.read_snapshot(touched)
+        else:
+            missing = touched.difference(snapshot['contents'])
+            if len(missing) > 0 or len(snapshot['contents']) == 0:
+                self.read_snapshot(missing, snapshot)
+
+        contents = {b: dict(accounts) for b, accounts in snapshot['contents'].items()}
+        for pub_x, balance in changes.items():
+            accounts = contents[self.bucket_of(pub_x)]
+            if balance > 0:
+                accounts[pub_x] = balance
+            else:
+                accounts.pop(pub_x, None)
+
+        leaves = {b: self.leaf_hash(list(accounts.items())) for b, accounts in contents.items()}
+        return self.recompute(leaves, snapshot['nodes'])[self.node_id(0, 0)]
+
+    def root(self):
+        """ Bring the tree up to date with the state and return the root.
+        """
+        flat = self._dirty_buckets()
+        generations, contents = [], defaultdict(list)
+        i = 0
+        while i < len(flat):
+            bucket, generation, n = int(flat[i]), flat[i + 1], int(flat[i + 2])
+            generations.extend([bucket, generation])
+            pairs = flat[i + 3:i + 3 + 2 * n]
+            contents[bucket] = [(int(pairs[j]), int(pairs[j + 1])) for j in range(0, len(pairs), 2)]
+            i += 3 + 2 * n
+
+        if len(contents) == 0:
+            return self.get_nodes([self.node_id(0, 0)])[self.node_id(0, 0)]
+
+        leaves = {b: self.leaf_hash(pairs) for b, pairs in contents.items()}
+        paths, siblings = self.paths_and_siblings(leaves.keys())
+        changed = self.recompute(leaves, self.get_nodes(siblings))
+        self._commit(keys=generations, args=[x for pair in changed.items() for x in pair])
+        return changed[self.node_id(0, 0)]
+
+    def reset(self):
+        return self._r.delete(self._nodes_path)
+
+
+class StateJournal:
+    """ An undo log for a State.
+    While open, the previous balance of every account the State modifies is recorded (once per account), so a
+    rollback only costs as much as the accounts touched since the journal was opened.
+    Journals can be nested; modifications are recorded in all open journals.
+    """
+    def __init__(self, state, path):
+        self._state = state
+        self.path = path
+
+    def commit(self):
+        self._state._close_journal(self, rollback=False)
+
+    def rollback(self):
+        self._state._close_journal(self, rollback=True)
+
+
 class State(_RedisObject):
     """ Super simple state device.
     Only functions are to add or subtract coins, and no checking is involved.
@@ -183,27 +421,64 @@ class State(_RedisObject):
     def __init__(self, db: Database, path="state", backup_path="backup_state"):
         super().__init__(db, path)
 
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()  # reentrant, so journals can be opened and closed by holders of it too
 
         self._backup_path = backup_path
         self._state = RedisHashMap(db, self._path, int, int)  # ECPoint, MoneyAmount)    <- use those types again when encodium is patched
+        self._tree = StateMerkleTree(db, self._path)
         self._hash = None
 
+        self._journals = []
+        self._journals_path = concat(path, 'journals')
+
         self._mod_balance = lua_helpers.get_mod_balance(self._db.redis, self._path)
         self._get_balance = lua_helpers.get_get_balance(self._db.redis, self._path)
+        self._reset = lua_helpers.get_reset_state(self._db.redis, self._path)
+        self._journal_rollback = lua_helpers.get_journal_rollback(self._r, self._path)
+        self._journal_discard = lua_helpers.get_journal_discard(self._r, self._path)
         self._backup_state = lua_helpers.get_backup_state_function(self._r, self._path, self._backup_path)
         self._restore_backup = lua_helpers.get_restore_backup_state_function(self._r, self._path, self._backup_path)
 
     def get(self, pub_x: ECPoint):
         return int(self._get_balance(keys=[pub_x]))
 
-    def modify_balance(self, pub_x: ECPoint, value: MoneyAmount, r: Redis=None):  # todo : write modify_many_balances(...)
+    def get_many(self, pub_xs):
+        if len(pub_xs) == 0:
+            return []
+        return [zero_if_none(b and int(b)) for b in self._r.hmget(self._path, pub_xs)]
+
+    def modify_balance(self, pub_x: ECPoint, value: MoneyAmount, r: Redis=None):
         #assert new_value >= 0  # todo, we probably shouldn't validate this here?
         self.modify_many_balances([pub_x], [value])
 
     def modify_many_balances(self, pub_xs, values):
-        self._mod_balance(keys=pub_xs, args=values)
-        self._hash = None
+        buckets = [StateMerkleTree.bucket_of(pub_x) for pub_x in pub_xs]
+        with self.lock:
+            self._mod_balance(keys=pub_xs, args=list(values) + buckets + [j.path for j in self._journals])
+            self._hash = None
+
+    def begin_journal(self):
+        with self.lock:
+            path = concat(self._path, 'journal', self._r.incr(concat(self._path, 'journal_n')))
+            self._r.sadd(self._journals_path, path)
+            journal = StateJournal(self, path)
+            self._journals.append(journal)
+            return journal
+
+    def _close_journal(self, journal, rollback):
+        with self.lock:
+            self._journals.remove(journal)
+            if rollback:
+                self._journal_rollback(keys=[journal.path])
+                self._hash = None
+            else:
+                self._journal_discard(keys=[journal.path])
+
+    def discard_stale_journals(self):
+        # journals left over from a previous run, they're never rolled back
+        stale = self._r.smembers(self._journals_path)
+        if len(stale) > 0:
+            self._r.delete(self._journals_path, *stale)
 
     def full_state(self):
         return self._state.get_all()
@@ -216,24 +491,149 @@ class State(_RedisObject):
 
     def restore_backup_from(self, backup_path):
         self._restore_backup(keys=[backup_path])
+        self._hash = None
 
     def reset(self):
-        if self._r.exists(self._path):
-            self._r.delete(self._path)
-        self._state[0] = 0  # allows backing up an "empty" state
+        self._reset()
+        self._hash = None
 
+    def load(self, balances, batch_size=1000):
+        """ Replace the state with balances (a dict of pub_x -> balance, e.g. a snapshot's full_state()). """
+        self.reset()
+        accounts = [(p, b) for p, b in balances.items() if b > 0]
+        for i in range(0, len(accounts), batch_size):
+            batch = accounts[i:i + batch_size]
+            self.modify_many_balances([p for p, b in batch], [b for p, b in batch])
+        if 0 not in balances:
+            self.modify_balance(0, 0)  # reset()'s placeholder, it's hashed if present
 
     @property
     def hash(self):
         # todo : note : this hash method relies on a map of pubkey_x's to balances. it'll fail with any other state
         if self._hash is None:
-            all_pubkeys = list(self.all_keys())
-            all_pubkeys.sort()
-            pair_to_bytes = lambda p, b1, b2 : (p[0].to_bytes(b1, 'big') + p[1].to_bytes(b2, 'big'))
-            self._hash = global_hash(b''.join(map(lambda i : pair_to_bytes(i, 32, 8), zip(all_pubkeys, [self.get(i) for i in all_pubkeys]))))
+            self._hash = self._tree.root()
         return self._hash
 
 
+class StateOverlay:
+    """ A copy-on-write view over a State.
+    Balance changes are held in process memory, and the hash they would produce is computed from the state's merkle
+    tree without writing to redis or taking State.lock. Used to find or check the state_hash of a candidate block.
+
+    With cache_reads, balances and merkle buckets read from the state are kept, so repeated hashes (e.g. after each
+    block of a reorg) only read what's new. That's only correct while the state can't change, i.e. under State.lock.
+    """
+    def __init__(self, state: State, cache_reads=False):
+        self._state = state
+        self._balances = {}  # pub_x -> balance after our changes, for every account touched
+        self._deltas = defaultdict(int)  # pub_x -> net change
+        self._base = {} if cache_reads else None  # pub_x -> balance in the state
+        self._snapshot = {'contents': {}, 'nodes': {}} if cache_reads else None
+
+    def prefetch(self, pub_xs):
+        # read many base balances in one call
+        if self._base is not None:
+            pub_xs = [p for p in set(pub_xs) if p not in self._base]
+            self._base.update(zip(pub_xs, self._state.get_many(pub_xs)))
+
+    def _get_base(self, pub_x):
+        if self._base is None:
+            return self._state.get(pub_x)
+        if pub_x not in self._base:
+            self._base[pub_x] = self._state.get(pub_x)
+        return self._base[pub_x]
+
+    def get(self, pub_x: ECPoint):
+        if pub_x not in self._balances:
+            return self._get_base(pub_x)
+        return self._balances[pub_x]
+
+    def modify_balance(self, pub_x: ECPoint, value: MoneyAmount):
+        self.modify_many_balances([pub_x], [value])
+
+    def modify_many_balances(self, pub_xs, values):
+        for pub_x, value in zip(pub_xs, values):
+            new_balance = self.get(pub_x) + value
+            assert new_balance >= 0, "Cannot allow negative balance"
+            self._balances[pub_x] = new_balance
+            self._deltas[pub_x] += value
+
+    @property
+    def changes(self):
+        return dict(self._balances)
+
+    @property
+    def deltas(self):
+        """ Net change to every account touched (possibly 0). """
+        return dict(self._deltas)
+
+    @property
+    def hash(self):
+        return self._state._tree.root_with(self._balances, self._snapshot)
+
+
+SNAPSHOT_CHUNK_ACCOUNTS = 2000  # accounts per chunk, 80KB
+SNAPSHOTS_KEPT = 2
+
+
+class StateSnapshots:
+    """ Copies of the state at given blocks, stored as chunks ready to serve to peers (see SnapshotSync).
+    A snapshot is every (pub_x, balance) of the state in order of pub_x, chunk_accounts to a chunk, encoded with
+    accounts_to_bytes. StateMerkleTree.root_of the whole of it is the block's state_hash. Only the latest `keep` are
+    kept.
+
+    Redis Particulars:
+        {path}.index : hash_map(height -> block_hash)
+        {path}.{block_hash} : hash_map(chunk index -> chunk)
+    """
+    def __init__(self, db: Database, path="state_snapshots", keep=SNAPSHOTS_KEPT, chunk_accounts=SNAPSHOT_CHUNK_ACCOUNTS):
+        self._db = db
+        self._r = db.redis
+        self._path = path
+        self._index = RedisHashMap(db, concat(path, 'index'), int, int)
+        self._keep = keep
+        self._chunk_accounts = chunk_accounts
+
+    def _chunks_path(self, block_hash):
+        return concat(self._path, block_hash)
+
+    def take(self, height, block_hash, balances):
+        """ :param balances: dict of pub_x -> balance, the state as of block_hash """
+        accounts = sorted(balances.items())
+        chunks = {i // self._chunk_accounts: accounts_to_bytes(accounts[i:i + self._chunk_accounts])
+                  for i in range(0, len(accounts), self._chunk_accounts)}
+        kept = sorted(self._index.get_all().items())
+        dropped = kept[:max(0, len(kept) + 1 - self._keep)]
+
+        pipe = self._r.pipeline()
+        pipe.delete(self._chunks_path(block_hash))
+        if len(chunks) > 0:
+            pipe.hmset(self._chunks_path(block_hash), chunks)
+        pipe.hset(concat(self._path, 'index'), height, block_hash)
+        for old_height, old_hash in dropped:
+            if old_height != height:
+                pipe.hdel(concat(self._path, 'index'), old_height)
+                pipe.delete(self._chunks_path(old_hash))
+        pipe.execute()
+
+    def latest(self):
+        """ :return: (height, block_hash, number of chunks) of the latest snapshot, or None """
+        kept = self._index.get_all()
+        if len(kept) == 0:
+            return None
+        height = max(kept)
+        return height, kept[height], self._r.hlen(self._chunks_path(kept[height]))
+
+    def get_chunk(self, block_hash, index):
+        """ :return: the chunk's bytes, or None if we don't have it """
+        return self._r.hget(self._chunks_path(block_hash), index)
+
+    def reset(self):
+        for height, block_hash in self._index.get_all().items():
+            self._r.delete(self._chunks_path(block_hash))
+        self._index.reset()
+
+
 class PrimaryChain:
     """ PrimaryChain is a list of hashes representing the primary chain.
     """
@@ -246,16 +646,52 @@ class PrimaryChain:
         self._chain = RedisList(db, path, int)
 
         self._get_all = lua_helpers.get_primary_chain_get_all(r, path)
+        self._get_many = lua_helpers.get_primary_chain_get_many(r, path)
+        self._get_range = lua_helpers.get_primary_chain_get_range(r, path)
+        self._contains_many = lua_helpers.get_primary_chain_contains_many(r, path)
         self._remove = lua_helpers.get_primary_chain_remove(r, path)
         self._append = lua_helpers.get_primary_chain_append(r, path)
+        self._index = lua_helpers.get_primary_chain_index(r, path)
         self._contains = lua_helpers.get_primary_chain_contains(r, path)
 
     @ensure_type
     def get_all(self):
         return self._get_all()
 
-    def append_hashes(self, block_hashes):
-        self._append(keys=block_hashes)
+    def get_at(self, height):
+        return self.get_many([height])[0]
+
+    def get_many(self, heights):
+        """ Look up the hashes at many heights in one call. Heights beyond the chain give None. """
+        return [None if h is None else int(h) for h in self._get_many(args=heights)]
+
+    def get_range(self, start, stop):
+        """ :return: list of (block_hash, total_work) for heights start (inclusive) to stop (exclusive) """
+        if stop <= start:
+            return []
+        hashes, total_works = self._get_range(args=[start, stop])
+        return list(zip(map(int, hashes), map(int, total_works)))
+
+    def __len__(self):
+        return self._r.llen(concat(self._path, 'l'))
+
+    @property
+    def indexed(self):
+        """ Are heights and total works kept for the whole chain? Not if it was stored before they were. """
+        pipe = self._r.pipeline()
+        pipe.llen(concat(self._path, 'l'))
+        pipe.hlen(concat(self._path, 'h'))
+        pipe.hlen(concat(self._path, 'w'))
+        length, n_heights, n_works = pipe.execute()
+        return length == n_heights == n_works
+
+    def index(self, start, total_works):
+        """ Record heights and total works for the blocks from height start """
+        if len(total_works) > 0:
+            self._index(keys=[start], args=total_works)
+
+    def append_hashes(self, block_hashes, total_works=()):
+        self._append(keys=block_hashes, args=list(total_works))
 
     def remove_hashes(self, block_hashes):
         self._remove(keys=block_hashes)
@@ -263,12 +699,90 @@ class PrimaryChain:
     def contains(self, block_hash):
         return bool(self._contains(keys=[block_hash]))
 
+    def contains_many(self, block_hashes):
+        if len(block_hashes) == 0:
+            return []
+        return list(map(bool, self._contains_many(keys=block_hashes)))
+
+
+class AncestorIndex:
+    """ An AncestorIndex answers ancestry questions about blocks in O(log n) lookups, in one call each.
+    When a block is added, pointers to its ancestors 1, 2, 4, 8, ... generations back are stored (binary lifting).
+
+    Redis Particulars:
+        {path}.p : hash_map('block_hash:k' -> hash of the ancestor 2^k generations back)
+        {path}.h : hash_map(block_hash -> height)
+    """
+    def __init__(self, db, path="ancestors"):
+        self._db = db
+        self._r = r = db.redis
+        self._path = path
+        self._add = lua_helpers.get_ancestors_add(r, path)
+        self._at_height = lua_helpers.get_ancestors_at_height(r, path)
+        self._common = lua_helpers.get_ancestors_common(r, path)
+        self._path_between = lua_helpers.get_ancestors_path(r, path)
+
+    def add(self, block_hash, parent_hash=None):
+        # the parent must already have been added, a root has no parent
+        return self._add(keys=[block_hash], args=['' if parent_hash is None else parent_hash])
+
+    def contains(self, block_hash):
+        return self._r.hexists(concat(self._path, 'h'), block_hash)
+
+    def height_of(self, block_hash):
+        return int(self._r.hget(concat(self._path, 'h'), block_hash))
+
+    def ancestor_at_height(self, block_hash, height):
+        result = self._at_height(keys=[block_hash], args=[height])
+        return None if result is None else int(result)
+
+    def common_ancestor(self, block_hash_a, block_hash_b):
+        result = self._common(keys=[block_hash_a, block_hash_b])
+        return None if result is None else int(result)
+
+    def path_between(self, early_hash, late_hash):
+        """ :return: hashes of the blocks after early_hash up to and including late_hash, oldest first """
+        return list(map(int, self._path_between(keys=[early_hash, late_hash])))
+
+
+class ReorgCommit:
+    """ Commits a reorganisation in one atomic call: the net balance changes to a State, the blocks leaving and
+    joining the end of a PrimaryChain, and the new top block.
+    """
+    def __init__(self, db, state: State, primary_chain: PrimaryChain, top_block_key=TOP_BLOCK):
+        self._state = state
+        self._commit = lua_helpers.get_reorg_commit(db.redis, state._path, primary_chain._path, top_block_key)
+
+    def __call__(self, balance_changes, removed_hashes, appended_blocks, top_block_hash):
+        """
+        :param balance_changes: dict of pub_x -> net change
+        :param removed_hashes: hashes leaving the end of the primary chain
+        :param appended_blocks: blocks joining the end of the primary chain, in order
+        """
+        pub_xs = list(balance_changes)
+        journals = [j.path for j in self._state._journals]
+        args = [len(pub_xs), len(journals), len(removed_hashes), len(appended_blocks), top_block_hash]
+        args += [balance_changes[p] for p in pub_xs] + [StateMerkleTree.bucket_of(p) for p in pub_xs] + journals
+        args += list(removed_hashes) + [b.hash for b in appended_blocks] + [b.total_work for b in appended_blocks]
+        self._commit(keys=pub_xs, args=args)
+        self._state._hash = None
+
+
+MAX_ORPHANS = 5000
+MAX_ORPHAN_BYTES = 16 * 1024 * 1024
+ORPHANS_PER_PEER = 1000
+ORPHAN_MAX_AGE = 60 * 60  # seconds
+
 
 class Orphanage:
     """ An Orphanage holds orphans.
     It acts as a priority queue, through put(), get(), etc. This is sorted by sigmadiff.
     For membership it acts as a set.
 
+    It's bounded: past max_count orphans or max_bytes of them, those with the least total work (the oldest of
+    those, on a tie) are evicted. An orphan's total work is only claimed until it connects, so add() can cap it
+    first. A peer may have at most peer_quota orphans here at once, and sweep() removes orphans older than max_age.
+
     Requirements:
     membership test for orphans (1)
     retrieval of orphans (2)
@@ -284,16 +798,40 @@ class Orphanage:
             3. hash_map(block_hash -> {linking_block_hashes})
             4. {linking_block_hashes} -> set(linking_block_hashes)
 
+        Bounds:
+            {path}.w : sorted_set(block_hash by total_work)
+            {path}.t : sorted_set(block_hash by arrival time)
+            {path}.b : hash_map(block_hash -> len(ser_block)), {path}.bytes : their sum
+            {path}.l : hash_map(block_hash -> linked_block_hash)
+            {path}.p : hash_map(block_hash -> peer), {path}.pc : hash_map(peer -> number of orphans)
+
+        Components (orphans linked to each other, labelled by their deepest missing ancestor):
+            {path}.c : hash_map(block_hash -> label), {path}.u : hash_map(label -> label it merged into)
+            {path}.need : sorted_set(label by total work of the component's tip)
+
     """
-    def __init__(self, db, path="orphanage"):
+    def __init__(self, db, path="orphanage", max_count=MAX_ORPHANS, max_bytes=MAX_ORPHAN_BYTES,
+                 peer_quota=ORPHANS_PER_PEER, max_age=ORPHAN_MAX_AGE):
         self._db = db
         self._r = r = db.redis
         self._path = path
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._peer_quota = peer_quota
+        self._max_age = max_age
         self._get = lua_helpers.get_orphanage_get(r, path)
         self._add = lua_helpers.get_orphanage_add(r, path)
         self._contains = lua_helpers.get_orphanage_contains(r, path)
         self._remove = lua_helpers.get_orphanage_remove(r, path)
         self._linking_to = lua_helpers.get_orphanage_linking_to(r, path)
+        self._subtree = lua_helpers.get_orphanage_subtree(r, path)
+        self._sweep = lua_helpers.get_orphanage_sweep(r, path)
+        self._clean_rev = lua_helpers.get_orphanage_clean_rev(r, path)
+
+        if r.scard(path + '.s') != r.zcard(path + '.t'):
+            # orphans from before arrivals and work were recorded, once
+            adopted = lua_helpers.get_orphanage_adopt(r, path)(args=[time.time()])
+            print('Orphanage adopted %d untracked orphans' % adopted)
 
     def __contains__(self, block: SimpleBlock):
         return self._contains(keys=[block.hash])
@@ -301,8 +839,33 @@ class Orphanage:
     def remove(self, block: SimpleBlock):
         return self._remove(keys=[block.hash, block.links[0]])
 
-    def add(self, block: SimpleBlock):
-        return self._add(keys=[block.to_json(), block.hash, block.links[0]])
+    def add(self, block: SimpleBlock, peer=None, max_work=None):
+        """ :param max_work: the most total work the orphan is credited with (for eviction and needs), if it claims more
+        :return: False if peer is over its quota, otherwise True (though the orphan may have been evicted) """
+        work = block.total_work if max_work is None else min(block.total_work, max_work)
+        result = self._add(keys=[block.to_json(), block.hash, block.links[0]],
+                           args=[work, time.time(), '' if peer is None else str(peer), self._max_count,
+                                 self._max_bytes, self._peer_quota])
+        if result > 0:
+            print('Orphanage full, evicted %d' % result)
+        return result != -1
+
+    def __len__(self):
+        return self._r.scard(self._path + '.s')
+
+    @property
+    def size_in_bytes(self):
+        return int(self._r.get(self._path + '.bytes') or 0)
+
+    def sweep(self):
+        """ Remove orphans older than max_age and reverse links left behind by orphans that are gone, and relabel the
+        components (dropping stale needs).
+        :return: (orphans expired, reverse links cleaned)
+        """
+        expired, components = self._sweep(args=[time.time() - self._max_age])
+        linked = self._r.hkeys(self._path + '.r')
+        cleaned = self._clean_rev(keys=linked) if len(linked) > 0 else 0
+        return expired, cleaned
 
     def get(self, block_hash):
         block = self._get(keys=[block_hash])
@@ -310,11 +873,19 @@ class Orphanage:
             block = SimpleBlock.from_json(block.decode())
         return block
 
+    def needs(self, n=None):
+        """ The missing ancestors of orphan components, heaviest component first.
+        :return: list of (block_hash, total work of the component's tip)
+        """
+        needed = self._r.zrevrange(self._path + '.need', 0, -1 if n is None else n - 1, withscores=True)
+        return [(int(h.decode()), int(work)) for h, work in needed]
+
     def children_of(self, parent_hash):
-        # decode bytes into block objects
-        print(self._linking_to(keys=[parent_hash]))
-        print({int(i.decode()) for i in self._linking_to(keys=[parent_hash])})
         return {int(i.decode()) for i in self._linking_to(keys=[parent_hash])}
 
+    def descendants_of(self, block_hash):
+        """ Every orphan descending from block_hash, in one call; parents come before their children. """
+        return [SimpleBlock.from_json(b.decode()) for b in self._subtree(keys=[block_hash])]
+
     def contains_block_hash(self, block_hash):
         return self._contains(keys=[block_hash])
@@ -0,0 +1,126 @@
+import asyncio, json, threading
+from binascii import hexlify
+
+from WSSTT import Network
+
+from blockchain import Chain
+from structs import SimpleBlock
+from helpers import work_target_to_hash_target
+from message_handlers import BLOCK_ANNOUNCE, BlockAnnounce
+from miner import Miner
+
+NONCE_RANGE = 2**24  # nonces handed to a worker per getwork
+
+
+class WorkServer:
+    """ Hands out block templates to external mining workers over a local socket and takes nonces back.
+
+    Protocol: newline delimited JSON, one response per request.
+
+    getwork ({"method": "getwork"}) -> {"template_id": str, "head_version": int, "prefix": hex, "suffix": hex,
+        "hash_target": int, "nonce_start": int, "nonce_count": int}
+        A block's serialization is prefix + str(nonce) + suffix, and a nonce is acceptable if the sha256 of that, as
+        a big endian int, is below hash_target. Each getwork gets its own range of nonces.
+
+    version ({"method": "version"}) -> {"head_version": int}
+        head_version changes every time the chain's head does; templates from an older version are stale.
+
+    submit ({"method": "submit", "template_id": str, "nonce": int}) -> {"accepted": bool, "reason": str}
+        The nonce must be in a range getwork handed out for the template. Winners are broadcast with BLOCK_ANNOUNCE,
+        and their template is retired, so a second winner for it is rejected as stale.
+    """
+    def __init__(self, chain: Chain, p2p: Network, miner: Miner, address=('127.0.0.1', 2282)):
+        self._chain = chain
+        self._p2p = p2p
+        self._miner = miner
+        self._address = address
+
+        self._lock = threading.Lock()
+        self._head_version = 0
+        self._template = None  # (template_id, candidate, prefix, suffix)
+        self._next_nonce = 0
+        self._templates = {}  # template_id -> [prefix, suffix, first nonce issued, end of nonces issued], this head
+        self._n_templates = 0  # made for this head, so ids aren't reused once templates are retired
+
+        chain.subscribe_head_change(self._on_new_head)
+
+    def start(self):
+        return asyncio.async(asyncio.start_server(self._handle_connection, *self._address))
+
+    def _on_new_head(self, head):
+        with self._lock:
+            self._head_version += 1
+            self._template = None
+            self._templates = {}
+            self._n_templates = 0
+
+    # Templates
+
+    def _new_template(self):
+        candidate = self._miner.make_candidate()
+        prefix, suffix = self._miner.split_candidate(candidate)
+        template_id = '%d.%d' % (self._head_version, self._n_templates)
+        self._n_templates += 1
+        self._template = (template_id, candidate, prefix, suffix)
+        self._templates[template_id] = [prefix, suffix, self._miner.special_nonce, self._miner.special_nonce]
+        self._next_nonce = self._miner.special_nonce
+
+    def getwork(self):
+        with self._lock:
+            width = len(str(self._miner.special_nonce))
+            if self._template is None or len(str(self._next_nonce + NONCE_RANGE)) != width:
+                self._new_template()  # nonces must keep their width, or the storage fee (and state_hash) changes
+            template_id, candidate, prefix, suffix = self._template
+            nonce_start = self._next_nonce
+            self._next_nonce += NONCE_RANGE
+            self._templates[template_id][3] = self._next_nonce
+            return {'template_id': template_id, 'head_version': self._head_version, 'prefix': hexlify(prefix).decode(),
+                    'suffix': hexlify(suffix).decode(), 'hash_target': work_target_to_hash_target(candidate.work_target),
+                    'nonce_start': nonce_start, 'nonce_count': NONCE_RANGE}
+
+    def version(self):
+        return {'head_version': self._head_version}
+
+    def submit(self, template_id, nonce):
+        with self._lock:
+            if template_id.split('.')[0] != str(self._head_version) or template_id not in self._templates:
+                return {'accepted': False, 'reason': 'stale'}
+            prefix, suffix, first_nonce, end_nonce = self._templates[template_id]
+        if not first_nonce <= nonce < end_nonce:
+            return {'accepted': False, 'reason': 'nonce not issued'}
+        block = SimpleBlock.from_json((prefix + str(nonce).encode() + suffix).decode())
+        if not block.acceptable_work:
+            return {'accepted': False, 'reason': 'unacceptable work'}
+        with self._lock:
+            if self._templates.pop(template_id, None) is None:
+                return {'accepted': False, 'reason': 'stale'}  # another worker's winner got in first
+            if self._template is not None and self._template[0] == template_id:
+                self._template = None
+        print('Announcing Block from external worker')
+        self._p2p.broadcast(BLOCK_ANNOUNCE, BlockAnnounce.from_block(block))
+        return {'accepted': True, 'reason': ''}
+
+    # Socket
+
+    def _dispatch(self, request):
+        method = request.get('method')
+        if method == 'getwork':
+            return self.getwork()
+        if method == 'version':
+            return self.version()
+        if method == 'submit':
+            return self.submit(str(request['template_id']), int(request['nonce']))
+        return {'error': 'unknown method %s' % method}
+
+    @asyncio.coroutine
+    def _handle_connection(self, reader, writer):
+        while True:
+            line = yield from reader.readline()
+            if not line:
+                break
+            try:
+                response = self._dispatch(json.loads(line.decode()))
+            except Exception as e:
+                response = {'error': str(e)}
+            writer.write((json.dumps(response) + '\n').encode())
+        writer.close()
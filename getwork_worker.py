@@ -0,0 +1,51 @@
+""" A stand-in external mining worker, for testing the getwork endpoint (see getwork.WorkServer).
+It only needs the standard library and mining_kernel.py.
+
+Usage: python getwork_worker.py [-host 127.0.0.1] [-port 2282]
+"""
+import sys, json, socket
+
+from mining_kernel import MiningKernel, NONCE_BATCH
+
+host = sys.argv[sys.argv.index("-host") + 1] if "-host" in sys.argv else '127.0.0.1'
+port = int(sys.argv[sys.argv.index("-port") + 1]) if "-port" in sys.argv else 2282
+
+BATCHES_BETWEEN_VERSION_CHECKS = 100
+
+
+class WorkClient:
+    def __init__(self, address):
+        self._sock = socket.create_connection(address)
+        self._file = self._sock.makefile('rwb')
+
+    def call(self, method, **kwargs):
+        kwargs['method'] = method
+        self._file.write((json.dumps(kwargs) + '\n').encode())
+        self._file.flush()
+        return json.loads(self._file.readline().decode())
+
+
+def work(client, max_templates=None):
+    """ Mine getwork templates until max_templates (default: no limit) have been worked through. """
+    n_templates = 0
+    while max_templates is None or n_templates < max_templates:
+        n_templates += 1
+        w = client.call('getwork')
+        kernel = MiningKernel(bytes.fromhex(w['prefix']), bytes.fromhex(w['suffix']), w['hash_target'])
+        nonce, end = w['nonce_start'], w['nonce_start'] + w['nonce_count']
+        batches = 0
+        while nonce < end:
+            winner = kernel.search(nonce, 1, min(NONCE_BATCH, end - nonce))
+            if winner is not None:
+                print('Found', winner, client.call('submit', template_id=w['template_id'], nonce=winner))
+                break
+            nonce += NONCE_BATCH
+            batches += 1
+            if batches % BATCHES_BETWEEN_VERSION_CHECKS == 0:
+                if client.call('version')['head_version'] != w['head_version']:
+                    print('Template is stale, getting new work')
+                    break
+
+
+if __name__ == '__main__':
+    work(WorkClient((host, port)))
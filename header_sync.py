@@ -0,0 +1,167 @@
+from collections import deque
+import time
+
+from structs import BlockHeader
+
+MAX_HEADERS = 500  # headers per HEADERS_PROVIDE, each carried as its block (see validate)
+MAX_STAGED_BODIES = 2000  # bodies held for earlier ones to arrive; past this they go to the chain as they come
+SKELETON_TIMEOUT = 120  # seconds without a body being released before the skeleton is dropped
+
+
+class HeaderSync:
+    """ The skeleton for headers-first sync: a validated run of headers extending a block we have, toward the best
+    chain a peer has told us about. Bodies (which come with the headers, or from the Seeker if they're turned away)
+    are released to the chain strictly in skeleton order, so none of them end up in the orphanage.
+
+    A block's hash covers all of it, so a header can only be checked against the block it came from: headers arrive
+    as their blocks, and each block's hash is recomputed and must meet its work_target. Each must also link to the
+    one before and have total_work follow from its parent's. A body is only released for a header if it hashes to it
+    and agrees with it.
+
+    A skeleton that releases nothing for SKELETON_TIMEOUT is dropped (see drop_stalled), so bodies that never turn
+    up (or never verify) can't hold up sync from other peers.
+    """
+    def __init__(self, chain):
+        self._chain = chain
+        self._order = deque()  # skeleton hashes not yet released, oldest first
+        self._headers = {}  # block_hash -> BlockHeader, for the skeleton
+        self._bodies = {}  # block_hash -> SimpleBlock, arrived but waiting on an earlier body
+        self._last_released = None  # header of the last body released, which the chain may not have added yet
+        self._progress_at = time.time()  # when a body was last released, or the skeleton started
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._headers
+
+    def header_of(self, block_hash):
+        """ :return: block_hash's header if it's in the skeleton, otherwise None """
+        return self._headers.get(block_hash)
+
+    def holds(self, block_hash):
+        """ Do we have block_hash's body, waiting on an earlier one? """
+        return block_hash in self._bodies
+
+    @property
+    def tip(self):
+        return self._headers[self._order[-1]] if len(self._order) > 0 else self._last_released
+
+    def wants_headers_from(self, total_work):
+        """ Is a peer claiming total_work worth syncing headers from? """
+        best = self._chain.head.total_work if self.tip is None else max(self.tip.total_work,
+                                                                         self._chain.head.total_work)
+        return total_work > best
+
+    def locator(self):
+        return ([self.tip.hash] if self.tip is not None else []) + self._chain.make_block_locator()
+
+    def _header(self, block_hash):
+        if block_hash in self._headers:
+            return self._headers[block_hash]
+        if self._last_released is not None and self._last_released.hash == block_hash:
+            return self._last_released
+        return self._chain.get_header(block_hash)
+
+    @staticmethod
+    def validate(parent: BlockHeader, blocks):
+        """ Raise ValueError unless blocks form a valid chain from parent.
+        :return: their headers
+        """
+        headers = []
+        for block in blocks:
+            if block.links != [parent.hash]:
+                raise ValueError('Block %064x does not link to the one before it' % block.hash)
+            if block.total_work != parent.total_work + block.work_target:
+                raise ValueError('Block %064x has the wrong total work' % block.hash)
+            if block.work_target <= 100000:
+                raise ValueError('Block %064x has too low a work target' % block.hash)
+            if not block.acceptable_work:  # block.hash is computed from the block, not taken from the peer
+                raise ValueError('Block %064x does not meet its work target' % block.hash)
+            parent = BlockHeader(block.hash, parent.hash, block.total_work, block.work_target, parent.height + 1)
+            headers.append(parent)
+        return headers
+
+    def add(self, blocks):
+        """ Validate blocks (the preimages of their headers) and extend (or replace, if they lead somewhere heavier)
+        the skeleton with their headers.
+        :return: the headers new to the skeleton, whose bodies should be fetched
+        """
+        if len(blocks) == 0:
+            return []
+        parent = self._header(blocks[0].links[0]) if len(blocks[0].links) == 1 else None
+        if parent is None:
+            raise ValueError('Headers do not connect to anything we know')
+        headers = self.validate(parent, blocks)
+
+        if self.tip is not None and parent.hash != self.tip.hash:
+            if headers[-1].total_work <= self.tip.total_work:
+                return []  # a lighter branch
+            self._truncate_after(parent.hash)
+        if len(self._order) == 0:
+            self._progress_at = time.time()
+        new = [h for h in headers if h.hash not in self._headers and not self._chain.contains_block(h.hash)]
+        for header in new:
+            self._headers[header.hash] = header
+            self._order.append(header.hash)
+        return new
+
+    def drop_stalled(self):
+        """ Drop the skeleton if no body has been released from it for SKELETON_TIMEOUT. :return: whether it was """
+        if len(self._order) == 0 or time.time() - self._progress_at < SKELETON_TIMEOUT:
+            return False
+        print('Dropping a stalled skeleton of %d headers' % len(self._order))
+        self._truncate_after(None)
+        return True
+
+    def _truncate_after(self, block_hash):
+        keep = self._order.index(block_hash) + 1 if block_hash in self._headers else 0
+        while len(self._order) > keep:
+            dropped = self._order.pop()
+            self._headers.pop(dropped)
+            self._bodies.pop(dropped, None)
+
+    def pending(self):
+        """ :return: headers in the skeleton whose bodies haven't been released, oldest first """
+        return [self._headers[h] for h in self._order]
+
+    def take_through(self, block_hash):
+        """ Remove the skeleton up to and including block_hash, as if released, without their bodies (e.g. for a
+        state snapshot at block_hash).
+        :return: the headers removed, oldest first
+        """
+        taken = []
+        while block_hash in self._headers:
+            taken.append(self._headers.pop(self._order.popleft()))
+            self._bodies.pop(taken[-1].hash, None)
+            self._last_released = taken[-1]
+        return taken
+
+    def take_ready(self, blocks):
+        """ Blocks outside the skeleton pass straight through. Skeleton blocks are held until every body before them
+        has arrived and are then released, in order.
+        :return: blocks to hand to the chain
+        """
+        passthrough = []
+        for block in blocks:
+            header = self._headers.get(block.hash)
+            if header is None or len(self._bodies) >= MAX_STAGED_BODIES:
+                passthrough.append(block)
+            elif block.links != [header.parent] or block.total_work != header.total_work \
+                    or block.work_target != header.work_target:
+                print('Body disagrees with its header, dropping the skeleton from there')
+                self._truncate_after(header.parent)
+                passthrough.append(block)
+            else:
+                self._bodies[block.hash] = block
+        ready = []
+        while len(self._order) > 0:
+            block_hash = self._order[0]
+            if block_hash in self._bodies:
+                ready.append(self._bodies.pop(block_hash))
+            elif not self._chain.contains_block(block_hash):  # it may have come another way
+                break
+            self._order.popleft()
+            self._last_released = self._headers.pop(block_hash)
+            self._progress_at = time.time()
+        return passthrough + ready
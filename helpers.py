@@ -1,4 +1,5 @@
 from hashlib import sha256
+from collections import OrderedDict
 from queue import Empty
 from asyncio import PriorityQueue
 import threading
@@ -75,6 +76,108 @@ def replace_type_with_decode_if_str(type):
         return lambda i: i.decode()
     return type
 
+# Binary serialization
+
+BINARY_FORMAT_V1 = 1  # first byte of a binary encoding; JSON always starts with '{'
+
+def encode_varint(n):
+    assert n >= 0
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def decode_varint(data, offset=0):
+    """ Only the minimal encoding (as encode_varint makes) of a value is accepted, so each has one encoding.
+    :return: (value, offset after the varint) """
+    n = shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError('Unexpected end of data')
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            if b == 0 and shift > 0:
+                raise ValueError('Non-minimal varint')
+            return n, offset
+        shift += 7
+
+def read_int(data, offset, length):
+    """ :return: (big endian unsigned int of length bytes, offset after it) """
+    if offset + length > len(data):
+        raise ValueError('Unexpected end of data')
+    return int.from_bytes(data[offset:offset + length], 'big'), offset + length
+
+# Inventory digests (see database.InventoryIndex)
+
+INV_RANGE = 256  # heights per range
+INV_DIGEST_BITS = 40  # low bits of each hash summed into its range's digest; 2**23 blocks per range before overflow
+INV_MAX_HASHES = 500  # hashes per INV_PROVIDE, as many blocks as a BLOCK_PROVIDE carries
+
+# Caches
+
+class LRUCache:
+    """ A bounded, thread safe, least-recently-used cache.
+    Each entry has a size (1 by default) and the least recently used entries are evicted once the total size is
+    over max_size. Hits and misses are counted.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def remove(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'max_size': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
 # Threads
 
 def wait_for_all_threads_to_finish(threads):
@@ -103,8 +206,27 @@ def nice_sleep(object, seconds):
 
 # Crypto Helpers
 
+SIGNATURE_CACHE_SIZE = 100000  # entries
+
+# (pub_x, pub_y, msg_hash, r, s) -> True for signatures that have verified, here or elsewhere (e.g. by a
+# verification.BlockVerifier worker process). Blocks are decoded again and again (from the block index, the
+# orphanage, relays) and each decode checks the signature; only the first needs the curve arithmetic.
+_verified_signatures = LRUCache(SIGNATURE_CACHE_SIZE)
+
+def mark_signatures_verified(signature_tuples):
+    for signature in signature_tuples:
+        _verified_signatures.put(signature, True)
+
+def signature_cache_stats():
+    return _verified_signatures.stats()
+
 def valid_secp256k1_signature(x, y, msg, r, s):
-    return ecdsa.verify(ecdsa.generator_secp256k1, (x, y), global_hash(msg), (r, s))
+    if _verified_signatures.get((x, y, msg, r, s)):
+        return True
+    valid = ecdsa.verify(ecdsa.generator_secp256k1, (x, y), msg, (r, s))  # msg is the hash that was signed
+    if valid:
+        _verified_signatures.put((x, y, msg, r, s), True)
+    return valid
 
 def pubkey_for_secret_exponent(exponent):
     return ecdsa.public_pair_for_secret_exponent(ecdsa.generator_secp256k1, exponent)
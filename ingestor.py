@@ -0,0 +1,123 @@
+import asyncio, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import global_hash
+from verification import BlockVerifier
+from header_sync import HeaderSync
+
+MAX_PIPELINE_BLOCKS = 5000  # blocks between put and applied; past this incoming blocks are shed
+APPLY_BATCH_SIZE = 500  # blocks handed to Chain.add_blocks at once
+
+
+class BlockIngestor:
+    """ The pipeline incoming blocks go through, so message handlers return straight away and the event loop keeps
+    answering queries (CHAIN_INFO, BLOCK_REQUEST, ...) while blocks are applied.
+
+    Stages:
+        1. dedup: blocks already in the pipeline (by their encoding) are dropped, on the loop
+        2. stateless validation: signatures, PoW and check() in a BlockVerifier's process pool
+        3. parent resolution: bodies for a HeaderSync skeleton are held until those before them have arrived
+        4. state application: Chain.add_blocks on one dedicated thread, heaviest blocks last; queued batches are
+           merged up to APPLY_BATCH_SIZE blocks
+        5. relay: on_added(block_hashes) callbacks, back on the loop, with the hashes of the blocks that verified
+
+    At most max_blocks blocks are in the pipeline at once. Blocks beyond that are shed: they're not remembered
+    anywhere, so the Seeker asks for them again later, once the pipeline has drained.
+    """
+    def __init__(self, chain, verifier: BlockVerifier=None, skeleton: HeaderSync=None,
+                 max_blocks=MAX_PIPELINE_BLOCKS, batch_size=APPLY_BATCH_SIZE):
+        self._chain = chain
+        self._verifier = BlockVerifier() if verifier is None else verifier
+        self._skeleton = skeleton
+        self._max_blocks = max_blocks
+        self._batch_size = batch_size
+        self._in_pipeline = set()  # sha256 of the encoding of each block from put_encoded() until it's applied
+        self._verified = asyncio.Queue()  # (keys, blocks, on_added, peer) waiting to be applied
+        self._worker = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+        self.shed = 0  # blocks turned away because the pipeline was full
+
+    def __len__(self):
+        return len(self._in_pipeline)
+
+    @property
+    def full(self):
+        return len(self._in_pipeline) >= self._max_blocks
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.async(self._apply_batches())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._worker.shutdown(wait=False)
+        self._verifier.shutdown()
+
+    def run_in_worker(self, f, *args):
+        """ Run f on the thread blocks are applied on, between batches. :return: a future """
+        return asyncio.get_event_loop().run_in_executor(self._worker, f, *args)
+
+    @asyncio.coroutine
+    def verify_all(self, encoded_blocks):
+        """ Decode blocks that aren't for the pipeline (headers), with their checks run in the verifier's pool rather
+        than on the loop. :raises ValueError: if any of them fails """
+        loop = asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(None, self._verifier.verify_all, encoded_blocks))
+
+    def put_encoded(self, encoded_blocks, on_added=None, peer=None):
+        """ Queue blocks (binary encodings). Returns immediately, with the number of blocks taken in;
+        on_added(block_hashes), if given, is called on the event loop once they've been processed (whether or not they
+        were accepted), with the hashes of those that verified. peer is where they came from, charged for any that end
+        up orphaned. """
+        fresh = []
+        for encoded in encoded_blocks:
+            key = global_hash(encoded)
+            if key in self._in_pipeline:
+                continue
+            if self.full:
+                self.shed += 1
+                continue
+            self._in_pipeline.add(key)
+            fresh.append((key, encoded))
+        if len(fresh) > 0:
+            asyncio.async(self._validate(fresh, on_added, peer))
+        elif on_added is not None:
+            on_added([])
+        return len(fresh)
+
+    @asyncio.coroutine
+    def _validate(self, fresh, on_added, peer):
+        loop = asyncio.get_event_loop()
+        keys = [key for key, encoded in fresh]
+        try:
+            blocks = yield from loop.run_in_executor(None, self._verifier.verify, [e for key, e in fresh])
+        except Exception:
+            traceback.print_exc()
+            blocks = []
+        self._verified.put_nowait((keys, blocks, on_added, peer))
+
+    @asyncio.coroutine
+    def _apply_batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batches = [(yield from self._verified.get())]
+            n_blocks = len(batches[0][1])
+            while not self._verified.empty() and n_blocks < self._batch_size:
+                batches.append(self._verified.get_nowait())
+                n_blocks += len(batches[-1][1])
+            blocks = [block for keys, batch, on_added, peer in batches for block in batch]
+            sources = {block.hash: peer for keys, batch, on_added, peer in batches for block in batch
+                       if peer is not None}
+            if self._skeleton is not None:
+                blocks = self._skeleton.take_ready(blocks)
+            try:
+                if len(blocks) > 0:
+                    yield from loop.run_in_executor(self._worker, self._chain.add_blocks, blocks, sources)
+            except Exception:
+                traceback.print_exc()
+            for keys, batch, on_added, peer in batches:
+                self._in_pipeline.difference_update(keys)
+                if on_added is not None:
+                    on_added([block.hash for block in batch])
@@ -8,8 +8,9 @@ def load_lua_file(filename):
 
 
 def make_script_maker_with_functions(functions):
+    # functions are plain lua (not formatted), so they can use braces
     def maker(r, lua_code, path):
-        return make_script(r, functions + lua_code, path)
+        return r.register_script(_functions + functions + lua_code.format(path=path))
     return maker
 
 
@@ -33,6 +34,62 @@ local copy_hashmap = function (from, to)
         redis.call("HMSET", to, unpack(redis.call("HGETALL", from)))
     end
 end
+
+local copy_key = function (from, to)
+    redis.call("DEL", to)
+    if redis.call("EXISTS", from) == 1 then
+        redis.call("RESTORE", to, 0, redis.call("DUMP", from))
+    end
+end
+
+--[[ a state lives at path, with its merkle tree alongside (see database.StateMerkleTree) ]]
+local copy_state = function (from, to)
+    copy_key(from, to)
+    copy_key(from .. ".idx", to .. ".idx")
+    copy_key(from .. ".merkle", to .. ".merkle")
+    copy_key(from .. ".dirty", to .. ".dirty")
+end
+
+local mod_balance = function (path, pub_x, value, bucket)
+    local new_val = get_balance(path, pub_x) + value
+    assert(new_val >= 0, "Cannot allow negative balance")
+    if (new_val > 0) then
+        redis.call("HSET", path, pub_x, new_val)
+        redis.call("ZADD", path .. ".idx", bucket, pub_x)
+    else
+        redis.call("HDEL", path, pub_x)
+        redis.call("ZREM", path .. ".idx", pub_x)
+    end
+    redis.call("HINCRBY", path .. ".dirty", bucket, 1)
+end
+
+--[[ a journal maps pub_x -> "bucket:previous_balance", previous_balance is empty if the account did not exist ]]
+local journal_record = function (path, journal, pub_x, bucket)
+    if redis.call("HEXISTS", journal, pub_x) == 0 then
+        redis.call("HSET", journal, pub_x, bucket .. ":" .. (redis.call("HGET", path, pub_x) or ""))
+    end
+end
+
+local journal_rollback = function (path, journal)
+    local entries = redis.call("HGETALL", journal)
+    local i
+    for i=1, table.getn(entries), 2 do
+        local pub_x = entries[i]
+        local sep = string.find(entries[i + 1], ":")
+        local bucket = string.sub(entries[i + 1], 1, sep - 1)
+        local previous = string.sub(entries[i + 1], sep + 1)
+        if previous == "" then
+            redis.call("HDEL", path, pub_x)
+            redis.call("ZREM", path .. ".idx", pub_x)
+        else
+            redis.call("HSET", path, pub_x, previous)
+            redis.call("ZADD", path .. ".idx", bucket, pub_x)
+        end
+        redis.call("HINCRBY", path .. ".dirty", bucket, 1)
+    end
+    redis.call("DEL", journal)
+    redis.call("SREM", path .. ".journals", journal)
+end
 """
 
 def make_script(r, lua_code, path, **kwargs):
@@ -46,15 +103,15 @@ def make_script(r, lua_code, path, **kwargs):
 
 # Backup
 _backup_state = """
-    copy_hashmap('{path}', KEYS[1])
+    copy_state('{path}', KEYS[1])
 """
 def get_backup_state_function(r, path, backup_path):
     return make_script(r, _backup_state, path, backup_path=backup_path)
 
 # Restore
 _restore_backup_state = """
-    copy_hashmap(KEYS[1], '{path}')
-    redis.call("DEL", KEYS[1])
+    copy_state(KEYS[1], '{path}')
+    redis.call("DEL", KEYS[1], KEYS[1] .. ".idx", KEYS[1] .. ".merkle", KEYS[1] .. ".dirty")
 """
 def get_restore_backup_state_function(r, path, backup_path):
     return make_script(r, _restore_backup_state, path, backup_path=backup_path)
@@ -63,19 +120,17 @@ def get_restore_backup_state_function(r, path, backup_path):
 _mod_balance = """
     local n
     local i
-    local new_val
+    local j
     n = table.getn(KEYS)
     for i=1, n do
-        new_val = get_balance("{path}", KEYS[i]) + ARGV[i]
-        assert(new_val >= 0, "Cannot allow negative balance")
-        if (new_val > 0) then
-            redis.call("HSET", "{path}", KEYS[i], new_val)
-        else
-            redis.call("HDEL", "{path}", KEYS[i])
+        for j=2 * n + 1, table.getn(ARGV) do
+            journal_record("{path}", ARGV[j], KEYS[i], ARGV[n + i])
         end
+        mod_balance("{path}", KEYS[i], ARGV[i], ARGV[n + i])
     end
 """
 def get_mod_balance(r, path):
+    # KEYS are pub_xs, ARGV is the values, then the merkle bucket of each pub_x, then the paths of any open journals
     return make_script(r, _mod_balance, path)
 
 # Balance, get
@@ -85,6 +140,139 @@ _get_balance = """
 def get_get_balance(r, path):
     return make_script(r, _get_balance, path)
 
+# Journals
+_journal_rollback = """
+    journal_rollback("{path}", KEYS[1])
+"""
+def get_journal_rollback(r, path):
+    # KEYS[1] is the journal's path
+    return make_script(r, _journal_rollback, path)
+
+_journal_discard = """
+    redis.call("DEL", KEYS[1])
+    redis.call("SREM", "{path}.journals", KEYS[1])
+"""
+def get_journal_discard(r, path):
+    # KEYS[1] is the journal's path
+    return make_script(r, _journal_discard, path)
+
+# Reset
+_reset_state = """
+    redis.call("DEL", "{path}", "{path}.idx", "{path}.merkle", "{path}.dirty")
+    redis.call("HSET", "{path}", 0, 0)  -- allows backing up an "empty" state
+    redis.call("ZADD", "{path}.idx", 0, 0)
+    redis.call("HINCRBY", "{path}.dirty", 0, 1)
+"""
+def get_reset_state(r, path):
+    return make_script(r, _reset_state, path)
+
+
+#
+# State Merkle Tree
+#
+
+# Dirty buckets and their contents
+_merkle_dirty_buckets = """
+    local result = {{}}
+    local dirty = redis.call("HGETALL", "{path}.dirty")
+    local i
+    for i=1, table.getn(dirty), 2 do
+        local bucket = dirty[i]
+        local members = redis.call("ZRANGEBYSCORE", "{path}.idx", bucket, bucket)
+        table.insert(result, bucket)
+        table.insert(result, dirty[i + 1])
+        table.insert(result, table.getn(members))
+        for j, pub_x in ipairs(members) do
+            table.insert(result, pub_x)
+            table.insert(result, get_balance("{path}", pub_x))
+        end
+    end
+    return result
+"""
+def get_merkle_dirty_buckets(r, path):
+    # returns a flat list of [bucket, generation, n, pub_x_1, balance_1, .., pub_x_n, balance_n, bucket, ..]
+    return make_script(r, _merkle_dirty_buckets, path)
+
+# Consistent view of some buckets, all dirty buckets and the siblings along their paths
+_merkle_snapshot = """
+    local depth = tonumber(ARGV[1])
+    local buckets = {{}}
+    local i
+    for i, bucket in ipairs(KEYS) do
+        buckets[bucket] = true
+    end
+    for i, bucket in ipairs(redis.call("HKEYS", "{path}.dirty")) do
+        buckets[bucket] = true
+    end
+    local contents = {{}}
+    local node_ids = {{}}
+    local nodes = {{}}
+    local seen = {{}}
+    for bucket, _ in pairs(buckets) do
+        local members = redis.call("ZRANGEBYSCORE", "{path}.idx", bucket, bucket)
+        table.insert(contents, bucket)
+        table.insert(contents, table.getn(members))
+        for j, pub_x in ipairs(members) do
+            table.insert(contents, pub_x)
+            table.insert(contents, get_balance("{path}", pub_x))
+        end
+        local index = tonumber(bucket)
+        for level=depth, 1, -1 do
+            local node_id = level .. "." .. (index + 1 - 2 * (index % 2))
+            if not seen[node_id] then
+                seen[node_id] = true
+                table.insert(node_ids, node_id)
+                table.insert(nodes, redis.call("HGET", "{path}.merkle", node_id))
+            end
+            index = math.floor(index / 2)
+        end
+    end
+    return {{contents, node_ids, nodes}}
+"""
+def get_merkle_snapshot(r, path):
+    # KEYS are buckets, ARGV[1] is the depth of the tree.
+    # returns [[bucket, n, pub_x_1, balance_1, .., pub_x_n, balance_n, bucket, ..], [node_id, ..], [node_hash, ..]]
+    return make_script(r, _merkle_snapshot, path)
+
+# Write nodes
+_merkle_commit = """
+    local i
+    for i=1, table.getn(ARGV), 2 do
+        if ARGV[i + 1] == "0" then
+            redis.call("HDEL", "{path}.merkle", ARGV[i])
+        else
+            redis.call("HSET", "{path}.merkle", ARGV[i], ARGV[i + 1])
+        end
+    end
+    for i=1, table.getn(KEYS), 2 do
+        -- buckets modified since they were read stay dirty
+        if redis.call("HGET", "{path}.dirty", KEYS[i]) == KEYS[i + 1] then
+            redis.call("HDEL", "{path}.dirty", KEYS[i])
+        end
+    end
+"""
+def get_merkle_commit(r, path):
+    # KEYS are pairs of (bucket, generation) that were read, ARGV are pairs of (node_id, node_hash)
+    return make_script(r, _merkle_commit, path)
+
+
+#
+# Inventory
+#
+
+_inventory_add = """
+    for i=1, #KEYS do
+        local range = ARGV[2 * i - 1]
+        if redis.call("SADD", "{path}." .. range, KEYS[i]) == 1 then
+            redis.call("HINCRBY", "{path}.n", range, 1)
+            redis.call("HINCRBY", "{path}.s", range, ARGV[2 * i])
+        end
+    end
+"""
+def get_inventory_add(r, path):
+    # KEYS are block hashes, ARGV pairs of (range, the block hash's digest part) for each
+    return make_script(r, _inventory_add, path)
+
 
 #
 # Orphanage
@@ -119,21 +307,58 @@ def get_orphanage_linking_to(r, path):
     # KEYS[1] is the block_hash of a block linked to by orphans. A set of orphan hashes is returned
     return make_orphanage_script(r, _orphanage_linking_to, path)
 
+# Get the orphan subtree
+_orphanage_subtree = """
+    return orph_subtree("{path}", KEYS[1])
+"""
+def get_orphanage_subtree(r, path):
+    # KEYS[1] is a block_hash. Serialized orphans descending from it are returned, parents before children
+    return make_orphanage_script(r, _orphanage_subtree, path)
+
 _orphanage_add = """
-    return orph_add("{path}", KEYS[1], KEYS[2], KEYS[3])
+    return orph_add("{path}", KEYS[1], KEYS[2], KEYS[3], ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4]),
+                    tonumber(ARGV[5]), tonumber(ARGV[6]))
 """
 def get_orphanage_add(r, path):
     # KEYS[1,2,3] are block, block_hash, linked_block_hash respectively
+    # ARGV is total_work, now, peer ("" for none), max_count, max_bytes, peer_quota
     return make_orphanage_script(r, _orphanage_add, path)
 
 
 _orphanage_remove = """
-    return orph_remove("{path}", KEYS[1], KEYS[2])
+    return orph_remove("{path}", KEYS[1], KEYS[2], false)
 """
 def get_orphanage_remove(r, path):
     # KEYS[1] is the block_hash, KEYS[2] : linked_block_hash
     return make_orphanage_script(r, _orphanage_remove, path)
 
+_orphanage_sweep = """
+    local expired = orph_expire("{path}", ARGV[1])
+    return {{expired, orph_rebuild_components("{path}")}}
+"""
+def get_orphanage_sweep(r, path):
+    # orphans that arrived before ARGV[1] are removed. Components are then relabelled.
+    # Returns {expired, components}
+    return make_orphanage_script(r, _orphanage_sweep, path)
+
+_orphanage_adopt = """
+    return orph_adopt_untracked("{path}", ARGV[1])
+"""
+def get_orphanage_adopt(r, path):
+    # ARGV[1] is now. Returns the number of orphans adopted
+    return make_orphanage_script(r, _orphanage_adopt, path)
+
+_orphanage_clean_rev = """
+    local removed = 0
+    for i=1, #KEYS do
+        removed = removed + orph_clean_rev("{path}", KEYS[i])
+    end
+    return removed
+"""
+def get_orphanage_clean_rev(r, path):
+    # KEYS are block hashes orphans link (or linked) to
+    return make_orphanage_script(r, _orphanage_clean_rev, path)
+
 
 #
 # Primary Chain
@@ -156,14 +381,130 @@ _primary_chain_get_all = """
 def get_primary_chain_get_all(r, path):
     return make_primary_chain_script(r, _primary_chain_get_all, path)
 
+_primary_chain_get_many = """
+    return chain_get_many("{path}", ARGV)
+"""
+def get_primary_chain_get_many(r, path):
+    # ARGV are heights, a hash (or nil) is returned for each
+    return make_primary_chain_script(r, _primary_chain_get_many, path)
+
+_primary_chain_contains_many = """
+    return chain_contains_many("{path}", KEYS)
+"""
+def get_primary_chain_contains_many(r, path):
+    # KEYS are block hashes, a 1 or 0 is returned for each
+    return make_primary_chain_script(r, _primary_chain_contains_many, path)
+
+_primary_chain_get_range = """
+    return chain_get_range("{path}", tonumber(ARGV[1]), tonumber(ARGV[2]))
+"""
+def get_primary_chain_get_range(r, path):
+    # ARGV[1] and ARGV[2] are the start (inclusive) and stop (exclusive) heights
+    return make_primary_chain_script(r, _primary_chain_get_range, path)
+
+_primary_chain_index = """
+    return chain_index("{path}", tonumber(KEYS[1]), ARGV)
+"""
+def get_primary_chain_index(r, path):
+    # KEYS[1] is the height to start at, ARGV the total works of the blocks from there
+    return make_primary_chain_script(r, _primary_chain_index, path)
+
 _primary_chain_append = """
-    return chain_append("{path}", KEYS)
+    return chain_append("{path}", KEYS, ARGV)
 """
 def get_primary_chain_append(r, path):
+    # KEYS are block hashes, ARGV their total works
     return make_primary_chain_script(r, _primary_chain_append, path)
 
 _primary_chain_remove = """
     return chain_remove("{path}", KEYS)
 """
 def get_primary_chain_remove(r, path):
-    return make_primary_chain_script(r, _primary_chain_remove, path)
\ No newline at end of file
+    return make_primary_chain_script(r, _primary_chain_remove, path)
+
+
+#
+# Reorganisation
+#
+
+_reorg_commit = """
+    local n_accounts = tonumber(ARGV[1])
+    local n_journals = tonumber(ARGV[2])
+    local n_removed = tonumber(ARGV[3])
+    local n_appended = tonumber(ARGV[4])
+    local offset = 5
+    local i
+    local j
+
+    -- check everything before writing anything, a failed script isn't rolled back
+    for i=1, n_accounts do
+        assert(get_balance("{state_path}", KEYS[i]) + ARGV[offset + i] >= 0, "Cannot allow negative balance")
+    end
+
+    for i=1, n_accounts do
+        for j=1, n_journals do
+            journal_record("{state_path}", ARGV[offset + 2 * n_accounts + j], KEYS[i], ARGV[offset + n_accounts + i])
+        end
+        mod_balance("{state_path}", KEYS[i], ARGV[offset + i], ARGV[offset + n_accounts + i])
+    end
+    offset = offset + 2 * n_accounts + n_journals
+
+    local removed = {{}}
+    for i=1, n_removed do
+        table.insert(removed, ARGV[offset + i])
+    end
+    chain_remove("{chain_path}", removed)
+    offset = offset + n_removed
+
+    local appended = {{}}
+    local total_works = {{}}
+    for i=1, n_appended do
+        table.insert(appended, ARGV[offset + i])
+        table.insert(total_works, ARGV[offset + n_appended + i])
+    end
+    chain_append("{chain_path}", appended, total_works)
+
+    redis.call("SET", "{top_block_key}", ARGV[5])
+"""
+def get_reorg_commit(r, state_path, chain_path, top_block_key):
+    # KEYS are pub_xs. ARGV is n_accounts, n_journals, n_removed, n_appended, top block hash, then the balance
+    # changes, merkle buckets, journal paths, removed hashes, appended hashes and appended total works
+    return r.register_script(_functions + _primary_chain_functions + _reorg_commit.format(
+        state_path=state_path, chain_path=chain_path, top_block_key=top_block_key))
+
+
+#
+# Ancestor Index
+#
+
+_ancestors_functions = load_lua_file('ancestors.lua')
+
+make_ancestors_script = make_script_maker_with_functions(_ancestors_functions)
+
+_ancestors_add = """
+    return anc_add("{path}", KEYS[1], ARGV[1])
+"""
+def get_ancestors_add(r, path):
+    # KEYS[1] is the block hash, ARGV[1] the parent's hash (empty for a root)
+    return make_ancestors_script(r, _ancestors_add, path)
+
+_ancestors_at_height = """
+    return anc_at_height("{path}", KEYS[1], tonumber(ARGV[1]))
+"""
+def get_ancestors_at_height(r, path):
+    # KEYS[1] is the block hash, ARGV[1] the height of the ancestor
+    return make_ancestors_script(r, _ancestors_at_height, path)
+
+_ancestors_common = """
+    return anc_common("{path}", KEYS[1], KEYS[2])
+"""
+def get_ancestors_common(r, path):
+    # KEYS[1] and KEYS[2] are block hashes
+    return make_ancestors_script(r, _ancestors_common, path)
+
+_ancestors_path = """
+    return anc_path("{path}", KEYS[1], KEYS[2])
+"""
+def get_ancestors_path(r, path):
+    # KEYS[1] is the early block hash, KEYS[2] the late block hash
+    return make_ancestors_script(r, _ancestors_path, path)
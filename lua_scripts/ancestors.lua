@@ -0,0 +1,115 @@
+--[[
+  LUA Scripts for data structures.
+  Used to create high speed complex structures in redis.
+  Debugging Instructions: http://www.trikoder.net/blog/make-lua-debugging-easier-in-redis-87/
+]]
+
+
+--[[ INTERNAL ORGANISATION ]]
+
+--[[ path augmentations for datastructs ]]
+
+local _pointers = ".p"  -- hash map of block_hash:k -> the ancestor 2^k generations back
+local _heights = ".h"  -- hash map of block_hash -> height
+
+--[[ generators for those paths ]]
+
+local gen_pointers_path = function (path)
+  return path .. _pointers
+end
+
+local gen_heights_path = function (path)
+  return path .. _heights
+end
+
+local gen_pointer_key = function (block_hash, k)
+  return block_hash .. ":" .. k
+end
+
+--[[ FUNCTIONS FOR SUPPORTED OPERATIONS ]]
+
+--[[ Lookups ]]
+
+local anc_height = function (path, block_hash)
+  local height = redis.call("HGET", gen_heights_path(path), block_hash)
+  assert(height, "Block not in ancestor index")
+  return tonumber(height)
+end
+
+local anc_pointer = function (path, block_hash, k)
+  return redis.call("HGET", gen_pointers_path(path), gen_pointer_key(block_hash, k))
+end
+
+local anc_at_height = function (path, block_hash, height)
+  local distance = anc_height(path, block_hash) - height
+  if distance < 0 then
+    return false
+  end
+  local k = 0
+  while distance > 0 do
+    if distance % 2 == 1 then
+      block_hash = anc_pointer(path, block_hash, k)
+    end
+    distance = math.floor(distance / 2)
+    k = k + 1
+  end
+  return block_hash
+end
+
+local anc_common = function (path, a, b)
+  local height_a = anc_height(path, a)
+  local height_b = anc_height(path, b)
+  if height_a > height_b then
+    a = anc_at_height(path, a, height_b)
+  else
+    b = anc_at_height(path, b, height_a)
+  end
+  if a == b then
+    return a
+  end
+  local k = 0
+  while anc_pointer(path, a, k + 1) do
+    k = k + 1
+  end
+  while k >= 0 do
+    local next_a = anc_pointer(path, a, k)
+    local next_b = anc_pointer(path, b, k)
+    if next_a and next_a ~= next_b then
+      a = next_a
+      b = next_b
+    end
+    k = k - 1
+  end
+  return anc_pointer(path, a, 0)
+end
+
+local anc_path = function (path, early_hash, late_hash)
+  -- hashes after early_hash up to and including late_hash, oldest first
+  local n = anc_height(path, late_hash) - anc_height(path, early_hash)
+  local result = {}
+  local block_hash = late_hash
+  local i
+  for i = n, 1, -1 do
+    result[i] = block_hash
+    block_hash = anc_pointer(path, block_hash, 0)
+  end
+  assert(block_hash == early_hash, "Early block is not an ancestor of late block")
+  return result
+end
+
+--[[ Modification ]]
+
+local anc_add = function (path, block_hash, parent_hash)
+  if parent_hash == "" then
+    redis.call("HSET", gen_heights_path(path), block_hash, 0)
+    return
+  end
+  redis.call("HSET", gen_heights_path(path), block_hash, anc_height(path, parent_hash) + 1)
+  local k = 0
+  local ancestor = parent_hash
+  while ancestor do
+    redis.call("HSET", gen_pointers_path(path), gen_pointer_key(block_hash, k), ancestor)
+    ancestor = anc_pointer(path, ancestor, k)
+    k = k + 1
+  end
+end
@@ -13,6 +13,16 @@ local _set = ".s"  -- set of orphan hashes
 local _orph_map = ".m"  -- map of orphan hashes to serialized blocks
 local _rev_map = ".r"  -- hash map of pointers to sets for reverse block links
 local _rev_key_suffix = ".orph_rev"  -- suffix for above pointer
+local _work = ".w"  -- sorted set of orphan hashes by total work
+local _arrival = ".t"  -- sorted set of orphan hashes by arrival time
+local _size = ".b"  -- map of orphan hashes to serialized size
+local _bytes = ".bytes"  -- total serialized size of orphans
+local _parent = ".l"  -- map of orphan hashes to the block they link to
+local _peer = ".p"  -- map of orphan hashes to the peer they came from
+local _peer_count = ".pc"  -- map of peers to how many orphans they've given us
+local _component = ".c"  -- map of orphan hashes to a label for their component (see orph_find)
+local _redirect = ".u"  -- map of labels to the label that replaced them, when components merged
+local _needs = ".need"  -- sorted set of missing ancestors (component labels) by the total work of their tip
 
 --[[ generators for those paths ]]
 
@@ -32,8 +42,78 @@ local gen_rev_key_path = function (path, block_hash)
   return path .. block_hash .. _rev_key_suffix
 end
 
+local gen_path = function (path, suffix)
+  return path .. suffix
+end
+
 --[[ FUNCTIONS FOR SUPPORTED OPERATIONS ]]
 
+--[[ Components
+
+  Orphans that link to each other form components, each hanging off one block we don't have: its deepest missing
+  ancestor, which labels the component. When an orphan arrives that a component needs, that component joins the
+  new orphan's and its label redirects to the new one (union-find, with path compression in orph_find).
+]]
+
+local orph_find = function (path, label)
+  local root = label
+  local next_label = redis.call("HGET", gen_path(path, _redirect), root)
+  while next_label do
+    root = next_label
+    next_label = redis.call("HGET", gen_path(path, _redirect), root)
+  end
+  while label ~= root do
+    next_label = redis.call("HGET", gen_path(path, _redirect), label)
+    redis.call("HSET", gen_path(path, _redirect), label, root)
+    label = next_label
+  end
+  return root
+end
+
+local orph_raise_need = function (path, label, total_work)
+  local current = redis.call("ZSCORE", gen_path(path, _needs), label)
+  if not current or tonumber(current) < tonumber(total_work) then
+    redis.call("ZADD", gen_path(path, _needs), total_work, label)
+  end
+end
+
+local orph_join_component = function (path, block_hash, linked_block_hash, total_work)
+  local label = linked_block_hash
+  if redis.call("SISMEMBER", gen_set_path(path), linked_block_hash) == 1 then
+    label = orph_find(path, redis.call("HGET", gen_path(path, _component), linked_block_hash) or linked_block_hash)
+  end
+  redis.call("HSET", gen_path(path, _component), block_hash, label)
+  local waiting = redis.call("ZSCORE", gen_path(path, _needs), block_hash)
+  if waiting then
+    -- this orphan is what a component was missing, so that component is now part of this one
+    redis.call("ZREM", gen_path(path, _needs), block_hash)
+    redis.call("HSET", gen_path(path, _redirect), block_hash, label)
+    orph_raise_need(path, label, waiting)
+  end
+  orph_raise_need(path, label, total_work)
+end
+
+--[[ orphans below block_hash (which is leaving) start a component of their own, needing it ]]
+local orph_split_component = function (path, block_hash, label)
+  local tip_work = redis.call("ZSCORE", gen_path(path, _needs), orph_find(path, label)) or 0  -- an upper bound
+  redis.call("HDEL", gen_path(path, _redirect), block_hash)
+  local frontier = {block_hash}
+  local i = 1
+  while i <= #frontier do
+    local children = redis.call("SMEMBERS", gen_rev_key_path(path, frontier[i]))
+    for j=1, #children do
+      if redis.call("SISMEMBER", gen_set_path(path), children[j]) == 1 then
+        table.insert(frontier, children[j])
+        redis.call("HSET", gen_path(path, _component), children[j], block_hash)
+      end
+    end
+    i = i + 1
+  end
+  if #frontier > 1 then
+    redis.call("ZADD", gen_path(path, _needs), tip_work, block_hash)
+  end
+end
+
 --[[ Lookups ]]
 
 local orph_contains = function (path, block_hash)
@@ -49,20 +129,184 @@ local orphs_linking_to = function(path, block_hash)
   return redis.call("SMEMBERS", gen_rev_key_path(path, block_hash))
 end
 
+--[[ serialized orphans descending from block_hash (not included), parents before children ]]
+local orph_subtree = function(path, block_hash)
+  local subtree = {}
+  local frontier = {block_hash}
+  local i = 1
+  while i <= #frontier do
+    local children = redis.call("SMEMBERS", gen_rev_key_path(path, frontier[i]))
+    for j=1, #children do
+      local block = redis.call("HGET", gen_orph_map_path(path), children[j])
+      if block then
+        table.insert(frontier, children[j])
+        table.insert(subtree, block)
+      end
+    end
+    i = i + 1
+  end
+  return subtree
+end
+
 --[[ Modification ]]
 
-local orph_add = function (path, block, block_hash, linked_block_hash)
+--[[ detach is true when block_hash is being dropped rather than connected; orphans below it then need it ]]
+local orph_remove = function (path, block_hash, linked_block_hash, detach)
+  --[[ linked_block_hash is only a fallback for orphans added before their parent was recorded ]]
+  linked_block_hash = redis.call("HGET", gen_path(path, _parent), block_hash) or linked_block_hash
+  local label = redis.call("HGET", gen_path(path, _component), block_hash)
+  if redis.call("SREM", gen_set_path(path), block_hash) == 1 then
+    if detach and label then
+      orph_split_component(path, block_hash, label)
+    end
+    local peer = redis.call("HGET", gen_path(path, _peer), block_hash)
+    if peer and tonumber(redis.call("HINCRBY", gen_path(path, _peer_count), peer, -1)) <= 0 then
+      redis.call("HDEL", gen_path(path, _peer_count), peer)
+    end
+    redis.call("DECRBY", gen_path(path, _bytes), redis.call("HGET", gen_path(path, _size), block_hash) or 0)
+  end
+  redis.call("HDEL", gen_orph_map_path(path), block_hash)
+  redis.call("ZREM", gen_path(path, _work), block_hash)
+  redis.call("ZREM", gen_path(path, _arrival), block_hash)
+  redis.call("HDEL", gen_path(path, _size), block_hash)
+  redis.call("HDEL", gen_path(path, _parent), block_hash)
+  redis.call("HDEL", gen_path(path, _peer), block_hash)
+  redis.call("HDEL", gen_path(path, _component), block_hash)
+  redis.call("SREM", gen_rev_key_path(path, linked_block_hash), block_hash)
+  if redis.call("EXISTS", gen_rev_key_path(path, linked_block_hash)) == 0 then
+    redis.call("HDEL", gen_rev_map_path(path), linked_block_hash)
+    redis.call("ZREM", gen_path(path, _needs), linked_block_hash)  -- nothing is waiting on it any more
+  end
+end
+
+--[[ the orphan with the least total work, the oldest of those if there's a tie ]]
+local orph_least_valuable = function (path)
+  local lowest = redis.call("ZRANGE", gen_path(path, _work), 0, 0, "WITHSCORES")
+  if #lowest == 0 then
+    return nil
+  end
+  local tied = redis.call("ZRANGEBYSCORE", gen_path(path, _work), lowest[2], lowest[2])
+  local chosen, chosen_time = nil, nil
+  for i=1, #tied do
+    local t = tonumber(redis.call("ZSCORE", gen_path(path, _arrival), tied[i]) or 0)
+    if chosen == nil or t < chosen_time then
+      chosen, chosen_time = tied[i], t
+    end
+  end
+  return chosen
+end
+
+local orph_over_limits = function (path, max_count, max_bytes)
+  return redis.call("SCARD", gen_set_path(path)) > max_count
+      or tonumber(redis.call("GET", gen_path(path, _bytes)) or 0) > max_bytes
+end
+
+--[[ returns -1 if the peer is over its quota, otherwise the number of orphans evicted (which may include this one) ]]
+local orph_add = function (path, block, block_hash, linked_block_hash, total_work, now, peer, max_count, max_bytes,
+                           peer_quota)
+  if redis.call("SISMEMBER", gen_set_path(path), block_hash) == 1 then
+    return 0
+  end
+  if peer ~= "" then
+    if tonumber(redis.call("HGET", gen_path(path, _peer_count), peer) or 0) >= peer_quota then
+      return -1
+    end
+    redis.call("HSET", gen_path(path, _peer), block_hash, peer)
+    redis.call("HINCRBY", gen_path(path, _peer_count), peer, 1)
+  end
   redis.call("SADD", gen_set_path(path), block_hash)
   redis.call("HSET", gen_orph_map_path(path), block_hash, block)
   redis.call("HSET", gen_rev_map_path(path), linked_block_hash, gen_rev_key_path(path, linked_block_hash))
   redis.call("SADD", gen_rev_key_path(path, linked_block_hash), block_hash)
+  redis.call("HSET", gen_path(path, _parent), block_hash, linked_block_hash)
+  redis.call("ZADD", gen_path(path, _work), total_work, block_hash)
+  redis.call("ZADD", gen_path(path, _arrival), now, block_hash)
+  redis.call("HSET", gen_path(path, _size), block_hash, string.len(block))
+  redis.call("INCRBY", gen_path(path, _bytes), string.len(block))
+  orph_join_component(path, block_hash, linked_block_hash, total_work)
+
+  local evicted = 0
+  while orph_over_limits(path, max_count, max_bytes) do
+    orph_remove(path, orph_least_valuable(path), "", true)
+    evicted = evicted + 1
+  end
+  return evicted
 end
 
-local orph_remove = function (path, block_hash, linked_block_hash)
-  redis.call("SREM", gen_set_path(path), block_hash)
-  redis.call("HDEL", gen_orph_map_path(path), block_hash)
-  redis.call("SREM", gen_rev_key_path(path, linked_block_hash), block_hash)
-  if redis.call("EXISTS", gen_rev_key_path(path, linked_block_hash)) == 0 then
-    redis.call("HDEL", gen_rev_map_path(path), linked_block_hash, gen_rev_key_path(path, linked_block_hash))
+--[[ Upkeep ]]
+
+--[[ removes orphans that arrived before a time, returns how many ]]
+local orph_expire = function (path, before)
+  local expired = redis.call("ZRANGEBYSCORE", gen_path(path, _arrival), "-inf", "(" .. before)
+  for i=1, #expired do
+    orph_remove(path, expired[i], "", true)
   end
-end
\ No newline at end of file
+  return #expired
+end
+
+--[[ orphans from before arrivals and work were recorded are treated as arriving now, with no work ]]
+local orph_adopt_untracked = function (path, now)
+  local adopted = 0
+  local members = redis.call("SMEMBERS", gen_set_path(path))
+  for i=1, #members do
+    if not redis.call("ZSCORE", gen_path(path, _arrival), members[i]) then
+      local size = redis.call("HSTRLEN", gen_orph_map_path(path), members[i])
+      redis.call("ZADD", gen_path(path, _arrival), now, members[i])
+      redis.call("ZADD", gen_path(path, _work), 0, members[i])
+      redis.call("HSET", gen_path(path, _size), members[i], size)
+      redis.call("INCRBY", gen_path(path, _bytes), size)
+      adopted = adopted + 1
+    end
+  end
+  return adopted
+end
+
+--[[ drops members of a reverse link set that are no longer orphans, and the set's pointer if it's empty ]]
+local orph_clean_rev = function (path, linked_block_hash)
+  local rev_key = gen_rev_key_path(path, linked_block_hash)
+  local members = redis.call("SMEMBERS", rev_key)
+  local removed = 0
+  for i=1, #members do
+    if redis.call("SISMEMBER", gen_set_path(path), members[i]) == 0 then
+      redis.call("SREM", rev_key, members[i])
+      removed = removed + 1
+    end
+  end
+  if redis.call("EXISTS", rev_key) == 0 then
+    redis.call("HDEL", gen_rev_map_path(path), linked_block_hash)
+  end
+  return removed
+end
+
+--[[ relabels every component from scratch, dropping redirects and stale needs; returns the number of components ]]
+local orph_rebuild_components = function (path)
+  redis.call("DEL", gen_path(path, _component), gen_path(path, _redirect), gen_path(path, _needs))
+  local linked = redis.call("HKEYS", gen_rev_map_path(path))
+  local components = 0
+  for i=1, #linked do
+    if redis.call("SISMEMBER", gen_set_path(path), linked[i]) == 0 then
+      local tip_work = nil
+      local frontier = {linked[i]}
+      local j = 1
+      while j <= #frontier do
+        local children = redis.call("SMEMBERS", gen_rev_key_path(path, frontier[j]))
+        for k=1, #children do
+          if redis.call("SISMEMBER", gen_set_path(path), children[k]) == 1 then
+            table.insert(frontier, children[k])
+            redis.call("HSET", gen_path(path, _component), children[k], linked[i])
+            local work = tonumber(redis.call("ZSCORE", gen_path(path, _work), children[k]) or 0)
+            if tip_work == nil or work > tip_work then
+              tip_work = work
+            end
+          end
+        end
+        j = j + 1
+      end
+      if tip_work ~= nil then
+        redis.call("ZADD", gen_path(path, _needs), tip_work, linked[i])
+        components = components + 1
+      end
+    end
+  end
+  return components
+end
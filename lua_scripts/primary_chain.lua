@@ -10,7 +10,9 @@
 --[[ path augmentations for datastructs ]]
 
 local _set = ".s"  -- set of orphan hashes
-local _list = ".l"  -- map of orphan hashes to serialized blocks
+local _list = ".l"  -- list of block hashes, indexed by height
+local _heights = ".h"  -- hash map of height -> block hash
+local _works = ".w"  -- hash map of height -> total work of the block
 
 --[[ generators for those paths ]]
 
@@ -22,6 +24,14 @@ local gen_list_path = function (path)
   return path .. _list
 end
 
+local gen_heights_path = function (path)
+  return path .. _heights
+end
+
+local gen_works_path = function (path)
+  return path .. _works
+end
+
 --[[ FUNCTIONS FOR SUPPORTED OPERATIONS ]]
 
 --[[ Lookups ]]
@@ -34,12 +44,49 @@ local chain_get_all = function (path)
     return redis.call("LRANGE", gen_list_path(path), 0, -1)
 end
 
+local chain_get_many = function (path, heights)
+  local result = {}
+  for i, height in ipairs(heights) do
+    table.insert(result, redis.call("HGET", gen_heights_path(path), height))
+  end
+  return result
+end
+
+local chain_contains_many = function (path, block_hashes)
+  local result = {}
+  for i, hash in ipairs(block_hashes) do
+    table.insert(result, redis.call("SISMEMBER", gen_set_path(path), hash))
+  end
+  return result
+end
+
+local chain_get_range = function (path, start, stop)
+  -- heights start (inclusive) to stop (exclusive), returns {hashes, total_works}
+  local hashes = redis.call("LRANGE", gen_list_path(path), start, stop - 1)
+  local works = {}
+  for i, hash in ipairs(hashes) do
+    table.insert(works, redis.call("HGET", gen_works_path(path), start + i - 1) or "0")
+  end
+  return {hashes, works}
+end
+
 --[[ Modification ]]
 
-local chain_append = function (path, block_hashes)
+local chain_append = function (path, block_hashes, total_works)
   for i, hash in ipairs(block_hashes) do
+      local height = redis.call("RPUSH", gen_list_path(path), hash) - 1
       redis.call("SADD", gen_set_path(path), hash)
-      redis.call("RPUSH", gen_list_path(path), hash)
+      redis.call("HSET", gen_heights_path(path), height, hash)
+      redis.call("HSET", gen_works_path(path), height, total_works[i] or 0)
+  end
+end
+
+--[[ fills in heights and total works for a run of the list, for chains stored before they were kept ]]
+local chain_index = function (path, start, total_works)
+  local hashes = redis.call("LRANGE", gen_list_path(path), start, start + #total_works - 1)
+  for i, hash in ipairs(hashes) do
+      redis.call("HSET", gen_heights_path(path), start + i - 1, hash)
+      redis.call("HSET", gen_works_path(path), start + i - 1, total_works[i])
   end
 end
 
@@ -47,5 +94,8 @@ local chain_remove = function (path, block_hashes)
   for i, hash in ipairs(block_hashes) do
       redis.call("SREM", gen_set_path(path), hash)
       redis.call("RPOP", gen_list_path(path))
+      local height = redis.call("LLEN", gen_list_path(path))
+      redis.call("HDEL", gen_heights_path(path), height)
+      redis.call("HDEL", gen_works_path(path), height)
   end
 end
\ No newline at end of file
@@ -1,6 +1,12 @@
+import asyncio, time
+
 from WSSTT import Network
 
 from structs import *
+from helpers import LRUCache
+from ingestor import BlockIngestor
+from header_sync import HeaderSync, MAX_HEADERS
+from snapshot_sync import SnapshotSync
 
 
 """ Message Protocol:
@@ -14,17 +20,42 @@ CHAIN_PRIMARY (chunk_size: int, n: int -> [h: Hash, ..]) requests the segment of
 chunk_size and the nth such chunk. Some (1, or 10, or w/e) hashes before this chunk should be included to help
 sync overlapping sections of the main chain. Less hashes will be provided than chunk_size if it is appropriate.
 
+HEADERS_REQUEST (block_locator: [Hash], max_headers: int -> blocks: Bytes) requests headers of the primary chain
+following the first hash in the locator that's on it, at most max_headers of them. A block's hash covers the whole
+block, so each header is carried as its block (as in BLOCK_PROVIDE), which is what lets the requester recompute the
+hash and check its work. This is headers-first sync: the headers are validated as a chain (see HeaderSync) and the
+blocks are then applied strictly in that order. Headers are decoded (and their signatures checked) in the verifier's
+pool, and once a full HEADERS_PROVIDE has been added a request for the next headers is farmed out. A peer that sends
+headers that don't decode or verify is ignored for PENALTY_TIME. A node that started from a state snapshot has no
+blocks before it, and serves none.
+
 BLOCK_REQUEST ([h: Hash, ..] -> [b: Block, ..])  A list of hashes is provided; a list of blocks is returned. The
 absence of a block belonging to a hash (in the reply) is not evidence the block does not exist, a node may return
 fewer blocks than the provided hashes requests. If a block is not found no special indication is given. (A node can
-check the inventory if they wish.)
-
-INV_REQUEST (-> [h: Hash, ..]) Return hashes of items in inventory.
+check the inventory if they wish.) A BLOCK_PROVIDE may be answered with the next BLOCK_REQUEST, so a peer that's
+serving blocks is kept busy (see Seeker).
+
+INV_REQUEST (digests: Bytes, start: int -> [h: Hash, ..]) Return hashes of blocks in inventory the requester
+doesn't have. The requester sends a digest of each height range of the blocks it has (see database.InventoryIndex),
+as (range: 4 bytes, count: 4 bytes, sum: 8 bytes) records end to end, base64'd. Hashes are returned from the ranges
+(from start) whose digests differ, lowest first, at most INV_MAX_HASHES of them, so the reply scales with the
+difference between the two nodes. A node that started from a state snapshot starts after it (see
+Chain.inventory_start). Nodes ask each peer now and then (see control_loops) and request what they turn out not to
+have.
  todo: segregate txs, blocks, etc
- todo: use bloom filters instead of list
 
 
+SNAPSHOT_INFO (-> height: int, n_chunks: int, block: Bytes) requests the latest state snapshot a node can serve: its
+height, how many chunks it's in and its block (binary encoding, base64'd; absent, with 0 chunks, if there's none).
+
+SNAPSHOT_CHUNK (block_hash: Hash, index: int -> block_hash, index, accounts: Bytes) requests a chunk of the snapshot at
+block_hash. Accounts are (pub_x, balance) records end to end (see accounts_to_bytes), ordered by pub_x across the
+chunks, base64'd; none are returned if the node doesn't have the chunk. The whole snapshot must hash (see
+StateMerkleTree.root_of) to the block's state_hash. A SNAPSHOT_CHUNK_PROVIDE may be answered with the next request.
+
 BLOCK_ANNOUNCE (b: Block ->) Push a block to a node.
+
+Blocks in BLOCK_PROVIDE and BLOCK_ANNOUNCE are carried in their binary encoding (see SimpleBlock.to_bytes), base64'd.
 """
 
 BLOCK_ANNOUNCE          = 'block_announce'
@@ -36,24 +67,118 @@ BLOCK_REQUEST           = 'block_request'
 BLOCK_PROVIDE           = 'block_provide'
 INV_REQUEST             = 'inv_request'
 INV_PROVIDE             = 'inv_provide'
+HEADERS_REQUEST         = 'headers_request'
+HEADERS_PROVIDE         = 'headers_provide'
+SNAPSHOT_INFO           = 'snapshot_info'
+SNAPSHOT_INFO_PROVIDE   = 'snapshot_info_provide'
+SNAPSHOT_CHUNK          = 'snapshot_chunk'
+SNAPSHOT_CHUNK_PROVIDE  = 'snapshot_chunk_provide'
+
+PENALTY_TIME = 600  # seconds a peer that sent us invalid headers is ignored for
+RELAYED_CACHE_SIZE = 10000  # hashes of announced blocks we've relayed, so each is relayed once
 
 # Message Containers
 
 class BlockAnnounce(Encodium):
-    block = SimpleBlock.Definition()
+    payload = BinaryPayload.Definition()
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(payload=BinaryPayload.encode(block.to_bytes()))
+
+    @property
+    def block(self):
+        return SimpleBlock.from_bytes(BinaryPayload.decode(self.payload))
 
 class BlockRequest(Encodium):
     hashes = List.Definition(Hash.Definition())  # blocks we're requesting
 
 class BlockProvide(Encodium):
-    blocks = List.Definition(SimpleBlock.Definition())
+    payload = BinaryPayload.Definition()
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        return cls(payload=BinaryPayload.encode(blocks_to_bytes(blocks)))
+
+    @property
+    def blocks(self):
+        return blocks_from_bytes(BinaryPayload.decode(self.payload))
+
+INV_DIGEST_RECORD_SIZE = 16
 
 class InvRequest(Encodium):
-    pass
+    digests = BinaryPayload.Definition()  # of the requester's blocks, by height range
+    start = Integer8Bytes.Definition()  # the first range the requester wants blocks in
+
+    @classmethod
+    def from_digests(cls, digests, start):
+        """ :param digests: {range: (count, sum)}, see Chain.inventory_digests """
+        return cls(start=start, digests=BinaryPayload.encode(b''.join(
+            r.to_bytes(4, 'big') + n.to_bytes(4, 'big') + s.to_bytes(8, 'big')
+            for r, (n, s) in sorted(digests.items()) if r >= start)))
+
+    @property
+    def range_digests(self):
+        data = BinaryPayload.decode(self.digests)
+        if len(data) % INV_DIGEST_RECORD_SIZE != 0:
+            raise ValueError('Inventory digests must be %d bytes each' % INV_DIGEST_RECORD_SIZE)
+        return {int.from_bytes(data[i:i + 4], 'big'):
+                    (int.from_bytes(data[i + 4:i + 8], 'big'), int.from_bytes(data[i + 8:i + 16], 'big'))
+                for i in range(0, len(data), INV_DIGEST_RECORD_SIZE)}
 
 class InvProvide(Encodium):
     inv_list = List.Definition(Hash.Definition())
 
+class HeadersRequest(Encodium):
+    block_locator = List.Definition(Hash.Definition())
+    max_headers = Integer8Bytes.Definition()
+
+class HeadersProvide(Encodium):
+    payload = BinaryPayload.Definition()  # the headers' blocks
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        return cls(payload=BinaryPayload.encode(blocks_to_bytes(blocks)))
+
+    @property
+    def encoded_blocks(self):
+        return split_blocks_bytes(BinaryPayload.decode(self.payload))
+
+class SnapshotInfoRequest(Encodium):
+    pass
+
+class SnapshotInfoProvide(Encodium):
+    height = Integer8Bytes.Definition()
+    n_chunks = Integer8Bytes.Definition()
+    payload = BinaryPayload.Definition(optional=True)  # the snapshot's block
+
+    @classmethod
+    def from_snapshot(cls, height, block, n_chunks):
+        return cls(height=height, n_chunks=n_chunks, payload=BinaryPayload.encode(block.to_bytes()))
+
+    @property
+    def block(self):
+        if self.payload is None:
+            return None
+        return SimpleBlock.from_bytes(BinaryPayload.decode(self.payload))
+
+class SnapshotChunkRequest(Encodium):
+    block_hash = Hash.Definition()
+    index = Integer8Bytes.Definition()
+
+class SnapshotChunkProvide(Encodium):
+    block_hash = Hash.Definition()
+    index = Integer8Bytes.Definition()
+    payload = BinaryPayload.Definition()
+
+    @classmethod
+    def from_chunk(cls, block_hash, index, chunk):
+        return cls(block_hash=block_hash, index=index, payload=BinaryPayload.encode(chunk))
+
+    @property
+    def accounts(self):
+        return BinaryPayload.decode(self.payload)
+
 class ChainInfoRequest(Encodium):
     pass
 
@@ -73,85 +198,227 @@ class ChainPrimaryProvide(Encodium):
     chunk_size = Integer8Bytes.Definition()
 
 
-def set_message_handlers(chain, p2p: Network):
+def set_message_handlers(chain, p2p: Network, ingestor: BlockIngestor=None, headers_first=True, snapshot_sync=False):
+    # handlers never add blocks themselves, so the loop keeps serving queries while blocks are applied
+    skeleton = HeaderSync(chain)
+    ingestor = BlockIngestor(chain, skeleton=skeleton) if ingestor is None else ingestor
+    ingestor.start()
+    chain.seeker.set_backpressure(lambda: ingestor.full)
+    chain.seeker.set_held(skeleton.holds)
+
+    def fetch_bodies_above(height):
+        chain.seek_blocks_with_total_work([(h.total_work, h.hash) for h in skeleton.pending() if h.height > height])
+
+    # a fresh node may start from a peer's state snapshot, found through the skeleton, rather than the root
+    snapshots = SnapshotSync(chain, skeleton, ingestor, fetch_bodies_above) if snapshot_sync and headers_first else None
+
+    penalised = {}  # peer -> when it last sent us something invalid
+
+    def penalise(peer, reason):
+        print('Penalising peer:', reason)
+        penalised[peer] = time.time()
+
+    def is_penalised(peer):
+        if peer in penalised and time.time() - penalised[peer] > PENALTY_TIME:
+            del penalised[peer]
+        return peer in penalised
+
+    def next_chunk_request(peer):
+        index = snapshots.request_for(peer)
+        if index is not None:
+            return SnapshotChunkRequest(block_hash=snapshots.target_hash, index=index)
+
+    relayed = LRUCache(RELAYED_CACHE_SIZE)
 
     @p2p.method(BlockAnnounce, BLOCK_ANNOUNCE, CHAIN_INFO)
     def block_announce(peer, announcement: BlockAnnounce):
         print('Got Block Ann')
-        if not chain.has_block(announcement.block.hash):
-            print ('Adding block')
-            chain.add_blocks([announcement.block])
-            p2p.broadcast(BLOCK_ANNOUNCE, announcement)
-
-            if not chain.has_block(announcement.block.links[0]):
-                return ChainInfoRequest()
+        # the block is decoded (and its signature checked) in the pipeline, only its links are read here
+        try:
+            encoded = BinaryPayload.decode(announcement.payload)
+            links = SimpleBlock.links_from_bytes(encoded)
+        except Exception as e:
+            print('Bad block announcement:', e)
+            return
+
+        def relay(block_hashes):
+            # block_hashes is empty if the block failed verification
+            for h in block_hashes:
+                if h not in relayed and chain.has_block(h):
+                    relayed.put(h, True)
+                    p2p.broadcast(BLOCK_ANNOUNCE, announcement)
+
+        ingestor.put_encoded([encoded], relay, peer)
+
+        if len(links) > 0 and not chain.has_block(links[0]):  # a root block has no parent to ask about
+            return ChainInfoRequest()
 
     @p2p.method(BlockRequest, BLOCK_REQUEST, BLOCK_PROVIDE)
     def block_request(peer, request):
         print("Block Request")
         hashes = request.hashes[:500]  # return at most 500 blocks
-        return BlockProvide(blocks=[chain.get_block(h) for h in hashes if chain.has_block(h)])
+        blocks = [chain.get_block(h) for h in hashes if chain.contains_block(h)]
+        return BlockProvide.from_blocks(blocks)
 
-    @p2p.method(BlockProvide, BLOCK_PROVIDE)
+    @p2p.method(BlockProvide, BLOCK_PROVIDE, BLOCK_REQUEST)
     def block_provide(peer, provided):
         print("Block Provide")
-        print(provided.blocks)
-        chain.add_blocks(provided.blocks)
+        # signatures, PoW and check() are verified in a process pool, only verified blocks reach the chain
+        try:
+            encoded_blocks = split_blocks_bytes(BinaryPayload.decode(provided.payload))
+        except ValueError as e:
+            print('Bad block batch:', e)
+            encoded_blocks = []
+        requested = chain.seeker.provided(peer, len(encoded_blocks))
+        taken = ingestor.put_encoded(encoded_blocks, lambda hashes: chain.seeker.landed(requested, hashes), peer)
+        if taken < len(encoded_blocks):
+            print('%d blocks already queued or shed (pipeline full)' % (len(encoded_blocks) - taken))
+        # keep this peer's download stream going
+        return chain.seeker.request_for(peer)
 
     @p2p.method(InvRequest, INV_REQUEST, INV_PROVIDE)
     def inv_request(peer, request):
         print("Inv Request")
-        # todo : this needs to be O(1), bloom filters?
-        return InvProvide(inv_list=[b.hash for b in chain.all_node_hashes])
+        return InvProvide(inv_list=chain.inventory_missing_from(request.range_digests, request.start))
 
     @p2p.method(InvProvide, INV_PROVIDE, BLOCK_REQUEST)
     def inv_provide(peer, provided):
         print("Inv Provide")
-        to_request = []
-        for h in provided.inv_list:
-            if not chain.has_block(h):
-                to_request.append(h)
-        if len(to_request) > 0:
-            return BlockRequest(hashes=to_request)
+        # only the ranges our digests disagreed on are sent, so this is usually a handful of lookups
+        to_request = [h for h in provided.inv_list if not chain.has_block(h)]
+        # through the Seeker, so they're windowed and timed out like any other download; we're on the loop, so the
+        # seeker is given them directly rather than through chain.seek_blocks, and this peer can be asked at once
+        chain.seeker.put(*to_request)
+        return chain.seeker.request_for(peer)
 
     @p2p.method(ChainInfoRequest, CHAIN_INFO, CHAIN_INFO_PROVIDE)
     def chain_info(peer, request):
         print("Chain Info")
         return ChainInfoProvide(top_block=chain.head.hash, total_work=chain.head.total_work)
 
-    @p2p.method(ChainInfoProvide, CHAIN_INFO_PROVIDE, CHAIN_PRIMARY)
+    @p2p.method(ChainInfoProvide, CHAIN_INFO_PROVIDE, HEADERS_REQUEST if headers_first else CHAIN_PRIMARY)
     def chain_info_provide(peer, provided):
         print("Chain Info Provide")
-        if provided.top_block not in chain.current_node_hashes:
+        if headers_first:
+            # sync headers from whichever peer claims the most work, only while it's more than we know of
+            if snapshots is not None and snapshots.info_due():
+                p2p.broadcast(SNAPSHOT_INFO, SnapshotInfoRequest())
+            if snapshots is None or not snapshots.active:  # bodies under a snapshot are never released
+                skeleton.drop_stalled()
+            if provided.top_block not in skeleton and skeleton.wants_headers_from(provided.total_work) \
+                    and not is_penalised(peer):
+                return HeadersRequest(block_locator=skeleton.locator(), max_headers=MAX_HEADERS)
+        elif provided.top_block not in chain.current_node_hashes:
             size = 1000
             n = 0
             print("Chain Info Provide returning")
-            print(chain.primary_chain)
             return ChainPrimaryRequest(block_locator=chain.make_block_locator(), chunk_size=size, chunk_n=n)
         print("Chain Info Provide did nothing")
 
+    @p2p.method(HeadersRequest, HEADERS_REQUEST, HEADERS_PROVIDE)
+    def headers_request(peer, request):
+        print("Headers Request")
+        start = chain.first_in_primary_chain(request.block_locator)
+        if start is None:
+            start = chain.root.hash
+        first_height = chain.height_of_block(start) + 1
+        hashes = [h for h, w in chain.primary_chain_range(first_height, first_height + min(request.max_headers,
+                                                                                             MAX_HEADERS))]
+        blocks = []
+        for block in map(chain.get_block, hashes):
+            if block is None:
+                break  # before a state snapshot we started from
+            blocks.append(block)
+        return HeadersProvide.from_blocks(blocks)
+
+    @p2p.method(HeadersProvide, HEADERS_PROVIDE, HEADERS_REQUEST)
+    def headers_provide(peer, provided):
+        print("Headers Provide")
+        if is_penalised(peer):
+            return
+        try:
+            encoded_blocks = provided.encoded_blocks
+        except Exception as e:
+            penalise(peer, e)
+            return
+        # decoding checks signatures, which is too slow for the loop with MAX_HEADERS of them
+        asyncio.async(add_headers(peer, encoded_blocks))
+
+    @asyncio.coroutine
+    def add_headers(peer, encoded_blocks):
+        try:
+            blocks = yield from ingestor.verify_all(encoded_blocks)
+        except Exception as e:
+            penalise(peer, e)
+            return
+        try:
+            new = skeleton.add(blocks)
+        except ValueError as e:
+            print('Rejecting headers:', e)
+            return
+        if snapshots is not None:
+            new = [h for h in new if not snapshots.covers(h)]
+            snapshots.headers_added()
+        # the blocks came with their headers, so they only need fetching if the pipeline turns some away
+        new_hashes = {h.hash for h in new}
+        bodies = [e for e, b in zip(encoded_blocks, blocks) if b.hash in new_hashes]
+        if ingestor.put_encoded(bodies, peer=peer) < len(bodies):
+            chain.seek_blocks_with_total_work([(h.total_work, h.hash) for h in new])
+        if len(blocks) >= MAX_HEADERS:
+            asyncio.async(p2p.farm_message(HEADERS_REQUEST,
+                                           HeadersRequest(block_locator=skeleton.locator(), max_headers=MAX_HEADERS)))
+
+    @p2p.method(SnapshotInfoRequest, SNAPSHOT_INFO, SNAPSHOT_INFO_PROVIDE)
+    def snapshot_info(peer, request):
+        print("Snapshot Info")
+        latest = chain.latest_snapshot()
+        if latest is None:
+            return SnapshotInfoProvide(height=0, n_chunks=0)
+        return SnapshotInfoProvide.from_snapshot(*latest)
+
+    @p2p.method(SnapshotInfoProvide, SNAPSHOT_INFO_PROVIDE, SNAPSHOT_CHUNK)
+    def snapshot_info_provide(peer, provided):
+        print("Snapshot Info Provide")
+        if snapshots is None:
+            return
+        try:
+            block = provided.block
+        except Exception as e:
+            print('Bad snapshot block:', e)
+            return
+        if snapshots.consider(provided.height, block, provided.n_chunks):
+            return next_chunk_request(peer)
+
+    @p2p.method(SnapshotChunkRequest, SNAPSHOT_CHUNK, SNAPSHOT_CHUNK_PROVIDE)
+    def snapshot_chunk(peer, request):
+        print("Snapshot Chunk")
+        chunk = chain.snapshot_chunk(request.block_hash, request.index)
+        return SnapshotChunkProvide.from_chunk(request.block_hash, request.index, b'' if chunk is None else chunk)
+
+    @p2p.method(SnapshotChunkProvide, SNAPSHOT_CHUNK_PROVIDE, SNAPSHOT_CHUNK)
+    def snapshot_chunk_provide(peer, provided):
+        print("Snapshot Chunk Provide")
+        if snapshots is None:
+            return
+        snapshots.add_chunk(peer, provided.block_hash, provided.index, provided.accounts)
+        # keep this peer's stream of chunks going
+        return next_chunk_request(peer)
+
     @p2p.method(ChainPrimaryRequest, CHAIN_PRIMARY, CHAIN_PRIMARY_PROVIDE)
     def chain_primary(peer, request):
         print("Primary Chain")
         start = request.chunk_size * request.chunk_n
 
-        primary_chain_set = {i for i in chain.primary_chain}
-        lca = chain.root.hash
-        for block_hash in request.block_locator:
-            if block_hash in primary_chain_set:
-                lca = block_hash
-            else:
-                break
+        lca = chain.last_of_prefix_in_primary_chain(request.block_locator)
+        if lca is None:
+            lca = chain.root.hash
 
         print("Found LCA", lca)
 
-        print(chain.get_block(lca).to_json(), chain.get_block(lca).hash)
-        print(chain.head.to_json(), chain.head.hash)
-        print(request.block_locator)
-
-        x = [(b.total_work, b.hash) for b in chain.order_from(chain.get_block(lca), chain.head)[start:start + request.chunk_size]]
-        total_works = [i[0] for i in x]
-        hashes = [i[1] for i in x]
+        first_height = chain.height_of_block(lca) + 1 + start
+        x = chain.primary_chain_range(first_height, first_height + request.chunk_size)
+        hashes = [i[0] for i in x]
+        total_works = [i[1] for i in x]
 
         print("Sending")
 
@@ -1,4 +1,5 @@
 import threading, time, random, asyncio
+import multiprocessing
 
 from WSSTT import Network
 
@@ -6,10 +7,13 @@ from blockchain import Chain
 from structs import SimpleBlock
 from helpers import fire, global_hash
 from message_handlers import *
+from mining_kernel import MiningKernel, NONCE_BATCH, mine_nonce_range, benchmark_hashrate
+
 
 class Miner:
 
-    def __init__(self, chain: Chain=None, p2p: Network=None, coinbase=PUB_KEY_X_FOR_KNOWN_SE, run_forever=True):
+    def __init__(self, chain: Chain=None, p2p: Network=None, coinbase=PUB_KEY_X_FOR_KNOWN_SE, run_forever=True,
+                 workers=1):
         self._chain = chain
         self._special_nonce = 1234567890
         self._run_forever = run_forever
@@ -19,14 +23,51 @@ class Miner:
         self._stop = False
         self._coinbase = coinbase
         self._mine_fast = False
+        self._workers = workers
+        self._hash_counts = [0] * workers  # hashes tried per worker on the current candidate
+        self._mining_started = None
+
+        # work is abandoned as soon as the chain's head moves away from the candidate's parent
+        self._candidate_parent = None
+        self._abandon = False
+        self._head_changed = threading.Event()
+        self._found = None  # cancels worker processes
+        self.stale_hashes = 0  # hashes spent on candidates that were abandoned
+        if chain is not None:
+            chain.subscribe_head_change(self._on_new_head)
 
     def mine_fast(self):
         self._mine_fast = True
 
+    @property
+    def hashrate(self):
+        """ :return: (aggregate hashes/s, [hashes/s per worker]) for the current (or last) candidate """
+        if self._mining_started is None:
+            return 0, [0] * self._workers
+        elapsed = max(time.time() - self._mining_started, 1e-6)
+        per_worker = [c / elapsed for c in self._hash_counts]
+        return sum(per_worker), per_worker
+
     def stop(self):
         self._stop = True
+        if self._found is not None: self._found.set()
         if self._mining_thread: self._mining_thread.join()
 
+    def _on_new_head(self, head):
+        self._head_changed.set()
+        if self._candidate_parent is not None and self._candidate_parent != head.hash:
+            print('Abandoning stale candidate')
+            self._abandon = True
+            if self._found is not None: self._found.set()
+
+    def _should_stop(self):
+        return self._stop or self._abandon or self._p2p.is_shutdown
+
+    def _wait_for_new_head(self, seconds):
+        for i in range(int(seconds * 10)):
+            if self._head_changed.wait(0.1) or self._stop or self._p2p.is_shutdown:
+                break
+
     def restart(self):
         self.stop()
         self.start()
@@ -35,63 +76,114 @@ class Miner:
         nice_sleep(self._p2p, 3)  # warm up
         while not self._stop and not self._p2p.is_shutdown:
             self.start()
+            if self._abandon:
+                continue  # build a fresh candidate on the new head straight away
             if self._mine_fast:
-                nice_sleep(self._p2p, 0.5)
+                self._wait_for_new_head(0.5)
             else:
-                nice_sleep(self._p2p, random.randint(60, 120))
+                self._wait_for_new_head(random.randint(60, 120))
 
-    def start(self, work_target=10**5+1):
-        chain_head = self._chain.head
+    def make_candidate(self, work_target=10**5+1, chain_head=None):
+        """ A block on chain_head (default: the chain's head) with the special nonce and its state_hash set. """
+        chain_head = self._chain.head if chain_head is None else chain_head
         candidate = SimpleBlock(links=[chain_head.hash], timestamp=int(time.time()), nonce=self._special_nonce,
                                 work_target=work_target, total_work=chain_head.total_work + work_target,
                                 coinbase=self._coinbase)
 
+        # todo: edge case where str(nonce) gains characters, altering the storage fee, causing the state_hash to change...
+
+        while candidate.state_hash != self._chain.get_next_state_hash(candidate):
+            candidate.state_hash = self._chain.get_next_state_hash(candidate)
+        return candidate
+
+    @property
+    def special_nonce(self):
+        return self._special_nonce
+
+    def start(self, work_target=10**5+1):
+        self._head_changed.clear()
+        self._abandon = False
+        chain_head = self._chain.head
+        self._candidate_parent = chain_head.hash
+        candidate = self.make_candidate(work_target, chain_head)
+
         self._stop = False
         self._mining_thread = fire(target=self._start_mining, args=[candidate])
         self._mining_thread.join()
 
     def _start_mining(self, candidate):
-
-        # todo: edge case where str(nonce) gains characters, altering the storage fee, causing the state_hash to change...
-
-        while candidate.state_hash != self._chain.get_next_state_hash(candidate):
-            candidate.state_hash = self._chain.get_next_state_hash(candidate)
         candidate = self.mine_this_block(candidate)
 
         if candidate is not None:
             # try not adding it directly and just broadcasting
             if self._p2p:
                 print('Announcing Block')
-                self._p2p.broadcast(BLOCK_ANNOUNCE, BlockAnnounce(block=candidate))
+                self._p2p.broadcast(BLOCK_ANNOUNCE, BlockAnnounce.from_block(candidate))
         self._running = False
+        self._candidate_parent = None
 
-    def mine_this_block(self, candidate: SimpleBlock):
-
+    def split_candidate(self, candidate: SimpleBlock):
         # hack to replace a known special nonce, increase hash rate by modifying serialized blocks.
-        m1, m2 = map(lambda x : x.encode(), candidate.to_json().split(str(self._special_nonce)))
-        def serialized_block_from_nonce(n):
-            return m1 + str(n).encode() + m2
-
-        nonce = self._special_nonce  # set large to avoid edge case presented
-        work_target = candidate.work_target
-        hash_target = work_target_to_hash_target(work_target)
-        self._running = True
-        while not self._stop and not self._p2p.is_shutdown:
-            h = global_hash(serialized_block_from_nonce(nonce))
-            if h < hash_target:
-                candidate.nonce = nonce
-                assert candidate.acceptable_work
-                break
-            nonce += 1
-            # if nonce % 100000 == 0: print(nonce)
-
-        if self._stop or self._p2p.is_shutdown:
-            return
-        return candidate
+        return tuple(map(lambda x : x.encode(), candidate.to_json().split(str(self._special_nonce))))
 
+    def benchmark(self, candidate: SimpleBlock, seconds=4):
+        return benchmark_hashrate(*self.split_candidate(candidate), seconds=seconds)
 
+    def mine_this_block(self, candidate: SimpleBlock):
 
+        m1, m2 = self.split_candidate(candidate)
+        hash_target = work_target_to_hash_target(candidate.work_target)
+        self._running = True
+        self._mining_started = time.time()
 
+        if self._workers > 1:
+            nonce = self._mine_in_processes(m1, m2, hash_target)
+        else:
+            nonce = self._mine_in_thread(m1, m2, hash_target)
 
+        aggregate, per_worker = self.hashrate
+        print('Hashrate: %.0f H/s (%s)' % (aggregate, ', '.join('%.0f' % r for r in per_worker)))
 
+        if self._abandon:
+            self.stale_hashes += sum(self._hash_counts)
+            print('Stale hashes so far:', self.stale_hashes)
+        if nonce is None or self._should_stop():
+            return
+        candidate.nonce = nonce
+        assert candidate.acceptable_work
+        return candidate
 
+    def _mine_in_thread(self, m1, m2, hash_target):
+        kernel = MiningKernel(m1, m2, hash_target)
+        self._hash_counts = [0]
+        nonce = self._special_nonce  # set large to avoid edge case presented
+        while not self._should_stop():
+            winner = kernel.search(nonce, 1, NONCE_BATCH)
+            if winner is not None:
+                self._hash_counts[0] += winner - nonce + 1
+                return winner
+            nonce += NONCE_BATCH
+            self._hash_counts[0] += NONCE_BATCH
+
+    def _mine_in_processes(self, m1, m2, hash_target):
+        # worker i tries special_nonce + i, special_nonce + i + workers, ...; the first to find one cancels the rest
+        self._found = found = multiprocessing.Event()
+        if self._should_stop():
+            found.set()
+        result = multiprocessing.Value('q', -1)
+        hash_counts = multiprocessing.Array('Q', self._workers)
+        self._hash_counts = hash_counts
+        processes = [multiprocessing.Process(target=mine_nonce_range, daemon=True,
+                                             args=(i, m1, m2, hash_target, self._special_nonce + i, self._workers,
+                                                   found, result, hash_counts))
+                     for i in range(self._workers)]
+        for p in processes:
+            p.start()
+        while not found.wait(0.1):
+            if self._should_stop():
+                found.set()
+        for p in processes:
+            p.join()
+        self._found = None
+        self._hash_counts = list(hash_counts)
+        return result.value if result.value != -1 else None
@@ -0,0 +1,89 @@
+""" The mining kernel: hashing candidate blocks for many nonces.
+It only depends on the standard library so external workers (see getwork_worker.py) can use it without the node.
+"""
+import time
+from hashlib import sha256
+
+NONCE_BATCH = 1000  # nonces tried between checks for stop / found, and between hash count updates
+
+
+class MiningKernel:
+    """ Hashes a candidate's serialization (m1 + nonce + m2) for many nonces.
+    The sha256 state after the constant prefix m1 (the midstate) is computed once per candidate, so each attempt
+    only hashes the nonce's digits and m2, which are written into a preallocated buffer. Digests are compared to
+    the target as bytes, which is the same as comparing them as big endian ints.
+    """
+    def __init__(self, m1, m2, hash_target):
+        self._midstate = sha256(m1)
+        self._m2 = m2
+        self._target = hash_target.to_bytes(32, 'big')
+        self._width = None
+        self._buffer = None
+
+    def _buffer_for(self, width):
+        if width != self._width:
+            self._width = width
+            self._buffer = bytearray(width) + self._m2
+        return self._buffer
+
+    def search(self, first_nonce, stride, count):
+        """ Try count nonces from first_nonce in steps of stride.
+        :return: the first acceptable nonce, or None
+        """
+        copy_midstate = self._midstate.copy
+        target = self._target
+        width = self._width
+        buffer = self._buffer
+        for nonce in range(first_nonce, first_nonce + stride * count, stride):
+            digits = b'%d' % nonce
+            if len(digits) != width:
+                width = len(digits)
+                buffer = self._buffer_for(width)
+            buffer[:width] = digits
+            h = copy_midstate()
+            h.update(buffer)
+            if h.digest() < target:
+                return nonce
+        return None
+
+
+def mine_nonce_range(worker_n, m1, m2, hash_target, first_nonce, stride, found, result, hash_counts):
+    """ Runs in a worker process: try nonces first_nonce, first_nonce + stride, ... until any worker finds one. """
+    kernel = MiningKernel(m1, m2, hash_target)
+    nonce = first_nonce
+    while not found.is_set():
+        winner = kernel.search(nonce, stride, NONCE_BATCH)
+        if winner is not None:
+            hash_counts[worker_n] += (winner - nonce) // stride + 1
+            with result.get_lock():
+                if result.value == -1:
+                    result.value = winner
+            found.set()
+            break
+        nonce += stride * NONCE_BATCH
+        hash_counts[worker_n] += NONCE_BATCH
+
+
+def benchmark_hashrate(m1, m2, seconds=4):
+    """ Compare the naive loop (concatenate, hash from scratch, convert to int) with MiningKernel.
+    :return: dict of hashes/s for each, and the speedup
+    """
+    impossible = 0  # never met, so both loops do full work
+    def naive(nonce):
+        for n in range(nonce, nonce + NONCE_BATCH):
+            if int.from_bytes(sha256(m1 + str(n).encode() + m2).digest(), 'big') < impossible:
+                return n
+
+    def rate(search_batch):
+        hashes, nonce = 0, 1234567890
+        start = time.time()
+        while time.time() - start < seconds / 2:
+            search_batch(nonce)
+            nonce += NONCE_BATCH
+            hashes += NONCE_BATCH
+        return hashes / (time.time() - start)
+
+    kernel = MiningKernel(m1, m2, impossible)
+    naive_rate = rate(naive)
+    kernel_rate = rate(lambda n: kernel.search(n, 1, NONCE_BATCH))
+    return {'naive': naive_rate, 'kernel': kernel_rate, 'speedup': kernel_rate / naive_rate}
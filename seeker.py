@@ -1,75 +1,218 @@
-import asyncio, time
+import asyncio, time, heapq
+from collections import defaultdict
 
 from message_handlers import BLOCK_REQUEST, BlockRequest
 from helpers import MAX_32_BYTE_INT
 
-def current_time():
-    return int(time.time())
+REQUEST_TIMEOUT = 5  # seconds, on top of how long the request should take at the peer's observed rate
+INITIAL_WINDOW = 16  # hashes per request
+MIN_WINDOW = 1
+MAX_WINDOW = 500  # peers return at most 500 blocks
+WINDOW_INCREASE = 8
+MAX_REQUESTS = 8  # requests in flight at once, across all peers
+PEER_EXPIRY = 300  # seconds a peer without a request is remembered after we last heard from it
+
+
+class PeerDownload:
+    """ A peer's request in flight (at most one, see Seeker) and how fast it has answered before. """
+    def __init__(self):
+        self.window = INITIAL_WINDOW
+        self.request = None  # block hashes
+        self.sent = None
+        self.rate = None  # blocks/s, moving average
+        self.last_seen = time.time()
+
+    @property
+    def timeout(self):
+        expected = len(self.request) / self.rate if self.rate else 0
+        return REQUEST_TIMEOUT + 2 * expected
+
+    def answered(self, n_blocks):
+        elapsed = max(time.time() - self.sent, 0.001)
+        rate = n_blocks / elapsed
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        if n_blocks >= len(self.request):
+            self.window = min(MAX_WINDOW, self.window + WINDOW_INCREASE)
+        elif n_blocks < len(self.request) / 2:
+            self.window = max(MIN_WINDOW, self.window // 2)
+        self.request = self.sent = None
+
+    def stalled(self):
+        self.window = max(MIN_WINDOW, self.window // 2)
+        self.request = self.sent = None
+
 
 class Seeker:
-    """ The Seeker will actively request and track block hashes.
+    """ The Seeker downloads the blocks we know we're missing, spread over the peers we're connected to.
+
+    Each peer has at most one BlockRequest in flight, of up to its window of hashes (lowest total work first).
+    When it answers with BLOCK_PROVIDE the next request is the reply, so every responsive peer keeps a stream
+    going. A window grows while the peer answers in full and halves when it doesn't, or when it stalls
+    (answers slower than its observed rate allows). A hash is only in one request at once; when a peer stalls its
+    hashes are free for the others. Blocks orphan chains are waiting on go ahead of the rest (see put_orphan_roots).
+
+    WSSTT picks the peer for a message sent with farm_message, so that's how streams start. A reply from a peer
+    without a request of its own is matched to such a request by the hashes of the blocks it brought, once they've
+    been through the pipeline (see landed). Peers we haven't heard from in PEER_EXPIRY are forgotten.
     """
     def __init__(self, chain, p2p):
         self._chain = chain
         self._p2p = p2p
-        self._follow_up = asyncio.PriorityQueue()
-        self._time_to_wait_before_follow_up = 2
-        # todo: write an alg that changes this variable depending on how many good blocks we get back to find
-        # a practical maximum
-        self._follow_up_at_most_at_once = 500
+        self._wanted = []  # heap of (total_work, block_hash)
+        self._wanted_set = set()
+        self._work = {}  # block_hash -> the work it's wanted at, while it's wanted or in flight
+        self._in_flight = set()  # block hashes in some request
+        self._peers = defaultdict(PeerDownload)
+        self._farmed = []  # (time sent, block hashes) of farm_message'd requests no peer has answered yet
+        self._missed = defaultdict(set)  # block_hash -> peers that had nothing when asked for it
+        self._backpressure = lambda: False
+        self._held = lambda block_hash: False
+        self._time_between_follow_ups = 1
 
         asyncio.get_event_loop().call_soon(self.follow_up)
 
-    def any_to_follow_up(self):
-        if self._follow_up.empty():
-            return False
-        peek = self._follow_up.get_nowait()
-        self._follow_up.put_nowait(peek)
-        if current_time() - peek[1] > self._time_to_wait_before_follow_up:
-            return True
-        return False
+    def set_backpressure(self, predicate):
+        """ No new requests are made while predicate() is true (e.g. while the block pipeline is full). """
+        self._backpressure = predicate
 
-    def follow_up(self):
-        if not self.any_to_follow_up():
-            return
-        still_to_seek = []  # list of block hashes
-        done = set()  # block hashes
-        put_soon = []
-        while self.any_to_follow_up() and len(still_to_seek) < self._follow_up_at_most_at_once:
-            height, ts, h = self._follow_up.get_nowait()
-            if not self._chain.has_block(h):
-                still_to_seek.append(h)
-                put_soon.append((height, time.time(), h))  # need to use current time, not old time
+    def set_held(self, predicate):
+        """ predicate(block_hash) is true for blocks we have but that aren't in the chain yet (e.g. bodies waiting in
+        a HeaderSync skeleton); they aren't asked for again. """
+        self._held = predicate
+
+    @property
+    def stats(self):
+        return {'wanted': len(self._wanted_set), 'in_flight': len(self._in_flight),
+                'windows': [d.window for d in self._peers.values()]}
+
+    # Wanting blocks
+
+    def put(self, *block_hashes):
+        self.put_with_work(*[(MAX_32_BYTE_INT, h) for h in block_hashes])  # really big work, so last
+
+    def put_with_work(self, *pairs):
+        for work, block_hash in pairs:
+            if block_hash not in self._wanted_set and block_hash not in self._in_flight:
+                self._wanted_set.add(block_hash)
+                self._work[block_hash] = work
+                heapq.heappush(self._wanted, (work, block_hash))
+        self._farm()
+
+    def put_orphan_roots(self, *pairs):
+        """ pairs are (block_hash, total work of the orphan chain waiting on it). These go ahead of everything else,
+        heaviest chain first, since each connects a whole chain of blocks we already hold. """
+        for block_hash, tip_work in pairs:
+            if block_hash in self._in_flight:
+                continue
+            if block_hash in self._wanted_set and self._work[block_hash] <= -tip_work:
+                continue  # already wanted at least as urgently
+            # if it was wanted further back, _take skips the stale entry
+            self._wanted_set.add(block_hash)
+            self._work[block_hash] = -tip_work
+            heapq.heappush(self._wanted, (-tip_work, block_hash))
+        self._farm()
+
+    def _take(self, n, peer=None):
+        """ Up to n wanted hashes (lowest total work first) that peer hasn't already come up empty on. """
+        taken, skipped = [], []
+        while len(taken) < n and len(self._wanted) > 0:
+            work, block_hash = heapq.heappop(self._wanted)
+            if block_hash not in self._wanted_set or work != self._work[block_hash]:
+                continue  # taken already, or wanted more urgently since, through another entry
+            if self._chain.has_block(block_hash):
+                self._wanted_set.discard(block_hash)
+                self._work.pop(block_hash, None)
+                self._missed.pop(block_hash, None)
+            elif peer is not None and peer in self._missed.get(block_hash, ()):
+                skipped.append((work, block_hash))
             else:
-                done.add(h)
+                self._wanted_set.discard(block_hash)
+                taken.append(block_hash)
+        for item in skipped:
+            heapq.heappush(self._wanted, item)
+        self._in_flight.update(taken)
+        return taken
 
-        for t in put_soon:
-            self._put_nowait(*t)
+    def _release(self, block_hashes):
+        # back to wanted, at the work they were wanted at
+        self._in_flight.difference_update(block_hashes)
+        pairs = [(self._work.pop(h, 0), h) for h in block_hashes]
+        self.put_with_work(*[(work, h) for work, h in pairs if not self._chain.has_block(h) and not self._held(h)])
 
-        self._chain.currently_seeking = self._chain.currently_seeking.difference(done)
-        self.farm_seek(still_to_seek)
+    # Peers
 
-        asyncio.get_event_loop().call_later(self._time_to_wait_before_follow_up + 1, self.follow_up)
+    def request_for(self, peer):
+        """ :return: the next BlockRequest for peer, or None if there's nothing for it to do """
+        download = self._peers[peer]
+        download.last_seen = time.time()
+        if download.request is not None or self._backpressure():
+            return None
+        hashes = self._take(download.window, peer)
+        if len(hashes) == 0:
+            return None
+        download.request, download.sent = hashes, time.time()
+        return BlockRequest(hashes=hashes)
 
-    def put(self, *block_hashes):
-        s = [h for h in block_hashes if h not in self._chain.currently_seeking]
-        self.farm_seek(s)
+    def provided(self, peer, n_blocks):
+        """ peer answered a BlockRequest with n_blocks blocks.
+        :return: the hashes it was asked for, or None if it had no request of its own (it may be answering a farmed
+        one); pass this to landed() once the blocks have been processed
+        """
+        download = self._peers[peer]
+        download.last_seen = time.time()
+        if download.request is None:
+            return None
+        hashes = download.request
+        download.answered(n_blocks)
+        if n_blocks == 0:
+            for block_hash in hashes:
+                self._missed[block_hash].add(peer)
+        return hashes
 
-        for hash in s:
-            self._put_nowait(MAX_32_BYTE_INT, time.time(), hash)  # really big height as first in tuple
+    def landed(self, requested, block_hashes):
+        """ Blocks from a reply have been through the pipeline; anything we still don't have from the request is wanted
+        again.
+        :param requested: what provided() returned
+        :param block_hashes: the hashes of the blocks that made it through verification
+        """
+        if requested is None:
+            # a farmed request, if any of them asked for these blocks
+            arrived = set(block_hashes)
+            for i, (sent, hashes) in enumerate(self._farmed):
+                if not arrived.isdisjoint(hashes):
+                    requested = self._farmed.pop(i)[1]
+                    break
+            else:
+                return
+        self._release(requested)
 
-    def put_with_work(self, *pairs):
-        s = [h for w, h in pairs if h not in self._chain.currently_seeking]
-        self.farm_seek(s)
+    # Follow up
 
-        for work, hash in pairs:
-            self._put_nowait(work, time.time(), hash)
+    def follow_up(self):
+        now = time.time()
+        for peer, download in self._peers.items():
+            if download.request is not None and now - download.sent > download.timeout:
+                print('Peer stalled, reassigning %d blocks' % len(download.request))
+                hashes = download.request
+                download.stalled()
+                self._release(hashes)
+        while len(self._farmed) > 0 and now - self._farmed[0][0] > REQUEST_TIMEOUT * 2:
+            self._release(self._farmed.pop(0)[1])
+        for peer in [p for p, d in self._peers.items() if d.request is None and now - d.last_seen > PEER_EXPIRY]:
+            del self._peers[peer]  # most likely disconnected
+            for peers in self._missed.values():
+                peers.discard(peer)
+        self._farm()
 
-    def _put_nowait(self, total_work, timestamp, hash):
-        self._follow_up.put_nowait((total_work, timestamp, hash))
+        asyncio.get_event_loop().call_later(self._time_between_follow_ups, self.follow_up)
 
-    def farm_seek(self, block_hashes):
-        if len(block_hashes) > 0:
-            asyncio.async(self._p2p.farm_message(BLOCK_REQUEST, BlockRequest(hashes=block_hashes)))
-            for h in block_hashes:
-                self._chain.currently_seeking.add(h)
+    def _farm(self):
+        # start streams (with WSSTT's choice of peer) until there are enough requests in flight
+        in_flight = len(self._farmed) + sum(1 for d in self._peers.values() if d.request is not None)
+        while in_flight < MAX_REQUESTS and len(self._wanted) > 0 and not self._backpressure():
+            hashes = self._take(INITIAL_WINDOW)
+            if len(hashes) == 0:
+                break
+            self._farmed.append((time.time(), hashes))
+            asyncio.async(self._p2p.farm_message(BLOCK_REQUEST, BlockRequest(hashes=hashes)))
+            in_flight += 1
@@ -0,0 +1,197 @@
+import asyncio, time, traceback
+
+from structs import accounts_from_bytes
+from database import StateMerkleTree
+from header_sync import HeaderSync
+
+SNAPSHOT_MIN_HEIGHT = 2000  # below this, replaying from the root is cheap enough
+CHUNK_TIMEOUT = 10  # seconds
+INFO_INTERVAL = 30  # seconds between asking peers for their snapshots
+TARGET_WAIT = 60  # seconds to wait (once the skeleton stops growing) for a usable offer before replaying from the root
+MAX_ATTEMPTS = 3  # snapshots tried (failing to verify, or off the best chain) before replaying from the root
+SNAPSHOT_DEPTH = 100  # blocks a snapshot's block must be buried under, on the skeleton
+
+
+class SnapshotSync:
+    """ Fast sync for a fresh node: load a peer's state snapshot instead of replaying every block from the root.
+
+    A snapshot is offered with its block (SNAPSHOT_INFO). It's only taken up if the block is on the HeaderSync
+    skeleton, whose work has been checked block by block, at least SNAPSHOT_DEPTH blocks below its tip; the
+    skeleton only ever moves to heavier chains, so that's the heaviest chain we know of. It's then downloaded in
+    chunks, one chunk request per peer at a time, each answer followed by the next request (like the Seeker's
+    streams). Once every chunk is in, and the block is still buried on the skeleton, the snapshot is checked against
+    the block's state_hash with StateMerkleTree.root_of and loaded by Chain.load_snapshot, on the block ingestion
+    thread.
+
+    Meanwhile bodies are only fetched for skeleton headers above the snapshot: resume(height) is called to fetch those
+    above height, once a snapshot is picked, and with 0 if snapshot sync is given up on.
+    """
+    def __init__(self, chain, skeleton: HeaderSync, ingestor, resume):
+        self._chain = chain
+        self._skeleton = skeleton
+        self._ingestor = ingestor
+        self._resume = resume
+        self.active = chain.head.hash == chain.root.hash  # only a fresh chain can load a snapshot
+        self._loading = False
+        self._waiting_since = time.time()
+        self._asked = None
+        self._attempts = 0
+
+        self._target = None  # (height, block) of the snapshot being downloaded
+        self._n_chunks = 0
+        self._chunks = {}  # index -> [(pub_x, balance), ..]
+        self._in_flight = {}  # peer -> (chunk index, time sent)
+        self._lacking = set()  # peers that answered without the chunk
+
+        if self.active:
+            asyncio.get_event_loop().call_soon(self.follow_up)
+
+    @property
+    def target_hash(self):
+        return None if self._target is None else self._target[1].hash
+
+    @property
+    def complete(self):
+        return self._target is not None and len(self._chunks) == self._n_chunks
+
+    def info_due(self):
+        """ Should peers be asked for their snapshots? True at most once per INFO_INTERVAL, while we have no snapshot
+        or nobody is serving it. """
+        if not self.active or self._loading or (self._target is not None and len(self._in_flight) > 0):
+            return False
+        if self._asked is not None and time.time() - self._asked < INFO_INTERVAL:
+            return False
+        self._asked = time.time()
+        return True
+
+    def covers(self, header):
+        """ Is the body for header not needed, since the snapshot (or one yet to be picked) will stand in for it? """
+        return self.active and (self._target is None or header.height <= self._target[0])
+
+    def _buried(self, height, block):
+        """ Is block, at height, on the skeleton and at least SNAPSHOT_DEPTH below its tip? """
+        header = self._skeleton.header_of(block.hash)  # block.hash is computed from block
+        return header is not None and header.height == height and block.links == [header.parent] \
+            and self._skeleton.tip.height - height >= SNAPSHOT_DEPTH
+
+    def headers_added(self):
+        """ The skeleton has grown; an offer may be usable now, or the snapshot loadable. """
+        if self._target is None:
+            self._waiting_since, self._asked = time.time(), None
+        self.try_load()
+
+    def consider(self, height, block, n_chunks):
+        """ A peer offers a snapshot.
+        :return: whether it's the snapshot we're downloading (so the peer can be asked for chunks)
+        """
+        if not self.active or self._loading or block is None or n_chunks == 0:
+            return False
+        if self._target is None:
+            if height < SNAPSHOT_MIN_HEIGHT or not self._buried(height, block):
+                return False
+            print('Downloading the state snapshot at height %d, %d chunks' % (height, n_chunks))
+            self._target, self._n_chunks = (height, block), n_chunks
+            self._resume(height)
+            return True
+        return block.hash == self.target_hash and n_chunks == self._n_chunks
+
+    def request_for(self, peer):
+        """ :return: the index of the next chunk to ask peer for, or None """
+        if self._target is None or self._loading or peer in self._in_flight or peer in self._lacking:
+            return None
+        taken = {index for index, sent in self._in_flight.values()}
+        for index in range(self._n_chunks):
+            if index not in self._chunks and index not in taken:
+                self._in_flight[peer] = (index, time.time())
+                return index
+
+    def add_chunk(self, peer, block_hash, index, data):
+        self._in_flight.pop(peer, None)
+        if block_hash != self.target_hash or not 0 <= index < self._n_chunks or index in self._chunks:
+            return
+        if len(data) == 0:
+            self._lacking.add(peer)
+            return
+        try:
+            accounts = accounts_from_bytes(data)
+        except ValueError as e:
+            print('Bad snapshot chunk:', e)
+            return
+        if any(accounts[i][0] >= accounts[i + 1][0] for i in range(len(accounts) - 1)):
+            print('Bad snapshot chunk: accounts out of order')
+            return
+        self._chunks[index] = accounts
+        self.try_load()
+
+    def try_load(self):
+        """ Load the snapshot if it's complete and its block is buried on the skeleton. """
+        if self.active and self.complete and not self._loading and self._buried(*self._target):
+            self._loading = True
+            asyncio.async(self._load())
+
+    @asyncio.coroutine
+    def _load(self):
+        height, block = self._target
+        accounts = [pair for i in range(self._n_chunks) for pair in self._chunks[i]]
+        balances = dict(accounts)
+        root = None
+        if len(balances) == len(accounts):  # no account in two chunks
+            root = yield from asyncio.get_event_loop().run_in_executor(None, StateMerkleTree.root_of, balances)
+        if root != block.state_hash:
+            print('State snapshot does not match its state_hash')
+            self._loading = False
+            self._drop_target()
+            return
+
+        pending = self._skeleton.pending()
+        if len(pending) == 0 or pending[0].parent != self._chain.root.hash:
+            print('Blocks have been replayed already, not loading the state snapshot')
+            self._loading = False
+            self.abandon()
+            return
+        headers = self._skeleton.take_through(block.hash)
+        try:
+            yield from self._ingestor.run_in_worker(self._chain.load_snapshot, headers, block, balances)
+        except Exception:
+            traceback.print_exc()
+            self._loading = False
+            self.abandon()
+            return
+        self.active = self._loading = False
+        self._chunks = {}
+
+    def _drop_target(self):
+        self._attempts += 1
+        self._target, self._n_chunks, self._chunks = None, 0, {}
+        self._in_flight.clear()
+        self._lacking.clear()
+        self._waiting_since, self._asked = time.time(), None
+        if self._attempts >= MAX_ATTEMPTS:
+            self.abandon()
+
+    def abandon(self):
+        if self.active:
+            print('Giving up on snapshot sync, replaying blocks from the root')
+        self.active = False
+        self._chunks = {}
+        self._in_flight.clear()
+        self._resume(0)
+
+    def follow_up(self):
+        if not self.active:
+            return
+        now = time.time()
+        for peer, (index, sent) in list(self._in_flight.items()):
+            if now - sent > CHUNK_TIMEOUT:
+                del self._in_flight[peer]
+        tip = self._skeleton.tip
+        if self._target is None and now - self._waiting_since > TARGET_WAIT:
+            print('No state snapshot offered')
+            self.abandon()
+            return
+        if self._target is not None and not self._loading and self.target_hash not in self._skeleton \
+                and tip is not None and tip.height >= self._target[0]:
+            print('State snapshot is not on the chain we are syncing')
+            self._drop_target()
+
+        asyncio.get_event_loop().call_later(1, self.follow_up)
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import base64
 
 from encodium import *
 
@@ -71,6 +72,20 @@ class Signature(Encodium):
         x, y = ecdsa.public_pair_for_secret_exponent(ecdsa.generator_secp256k1, secret_exponent)
         return Signature(pub_x=x, pub_y=y, r=r, s=s, msg_hash=msg_hash)
 
+    # Binary layout: r, s, pub_x, pub_y, msg_hash as 32 byte ints
+
+    def to_bytes(self):
+        return b''.join(i.to_bytes(32, 'big') for i in (self.r, self.s, self.pub_x, self.pub_y, self.msg_hash))
+
+    @classmethod
+    def read_bytes(cls, data, offset=0):
+        values = []
+        for _ in range(5):
+            value, offset = read_int(data, offset, 32)
+            values.append(value)
+        r, s, pub_x, pub_y, msg_hash = values
+        return cls(r=r, s=s, pub_x=pub_x, pub_y=pub_y, msg_hash=msg_hash), offset
+
 
 class Transaction(Encodium):
     value = MoneyAmount.Definition()
@@ -81,6 +96,18 @@ class Transaction(Encodium):
     def total(self):
         return self.value
 
+    # Binary layout: value (8 bytes), recipient (32 bytes), signature
+
+    def to_bytes(self):
+        return self.value.to_bytes(8, 'big') + self.recipient.to_bytes(32, 'big') + self.signature.to_bytes()
+
+    @classmethod
+    def read_bytes(cls, data, offset=0):
+        value, offset = read_int(data, offset, 8)
+        recipient, offset = read_int(data, offset, 32)
+        signature, offset = Signature.read_bytes(data, offset)
+        return cls(value=value, recipient=recipient, signature=signature), offset
+
 
 # Block structure
 
@@ -148,4 +175,168 @@ class SimpleBlock(Encodium):
     def is_root(self):
         return len(self.links) == 0
 
+    # Binary encoding
+    # Layout (v1): format byte, varint link count, links (32 bytes each), tx flag byte, tx (if flag is 1),
+    # coinbase, work_target, total_work, state_hash (32 bytes each), timestamp, nonce (8 bytes each)
+
+    def to_bytes(self):
+        parts = [bytes([BINARY_FORMAT_V1]), encode_varint(len(self.links))]
+        parts.extend(l.to_bytes(32, 'big') for l in self.links)
+        if self.tx is None:
+            parts.append(b'\x00')
+        else:
+            parts.extend([b'\x01', self.tx.to_bytes()])
+        parts.extend(i.to_bytes(32, 'big') for i in (self.coinbase, self.work_target, self.total_work, self.state_hash))
+        parts.extend(i.to_bytes(8, 'big') for i in (self.timestamp, self.nonce))
+        return b''.join(parts)
+
+    @classmethod
+    def read_bytes(cls, data, offset=0):
+        links, offset = cls._read_links(data, offset)
+        kwargs = {}
+        has_tx, offset = read_int(data, offset, 1)
+        if has_tx not in (0, 1):
+            raise ValueError('Bad tx flag %d' % has_tx)
+        if has_tx:
+            kwargs['tx'], offset = Transaction.read_bytes(data, offset)
+        for name in ('coinbase', 'work_target', 'total_work', 'state_hash'):
+            kwargs[name], offset = read_int(data, offset, 32)
+        for name in ('timestamp', 'nonce'):
+            kwargs[name], offset = read_int(data, offset, 8)
+        return cls(links=links, **kwargs), offset
+
+    @staticmethod
+    def _read_links(data, offset):
+        if offset >= len(data):
+            raise ValueError('Unexpected end of data')
+        if data[offset] != BINARY_FORMAT_V1:
+            raise ValueError('Unknown block format %d' % data[offset])
+        n_links, offset = decode_varint(data, offset + 1)
+        links = []
+        for _ in range(n_links):
+            link, offset = read_int(data, offset, 32)
+            links.append(link)
+        return links, offset
+
+    @classmethod
+    def links_from_bytes(cls, data):
+        """ The links of an encoded block, read without decoding (or checking the signature in) the rest of it. """
+        return cls._read_links(data, 0)[0]
+
+    @classmethod
+    def from_bytes(cls, data):
+        block, offset = cls.read_bytes(data)
+        if offset != len(data):
+            raise ValueError('Trailing bytes after block')
+        return block
+
+    @classmethod
+    def from_serialized(cls, data: bytes):
+        """ Decode either the binary encoding or (legacy) JSON. """
+        if data[0] == BINARY_FORMAT_V1:
+            return cls.from_bytes(data)
+        return cls.from_json(data.decode())
+
+
+def blocks_to_bytes(blocks):
+    """ Layout: varint block count, then each block as a varint length and its binary encoding. """
+    parts = [encode_varint(len(blocks))]
+    for block in blocks:
+        encoded = block.to_bytes()
+        parts.extend([encode_varint(len(encoded)), encoded])
+    return b''.join(parts)
+
+class BlockHeader:
+    """ What traversal needs to know about a block, without its body. Not an Encodium; these are only ever built
+    from a block we've accepted or read back from the header index.
+    """
+    __slots__ = ('hash', 'parent', 'total_work', 'work_target', 'height')
+
+    # Layout: hash, parent (0 for a root), total_work, work_target (32 bytes each), height (8 bytes)
+    SIZE = 32 * 4 + 8
+
+    def __init__(self, hash, parent, total_work, work_target, height):
+        self.hash = hash
+        self.parent = parent
+        self.total_work = total_work
+        self.work_target = work_target
+        self.height = height
+
+    def __repr__(self):
+        return '<BlockHeader %064x height %d>' % (self.hash, self.height)
+
+    @classmethod
+    def from_block(cls, block: SimpleBlock, height):
+        return cls(block.hash, 0 if block.is_root else block.links[0], block.total_work, block.work_target, height)
+
+    @property
+    def is_root(self):
+        return self.height == 0
+
+    def to_bytes(self):
+        return b''.join(i.to_bytes(32, 'big') for i in (self.hash, self.parent, self.total_work, self.work_target)) \
+               + self.height.to_bytes(8, 'big')
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) != cls.SIZE:
+            raise ValueError('Header must be %d bytes' % cls.SIZE)
+        values = [int.from_bytes(data[i:i + 32], 'big') for i in range(0, 128, 32)]
+        return cls(*values, height=int.from_bytes(data[128:], 'big'))
+
+
+def headers_to_bytes(headers):
+    return b''.join(h.to_bytes() for h in headers)
+
+def headers_from_bytes(data):
+    if len(data) % BlockHeader.SIZE != 0:
+        raise ValueError('Headers must be %d bytes each' % BlockHeader.SIZE)
+    return [BlockHeader.from_bytes(data[i:i + BlockHeader.SIZE]) for i in range(0, len(data), BlockHeader.SIZE)]
+
+
+ACCOUNT_RECORD_SIZE = 40  # pub_x (32 bytes), balance (8 bytes), as StateMerkleTree hashes them
+
+def accounts_to_bytes(pairs):
+    """ :param pairs: (pub_x, balance) pairs, written in the order given """
+    return b''.join(pub_x.to_bytes(32, 'big') + balance.to_bytes(8, 'big') for pub_x, balance in pairs)
+
+def accounts_from_bytes(data):
+    if len(data) % ACCOUNT_RECORD_SIZE != 0:
+        raise ValueError('Accounts must be %d bytes each' % ACCOUNT_RECORD_SIZE)
+    return [(int.from_bytes(data[i:i + 32], 'big'), int.from_bytes(data[i + 32:i + ACCOUNT_RECORD_SIZE], 'big'))
+            for i in range(0, len(data), ACCOUNT_RECORD_SIZE)]
+
+
+def split_blocks_bytes(data):
+    """ :return: the binary encoding of each block in a blocks_to_bytes() batch, without decoding them """
+    n, offset = decode_varint(data)
+    encoded = []
+    for _ in range(n):
+        length, offset = decode_varint(data, offset)
+        if offset + length > len(data):
+            raise ValueError('Unexpected end of data')
+        encoded.append(data[offset:offset + length])
+        offset += length
+    return encoded
+
+def blocks_from_bytes(data):
+    return [SimpleBlock.from_bytes(encoded) for encoded in split_blocks_bytes(data)]
+
+
+# Wire types
+
+class BinaryPayload(Encodium):
+    """ Binary data carried as a base64 string. """
+    class Definition(Encodium.Definition):
+        _encodium_type = str
+
+    @staticmethod
+    def encode(data: bytes):
+        return base64.b64encode(data).decode()
+
+    @staticmethod
+    def decode(payload: str):
+        return base64.b64decode(payload.encode())
+
+
 
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from database import Database, AncestorIndex
+from helpers import assert_equal
+
+db = Database(db_num=15)
+db.redis.flushdb()
+
+
+class TestAncestorIndex(TestCase):
+    def setUp(self):
+        db.redis.flushdb()
+        self.a = AncestorIndex(db)
+
+        # main chain 0 <- 1 <- ... <- 100, side chain 1000 <- 1001 <- ... <- 1030 forking off 60
+        self.a.add(0)
+        for h in range(1, 101):
+            self.a.add(h, h - 1)
+        self.a.add(1000, 60)
+        for h in range(1001, 1031):
+            self.a.add(h, h - 1)
+
+    def test_height_of(self):
+        assert_equal(100, self.a.height_of(100))
+        assert_equal(61, self.a.height_of(1000))
+        assert_equal(True, self.a.contains(1030))
+        assert_equal(False, self.a.contains(2000))
+
+    def test_ancestor_at_height(self):
+        assert_equal(37, self.a.ancestor_at_height(100, 37))
+        assert_equal(0, self.a.ancestor_at_height(1030, 0))
+        assert_equal(1005, self.a.ancestor_at_height(1030, 66))
+        assert_equal(None, self.a.ancestor_at_height(5, 6))
+
+    def test_common_ancestor(self):
+        assert_equal(60, self.a.common_ancestor(100, 1030))
+        assert_equal(60, self.a.common_ancestor(1000, 61))
+        assert_equal(42, self.a.common_ancestor(42, 99))
+        assert_equal(7, self.a.common_ancestor(7, 7))
+
+    def test_path_between(self):
+        assert_equal(list(range(57, 61)) + list(range(1000, 1004)), self.a.path_between(56, 1003))
+        assert_equal([], self.a.path_between(9, 9))
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from blockchain import Chain
+from database import Database, State, StateOverlay
+from helpers import *
+
+db = Database(db_num=15)
+db.redis.flushdb()
+
+
+class Block:
+    tx = None
+    coins_generated = 10
+
+    def __init__(self, coinbase):
+        self.coinbase = coinbase
+        self.state_hash = None
+
+
+class TestApplyToState(TestCase):
+    def setUp(self):
+        db.redis.flushdb()
+        self.chain = Chain.__new__(Chain)  # only the state is needed
+        self.chain._state = State(db)
+        self.chain._state.reset()
+
+    def test_dirty_stays_bounded(self):
+        for i in range(200):
+            block = Block(global_hash(b'miner %d' % i))
+            overlay = StateOverlay(self.chain._state)
+            overlay.modify_balance(block.coinbase, block.coins_generated)
+            block.state_hash = overlay.hash
+            self.chain._apply_to_state(block)
+            assert_equal(0, db.redis.hlen('state.dirty'))
+        assert_equal(200 * 10, sum(self.chain._state.full_state().values()))
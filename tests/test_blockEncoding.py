@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+from structs import SimpleBlock, BlockHeader, Transaction, Signature, blocks_to_bytes, blocks_from_bytes, \
+    split_blocks_bytes
+from helpers import *
+
+
+def fields(block):
+    return (block.links, block.coinbase, block.work_target, block.total_work, block.state_hash, block.timestamp,
+            block.nonce)
+
+
+class TestBlockEncoding(TestCase):
+    def setUp(self):
+        self.root = SimpleBlock(links=[], work_target=10**6, total_work=10**6, timestamp=1412226468, nonce=529437,
+                                coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=2**255 + 1)
+        self.child = SimpleBlock(links=[2**255 + 3], work_target=10**6, total_work=2 * 10**6, timestamp=1412226500,
+                                 nonce=1234567890, coinbase=PUB_KEY_X_FOR_KNOWN_SE, state_hash=7)
+
+    def test_round_trip(self):
+        for block in (self.root, self.child):
+            decoded = SimpleBlock.from_bytes(block.to_bytes())
+            assert_equal(fields(block), fields(decoded))
+            assert_equal(None, decoded.tx)
+
+    def test_from_serialized(self):
+        assert_equal(fields(self.child), fields(SimpleBlock.from_serialized(self.child.to_bytes())))
+        assert_equal(fields(self.child), fields(SimpleBlock.from_serialized(self.child.to_json().encode())))
+
+    def test_many(self):
+        decoded = blocks_from_bytes(blocks_to_bytes([self.root, self.child]))
+        assert_equal([fields(self.root), fields(self.child)], list(map(fields, decoded)))
+
+    def test_split(self):
+        encoded = split_blocks_bytes(blocks_to_bytes([self.root, self.child]))
+        assert_equal([self.root.to_bytes(), self.child.to_bytes()], encoded)
+        with self.assertRaises(ValueError):
+            split_blocks_bytes(blocks_to_bytes([self.root])[:-1])
+
+    def test_header(self):
+        header = BlockHeader.from_block(self.child, 5)
+        encoded = header.to_bytes()
+        assert_equal(BlockHeader.SIZE, len(encoded))
+        decoded = BlockHeader.from_bytes(encoded)
+        assert_equal((self.child.hash, 2**255 + 3, 2 * 10**6, 10**6, 5),
+                     (decoded.hash, decoded.parent, decoded.total_work, decoded.work_target, decoded.height))
+        assert_equal((0, True), (BlockHeader.from_block(self.root, 0).parent, BlockHeader.from_block(self.root, 0).is_root))
+
+    def test_tx_round_trip(self):
+        signature = Signature.from_secret_exponent_and_msg(1, b'pay 1000 to 2')
+        tx = Transaction(value=1000, recipient=PUB_KEY_X_FOR_KNOWN_SE, signature=signature)
+        self.child.tx = tx
+        decoded = SimpleBlock.from_bytes(self.child.to_bytes())
+        assert_equal(fields(self.child), fields(decoded))
+        assert_equal(tx.to_bytes(), decoded.tx.to_bytes())
+        assert_equal((tx.value, tx.recipient), (decoded.tx.value, decoded.tx.recipient))
+        assert_equal((signature.r, signature.s, signature.pub_x, signature.pub_y, signature.msg_hash),
+                     (decoded.tx.signature.r, decoded.tx.signature.s, decoded.tx.signature.pub_x,
+                      decoded.tx.signature.pub_y, decoded.tx.signature.msg_hash))
+
+    def test_links(self):
+        assert_equal([], SimpleBlock.links_from_bytes(self.root.to_bytes()))
+        assert_equal([2**255 + 3], SimpleBlock.links_from_bytes(self.child.to_bytes()))
+        with self.assertRaises(ValueError):
+            SimpleBlock.links_from_bytes(self.child.to_bytes()[:10])
+
+    def test_truncated(self):
+        self.child.tx = Transaction(value=1, recipient=PUB_KEY_X_FOR_KNOWN_SE,
+                                    signature=Signature.from_secret_exponent_and_msg(1, b'x'))
+        encoded = self.child.to_bytes()
+        for length in (0, 1, 2, 40, 100, len(encoded) - 1):
+            with self.assertRaises(ValueError):
+                SimpleBlock.from_bytes(encoded[:length])
+
+    def test_varint(self):
+        for n in (0, 1, 127, 128, 300, 2**40):
+            assert_equal((n, len(encode_varint(n))), decode_varint(encode_varint(n)))
+        with self.assertRaises(ValueError):
+            decode_varint(encode_varint(300)[:1])
+        for non_minimal in (b'\x80\x00', b'\x81\x80\x00'):
+            with self.assertRaises(ValueError):
+                decode_varint(non_minimal)
+
+    def test_tx_flag(self):
+        encoded = self.child.to_bytes()
+        flag_at = 2 + 32  # format byte, varint link count, one link
+        assert_equal(0, encoded[flag_at])
+        for flag in (2, 255):
+            with self.assertRaises(ValueError):
+                SimpleBlock.from_bytes(encoded[:flag_at] + bytes([flag]) + encoded[flag_at + 1:])
@@ -0,0 +1,89 @@
+from unittest import TestCase
+
+from getwork import WorkServer, NONCE_RANGE
+from miner import Miner
+from helpers import *
+import getwork_worker
+
+
+class Head:
+    hash = 2**255 + 1
+    total_work = 10**6
+
+
+class Chain:
+    """ Just what WorkServer and Miner ask of a Chain """
+    def __init__(self):
+        self.head = Head()
+        self._listeners = []
+
+    def subscribe_head_change(self, callback):
+        self._listeners.append(callback)
+
+    def move_head(self):
+        for callback in self._listeners:
+            callback(self.head)
+
+    def get_next_state_hash(self, block):
+        return 7
+
+
+class P2P:
+    is_shutdown = False
+
+    def __init__(self):
+        self.broadcasts = []
+
+    def broadcast(self, name, message):
+        self.broadcasts.append((name, message))
+
+
+class LocalClient:
+    """ A getwork_worker client that calls the server directly instead of over a socket """
+    def __init__(self, server):
+        self.server = server
+        self.submitted = []
+
+    def call(self, method, **kwargs):
+        kwargs['method'] = method
+        response = self.server._dispatch(kwargs)
+        if method == 'submit':
+            self.submitted.append((kwargs, response))
+        return response
+
+
+class TestWorkServer(TestCase):
+    def setUp(self):
+        self.chain = Chain()
+        self.p2p = P2P()
+        self.miner = Miner(self.chain, self.p2p)
+        self.server = WorkServer(self.chain, self.p2p, self.miner)
+
+    def test_getwork_ranges(self):
+        first, second = self.server.getwork(), self.server.getwork()
+        assert_equal(first['template_id'], second['template_id'])
+        assert_equal(self.miner.special_nonce, first['nonce_start'])
+        assert_equal(first['nonce_start'] + NONCE_RANGE, second['nonce_start'])
+
+    def test_stale(self):
+        w = self.server.getwork()
+        self.chain.move_head()
+        assert_equal({'accepted': False, 'reason': 'stale'}, self.server.submit(w['template_id'], w['nonce_start']))
+        assert_equal(False, self.server.getwork()['template_id'] == w['template_id'])
+
+    def test_nonce_not_issued(self):
+        w = self.server.getwork()
+        for nonce in (w['nonce_start'] - 1, w['nonce_start'] + NONCE_RANGE):
+            assert_equal({'accepted': False, 'reason': 'nonce not issued'}, self.server.submit(w['template_id'], nonce))
+        assert_equal('stale', self.server.submit('0.99', w['nonce_start'])['reason'])
+
+    def test_worker_winner_and_duplicate(self):
+        client = LocalClient(self.server)
+        getwork_worker.work(client, max_templates=1)
+        (submitted, response), = client.submitted
+        assert_equal({'accepted': True, 'reason': ''}, response)
+        assert_equal(1, len(self.p2p.broadcasts))
+        # the template is retired once it has a winner
+        assert_equal({'accepted': False, 'reason': 'stale'},
+                     self.server.submit(submitted['template_id'], submitted['nonce']))
+        assert_equal(False, self.server.getwork()['template_id'] == submitted['template_id'])
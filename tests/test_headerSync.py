@@ -0,0 +1,110 @@
+from unittest import TestCase
+
+from structs import BlockHeader
+import header_sync
+from header_sync import HeaderSync
+from helpers import *
+
+
+class Chain:
+    def __init__(self, root):
+        self.root = root
+        self.head = root
+        self.blocks = {root.hash: root}
+
+    def get_header(self, block_hash):
+        return self.blocks.get(block_hash)
+
+    def contains_block(self, block_hash):
+        return block_hash in self.blocks
+
+    def make_block_locator(self):
+        return [self.head.hash]
+
+
+class Block:
+    """ Stands in for SimpleBlock; its hash is what SimpleBlock would compute. """
+    def __init__(self, header):
+        self.hash = header.hash
+        self.links = [header.parent]
+        self.total_work = header.total_work
+        self.work_target = header.work_target
+
+    @property
+    def acceptable_work(self):
+        return ONE_WORK_HASH // self.hash > self.work_target
+
+
+def extend(parent, n, first_hash):
+    headers = []
+    for i in range(n):
+        parent = BlockHeader(first_hash + i, parent.hash, parent.total_work + 10**6, 10**6, parent.height + 1)
+        headers.append(parent)
+    return headers
+
+
+def blocks(headers):
+    return [Block(h) for h in headers]
+
+
+def same(headers_a, headers_b):
+    return [h.to_bytes() for h in headers_a] == [h.to_bytes() for h in headers_b]
+
+
+class TestHeaderSync(TestCase):
+    def setUp(self):
+        self.root = BlockHeader(1, 0, 10**6, 10**6, 0)
+        self.chain = Chain(self.root)
+        self.sync = HeaderSync(self.chain)
+        self.headers = extend(self.root, 5, 100)
+        self.bodies = blocks(self.headers)
+
+    def test_add(self):
+        assert_equal(True, same(self.headers, self.sync.add(self.bodies)))
+        assert_equal(True, same(self.headers[-1:], [self.sync.tip]))
+        assert_equal(True, self.sync.wants_headers_from(10**7))
+        assert_equal(False, self.sync.wants_headers_from(6 * 10**6))
+
+    def test_invalid(self):
+        bad_work = blocks(extend(self.root, 2, 100))
+        bad_work[1].total_work += 1
+        unlinked = self.bodies[:2] + self.bodies[3:]
+        too_little_work = blocks(extend(self.root, 1, ONE_WORK_HASH // 10**5))
+        unconnected = blocks(extend(self.headers[0], 2, 200))
+        for bad in (bad_work, unlinked, too_little_work, unconnected):
+            with self.assertRaises(ValueError):
+                self.sync.add(bad)
+        assert_equal(None, self.sync.tip)
+
+    def test_heavier_branch_replaces(self):
+        self.sync.add(self.bodies)
+        assert_equal([], self.sync.add(blocks(extend(self.headers[1], 2, 200))))
+        heavier = extend(self.headers[1], 4, 300)
+        assert_equal(True, same(heavier, self.sync.add(blocks(heavier))))
+        assert_equal(6, len(self.sync))
+
+    def test_bodies_released_in_order(self):
+        self.sync.add(self.bodies)
+        bodies = self.bodies
+        assert_equal([], self.sync.take_ready([bodies[2], bodies[1]]))
+        assert_equal(True, self.sync.holds(bodies[2].hash))
+        assert_equal([bodies[0], bodies[1], bodies[2]], self.sync.take_ready([bodies[0]]))
+        outsider = Block(BlockHeader(999, 1, 2 * 10**6, 10**6, 1))
+        assert_equal([outsider, bodies[3], bodies[4]], self.sync.take_ready([bodies[4], outsider, bodies[3]]))
+        assert_equal(0, len(self.sync))
+
+    def test_take_through(self):
+        self.sync.add(self.bodies)
+        bodies = self.bodies
+        assert_equal([], self.sync.take_ready([bodies[1], bodies[3]]))
+        assert_equal(True, same(self.headers[:3], self.sync.take_through(self.headers[2].hash)))
+        assert_equal(True, same(self.headers[3:], self.sync.pending()))
+        assert_equal([bodies[3]], self.sync.take_ready([]))
+
+    def test_drop_stalled(self):
+        self.sync.add(self.bodies)
+        assert_equal(False, self.sync.drop_stalled())
+        self.sync._progress_at -= header_sync.SKELETON_TIMEOUT + 1
+        assert_equal(True, self.sync.drop_stalled())
+        assert_equal(0, len(self.sync))
+        assert_equal(True, self.sync.wants_headers_from(2 * 10**6))
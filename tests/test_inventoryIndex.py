@@ -0,0 +1,47 @@
+from unittest import TestCase
+import random
+
+from database import Database, InventoryIndex
+from helpers import *
+
+db = Database(db_num=15)
+db.redis.flushdb()
+
+
+class TestInventoryIndex(TestCase):
+
+    def setUp(self):
+        for key in db.redis.keys("test_inv.*"):
+            db.redis.delete(key)
+        self.ours = InventoryIndex(db, "test_inv.a")
+        self.theirs = InventoryIndex(db, "test_inv.b")
+        random.seed(1)
+        self.blocks = [(random.getrandbits(256), height) for height in range(3 * INV_RANGE)]
+        self.ours.add(*self.blocks)
+        self.theirs.add(*self.blocks)
+
+    def test_same_blocks_same_digests(self):
+        assert_equal(self.ours.digests(), self.theirs.digests())
+        assert_equal([], self.ours.missing_from(self.theirs.digests(), 0, 100))
+
+    def test_add_twice(self):
+        digests = self.ours.digests()
+        self.ours.add(*self.blocks[:10])
+        assert_equal(digests, self.ours.digests())
+
+    def test_missing_from(self):
+        side_branch = (random.getrandbits(256), INV_RANGE + 5)
+        tip = [(random.getrandbits(256), 3 * INV_RANGE + i) for i in range(3)]
+        self.ours.add(side_branch, *tip)
+        missing = self.ours.missing_from(self.theirs.digests(), 0, 1000)
+        # only the two ranges that differ are listed
+        assert_equal(INV_RANGE + 1 + 3, len(missing))
+        assert_equal(True, side_branch[0] in missing and all(h in missing for h, height in tip))
+
+    def test_start_and_limit(self):
+        self.ours.add((random.getrandbits(256), 5), (random.getrandbits(256), 2 * INV_RANGE))
+        their_digests = self.theirs.digests()
+        assert_equal(INV_RANGE + 1, len(self.ours.missing_from(their_digests, 1, 1000)))
+        assert_equal(10, len(self.ours.missing_from(their_digests, 0, 10)))
+        assert_equal(True, all(h in self.ours.missing_from(their_digests, 0, INV_RANGE + 1)
+                               for h, height in self.blocks[:INV_RANGE]))
@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from helpers import LRUCache, assert_equal
+
+
+class TestLRUCache(TestCase):
+    def setUp(self):
+        self.cache = LRUCache(10)
+
+        self.cache.put(1, 'a', 4)
+        self.cache.put(2, 'b', 4)
+
+    def test_get(self):
+        assert_equal('a', self.cache.get(1))
+        assert_equal(None, self.cache.get(3))
+        assert_equal(1, self.cache.hits)
+        assert_equal(1, self.cache.misses)
+
+    def test_eviction(self):
+        self.cache.get(1)  # 2 is now least recently used
+        self.cache.put(3, 'c', 4)
+        assert_equal(True, 1 in self.cache)
+        assert_equal(False, 2 in self.cache)
+        assert_equal(8, self.cache.size)
+
+    def test_too_large(self):
+        self.cache.put(3, 'c', 11)
+        assert_equal(False, 3 in self.cache)
+        assert_equal(2, len(self.cache))
+
+    def test_remove(self):
+        self.cache.remove(1)
+        assert_equal(None, self.cache.get(1))
+        assert_equal(4, self.cache.size)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from miner import Miner
+from helpers import *
+
+
+class Head:
+    hash = 2**255 + 1
+    total_work = 10**6
+
+
+class Chain:
+    """ Just what Miner.make_candidate asks of a Chain """
+    head = Head()
+
+    def subscribe_head_change(self, callback):
+        pass
+
+    def get_next_state_hash(self, block):
+        return 7
+
+
+class TestMiner(TestCase):
+    def setUp(self):
+        self.miner = Miner(Chain())
+
+    def test_make_candidate(self):
+        candidate = self.miner.make_candidate(work_target=10**6)
+        assert_equal([Head.hash], candidate.links)
+        assert_equal((10**6, Head.total_work + 10**6), (candidate.work_target, candidate.total_work))
+        assert_equal(self.miner.special_nonce, candidate.nonce)
+        assert_equal(7, candidate.state_hash)
+
+    def test_make_candidate_on(self):
+        other = Head()
+        other.hash, other.total_work = 3, 10
+        candidate = self.miner.make_candidate(chain_head=other)
+        assert_equal(([3], 10 + 10**5 + 1), (candidate.links, candidate.total_work))
+
+    def test_split_candidate(self):
+        candidate = self.miner.make_candidate()
+        prefix, suffix = self.miner.split_candidate(candidate)
+        assert_equal(candidate.to_json().encode(), prefix + str(self.miner.special_nonce).encode() + suffix)
@@ -0,0 +1,151 @@
+from unittest import TestCase
+import json, time
+
+from database import Database, Orphanage
+from helpers import *
+
+db = Database(db_num=15)
+db.redis.flushdb()
+
+
+class Block:
+    def __init__(self, block_hash, parent, total_work, size=10):
+        self.hash = block_hash
+        self.links = [parent]
+        self.total_work = total_work
+        self.padding = 'x' * size
+
+    def to_json(self):
+        return json.dumps({'hash': self.hash, 'padding': self.padding})
+
+
+class TestOrphanage(TestCase):
+    def setUp(self):
+        db.redis.flushdb()
+        self.o = Orphanage(db, 'test_orphanage', max_count=5, max_bytes=10000, peer_quota=3, max_age=60)
+
+    def test_add_remove(self):
+        b = Block(1, 100, 10)
+        self.o.add(b)
+        assert_equal(True, bool(self.o.contains_block_hash(1)))
+        assert_equal({1}, self.o.children_of(100))
+        assert_equal(1, len(self.o))
+        self.o.remove(b)
+        assert_equal(False, bool(self.o.contains_block_hash(1)))
+        assert_equal(set(), self.o.children_of(100))
+        assert_equal(0, len(self.o))
+        assert_equal(0, self.o.size_in_bytes)
+
+    def test_count_evicts_least_work(self):
+        for i in range(1, 8):
+            self.o.add(Block(i, 100, 10 * i))
+        assert_equal(5, len(self.o))
+        assert_equal({3, 4, 5, 6, 7}, self.o.children_of(100))
+
+    def test_least_work_evicted_even_if_newest(self):
+        for i in range(1, 6):
+            self.o.add(Block(i, 100, 100))
+        self.o.add(Block(6, 100, 1))
+        assert_equal({1, 2, 3, 4, 5}, self.o.children_of(100))
+
+    def test_tie_evicts_oldest(self):
+        for i in range(1, 7):
+            self.o.add(Block(i, 100, 100))
+        assert_equal({2, 3, 4, 5, 6}, self.o.children_of(100))
+
+    def test_bytes(self):
+        o = Orphanage(db, 'test_orphanage_bytes', max_bytes=1000)
+        for i in range(1, 6):
+            o.add(Block(i, 100, 10 * i, size=300))
+        assert_equal(True, o.size_in_bytes <= 1000)
+        assert_equal(3, len(o))
+        assert_equal({3, 4, 5}, o.children_of(100))
+
+    def test_peer_quota(self):
+        for i in range(1, 4):
+            assert_equal(True, self.o.add(Block(i, 100, 10), peer='a'))
+        assert_equal(False, self.o.add(Block(4, 100, 10), peer='a'))
+        assert_equal(True, self.o.add(Block(5, 100, 10), peer='b'))
+        self.o.remove(Block(1, 100, 10))
+        assert_equal(True, self.o.add(Block(6, 100, 10), peer='a'))
+
+    def test_sweep_expires(self):
+        self.o.add(Block(1, 100, 10))
+        self.o._max_age = -1
+        assert_equal((1, 0), self.o.sweep())
+        assert_equal(0, len(self.o))
+
+    def test_sweep_cleans_rev(self):
+        self.o.add(Block(1, 100, 10))
+        db.redis.srem('test_orphanage.s', 1)  # left behind, as by an older version
+        assert_equal((0, 1), self.o.sweep())
+        assert_equal(set(), self.o.children_of(100))
+        assert_equal(False, db.redis.exists('test_orphanage100.orph_rev'))
+
+    def test_subtree(self):
+        o = Orphanage(db, 'test_orphanage_subtree')
+        # 100 <- 1 <- 2 <- 4, 1 <- 3, and 200 <- 5 unrelated
+        for block_hash, parent in [(4, 2), (3, 1), (2, 1), (1, 100), (5, 200)]:
+            o.add(Block(block_hash, parent, 10))
+        subtree = [json.loads(b.decode())['hash'] for b in o._subtree(keys=[100])]
+        assert_equal({1, 2, 3, 4}, set(subtree))
+        assert_equal(4, len(subtree))
+        for child, parent in [(2, 1), (3, 1), (4, 2)]:
+            assert_equal(True, subtree.index(parent) < subtree.index(child))
+        assert_equal([], o._subtree(keys=[5]))
+
+    def test_needs_chain_any_order(self):
+        o = Orphanage(db, 'test_orphanage_needs')
+        # 100 <- 1 <- 2 <- 3 <- 4, arriving out of order; one component, missing 100
+        for block_hash in [3, 1, 4, 2]:
+            o.add(Block(block_hash, 100 if block_hash == 1 else block_hash - 1, 10 * block_hash))
+        assert_equal([(100, 40)], o.needs())
+
+    def test_needs_heaviest_first(self):
+        o = Orphanage(db, 'test_orphanage_needs')
+        o.add(Block(1, 100, 10))
+        o.add(Block(2, 1, 20))
+        o.add(Block(3, 200, 50))
+        assert_equal([(200, 50), (100, 20)], o.needs())
+        assert_equal([(200, 50)], o.needs(1))
+
+    def test_needs_connected(self):
+        o = Orphanage(db, 'test_orphanage_needs')
+        blocks = [Block(1, 100, 10), Block(2, 1, 20)]
+        for b in blocks:
+            o.add(b)
+        for b in blocks:  # as the chain connects them
+            o.remove(b)
+        assert_equal([], o.needs())
+
+    def test_needs_after_eviction(self):
+        o = Orphanage(db, 'test_orphanage_needs', max_count=3)
+        for block_hash in range(1, 4):
+            o.add(Block(block_hash, 100 if block_hash == 1 else block_hash - 1, 10 * block_hash))
+        o.add(Block(9, 200, 5))  # the least work, evicted straight away
+        o.add(Block(10, 300, 50))  # evicts 1, so 2 and 3 now wait on it
+        assert_equal([(300, 50), (1, 30)], o.needs())
+
+    def test_needs_rebuilt_by_sweep(self):
+        o = Orphanage(db, 'test_orphanage_needs')
+        o.add(Block(1, 100, 10))
+        o.add(Block(2, 1, 20))
+        db.redis.execute_command('ZADD', 'test_orphanage_needs.need', 99, 12345)
+        o.sweep()
+        assert_equal([(100, 20)], o.needs())
+
+    def test_claimed_work_capped(self):
+        for i in range(1, 6):
+            self.o.add(Block(i, 100, 100))
+        self.o.add(Block(6, 200, 10 ** 30), max_work=50)  # claims a lot, credited with 50, evicted
+        assert_equal({1, 2, 3, 4, 5}, self.o.children_of(100))
+        assert_equal([(100, 100)], self.o.needs())
+
+    def test_untracked_adopted_once(self):
+        self.o.add(Block(1, 100, 10))
+        db.redis.sadd('test_orphanage.s', 2)
+        db.redis.hset('test_orphanage.m', 2, Block(2, 100, 20).to_json())
+        o = Orphanage(db, 'test_orphanage', max_age=60)
+        assert_equal(db.redis.scard('test_orphanage.s'), db.redis.zcard('test_orphanage.t'))
+        assert_equal(0.0, db.redis.zscore('test_orphanage.w', 2))
+        assert_equal(0, o.sweep()[0])
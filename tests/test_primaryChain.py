@@ -38,4 +38,32 @@ class TestPrimaryChain(TestCase):
         assert_equal(True, self.p.contains(2))
         assert_equal(True, self.p.contains(3))
         assert_equal(True, self.p.contains(4))
-        assert_equal(False, self.p.contains(5))
\ No newline at end of file
+        assert_equal(False, self.p.contains(5))
+
+    def test_get_at(self):
+        assert_equal(1, self.p.get_at(0))
+        assert_equal(4, self.p.get_at(3))
+        assert_equal(None, self.p.get_at(4))
+
+    def test_get_many(self):
+        self.p.append_hashes([5, 6, 7])
+        self.p.remove_hashes([7])
+        assert_equal([6, 5, 3, None], self.p.get_many([5, 4, 2, 6]))
+        assert_equal(6, len(self.p))
+
+    def test_get_range(self):
+        self.p.append_hashes([5, 6], [50, 60])
+        assert_equal([(4, 0), (5, 50), (6, 60)], self.p.get_range(3, 10))
+        assert_equal([], self.p.get_range(7, 10))
+
+    def test_contains_many(self):
+        assert_equal([True, False, True], self.p.contains_many([4, 5, 1]))
+
+    def test_index_legacy_chain(self):
+        db.redis.delete('primary_chain.h', 'primary_chain.w')
+        assert_equal(False, self.p.indexed)
+        self.p.index(0, [10, 20])
+        self.p.index(2, [30, 40])
+        assert_equal(True, self.p.indexed)
+        assert_equal([3, 4], self.p.get_many([2, 3]))
+        assert_equal([(2, 20), (3, 30)], self.p.get_range(1, 3))
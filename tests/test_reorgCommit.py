@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+from database import Database, State, StateOverlay, PrimaryChain, ReorgCommit
+from helpers import *
+
+
+class Block:
+    def __init__(self, hash, total_work):
+        self.hash = hash
+        self.total_work = total_work
+
+
+class TestReorgCommit(TestCase):
+    def setUp(self):
+        self.db = Database(db_num=15)
+        self.db.redis.flushdb()
+        self.state = State(self.db)
+        self.chain = PrimaryChain(self.db)
+        self.commit = ReorgCommit(self.db, self.state, self.chain, 'test_top_block')
+
+        self.state.modify_many_balances([1, 2], [50, 50])
+        self.chain.append_hashes([10, 11, 12], [1, 2, 3])
+
+    def test_commit(self):
+        overlay = StateOverlay(self.state, cache_reads=True)
+        overlay.prefetch([1, 2, 3])
+        overlay.modify_many_balances([1, 2, 3], [-50, 10, 40])
+        expected_hash = overlay.hash
+        journal = self.state.begin_journal()
+
+        self.commit(overlay.deltas, [12, 11], [Block(21, 5), Block(22, 7)], 22)
+
+        assert_equal({2: 60, 3: 40}, self.state.full_state())
+        assert_equal(expected_hash, self.state.hash)
+        assert_equal([(10, 1), (21, 5), (22, 7)], self.chain.get_range(0, 10))
+        assert_equal(b'22', self.db.redis.get('test_top_block'))
+
+        journal.rollback()
+        assert_equal({1: 50, 2: 50}, self.state.full_state())
+
+    def test_negative_balance_writes_nothing(self):
+        with self.assertRaises(Exception):
+            self.commit({2: 10, 1: -51}, [12], [], 11)
+        assert_equal({1: 50, 2: 50}, self.state.full_state())
+        assert_equal([10, 11, 12], self.chain.get_all())
+
+    def test_hash_commits_tree(self):
+        overlay = StateOverlay(self.state, cache_reads=True)
+        overlay.prefetch([1, 3])
+        overlay.modify_many_balances([1, 3], [-10, 10])
+        self.commit(overlay.deltas, [12], [Block(21, 5)], 21)
+        assert_equal(True, self.db.redis.hlen('state.dirty') > 0)
+        assert_equal(overlay.hash, self.state.hash)
+        assert_equal(0, self.db.redis.hlen('state.dirty'))
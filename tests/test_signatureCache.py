@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+import helpers
+from helpers import *
+
+
+class TestSignatureCache(TestCase):
+    def setUp(self):
+        helpers._verified_signatures.clear()
+        self.msg_hash = global_hash(b'hello')
+        r, s = ecdsa.sign(ecdsa.generator_secp256k1, 1, self.msg_hash)
+        self.signature = PUB_KEY_FOR_KNOWN_SE + (self.msg_hash, r, s)
+
+    def test_verified_once(self):
+        hits = signature_cache_stats()['hits']
+        assert_equal(True, valid_secp256k1_signature(*self.signature))
+        assert_equal(hits, signature_cache_stats()['hits'])
+        assert_equal(True, valid_secp256k1_signature(*self.signature))
+        assert_equal(hits + 1, signature_cache_stats()['hits'])
+        assert_equal(1, signature_cache_stats()['entries'])
+
+    def test_invalid_not_cached(self):
+        bad = self.signature[:4] + (self.signature[4] + 1,)
+        assert_equal(False, valid_secp256k1_signature(*bad))
+        assert_equal(False, valid_secp256k1_signature(*bad))
+        assert_equal(0, signature_cache_stats()['entries'])
+
+    def test_marked(self):
+        mark_signatures_verified([(1, 2, 3, 4, 5)])
+        assert_equal(True, valid_secp256k1_signature(1, 2, 3, 4, 5))
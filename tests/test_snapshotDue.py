@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from blockchain import snapshot_due, SNAPSHOT_INTERVAL
+from helpers import *
+
+
+class TestSnapshotDue(TestCase):
+    def test_one_block(self):
+        assert_equal(True, snapshot_due(SNAPSHOT_INTERVAL - 1, SNAPSHOT_INTERVAL))
+        assert_equal(False, snapshot_due(SNAPSHOT_INTERVAL, SNAPSHOT_INTERVAL + 1))
+        assert_equal(False, snapshot_due(0, 1))
+
+    def test_jump_past_multiple(self):
+        assert_equal(True, snapshot_due(SNAPSHOT_INTERVAL - 3, SNAPSHOT_INTERVAL + 5))
+        assert_equal(True, snapshot_due(SNAPSHOT_INTERVAL - 3, 3 * SNAPSHOT_INTERVAL + 5))
+        assert_equal(False, snapshot_due(SNAPSHOT_INTERVAL + 1, 2 * SNAPSHOT_INTERVAL - 1))
+
+    def test_reorg_past_multiple(self):
+        # the branch the old snapshot was taken on has been replaced
+        assert_equal(True, snapshot_due(SNAPSHOT_INTERVAL - 10, SNAPSHOT_INTERVAL + 2))
+        assert_equal(False, snapshot_due(SNAPSHOT_INTERVAL + 1, SNAPSHOT_INTERVAL + 2))
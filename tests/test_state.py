@@ -1,6 +1,7 @@
 from unittest import TestCase
+import threading
 
-from database import Database, State
+from database import Database, State, StateMerkleTree, StateOverlay
 from helpers import *
 
 
@@ -41,3 +42,69 @@ class TestState(TestCase):
         _hash = global_hash(PUB_KEY_X_FOR_KNOWN_SE.to_bytes(32, 'big') + (20).to_bytes(8, 'big'))
         assert_equal(_hash, self.state.hash)
 
+
+    def test_hash_is_incremental(self):
+        balances = {PUB_KEY_X_FOR_KNOWN_SE: 20}
+        for i in range(1, 50):
+            pub_x = global_hash(i.to_bytes(4, 'big'))
+            self.state.modify_balance(pub_x, i)
+            balances[pub_x] = i
+            assert_equal(StateMerkleTree.root_of(balances), self.state.hash)
+        self.state.modify_balance(pub_x, -49)
+        del balances[pub_x]
+        assert_equal(StateMerkleTree.root_of(balances), self.state.hash)
+
+    def test_hash_after_restore(self):
+        original_hash = self.state.hash
+        self.state.backup_to('test_backup')
+        self.state.modify_balance(PUB_KEY_X_FOR_KNOWN_SE, 99)
+        self.state.modify_balance(global_hash(b'someone'), 1)
+        assert original_hash != self.state.hash
+        self.state.restore_backup_from('test_backup')
+        assert_equal(original_hash, self.state.hash)
+
+    def test_journal_rollback(self):
+        original_hash = self.state.hash
+        someone = global_hash(b'someone')
+        journal = self.state.begin_journal()
+        self.state.modify_balance(PUB_KEY_X_FOR_KNOWN_SE, -20)
+        self.state.modify_balance(someone, 20)
+        inner = self.state.begin_journal()
+        self.state.modify_balance(someone, 5)
+        inner.rollback()
+        assert_equal(20, self.state.get(someone))
+        assert_equal(0, self.state.get(PUB_KEY_X_FOR_KNOWN_SE))
+        journal.rollback()
+        assert_equal({PUB_KEY_X_FOR_KNOWN_SE: 20}, self.state.full_state())
+        assert_equal(original_hash, self.state.hash)
+
+    def test_journal_commit(self):
+        journal = self.state.begin_journal()
+        self.state.modify_balance(PUB_KEY_X_FOR_KNOWN_SE, 5)
+        journal.commit()
+        assert_equal(25, self.state.get(PUB_KEY_X_FOR_KNOWN_SE))
+        assert_equal(False, self.r.exists(journal.path))
+
+    def test_journal_waits_for_lock(self):
+        opened = []
+        with self.state.lock:
+            journal = self.state.begin_journal()  # the holder can still open and close journals
+            journal.commit()
+            t = threading.Thread(target=lambda: opened.append(self.state.begin_journal()))
+            t.start()
+            t.join(0.2)
+            assert_equal([], opened)
+        t.join()
+        assert_equal(1, len(opened))
+        opened[0].commit()
+
+    def test_overlay(self):
+        someone = global_hash(b'someone')
+        overlay = StateOverlay(self.state)
+        overlay.modify_balance(PUB_KEY_X_FOR_KNOWN_SE, -20)
+        overlay.modify_balance(someone, 20)
+        assert_equal(20, overlay.get(someone))
+        assert_equal({PUB_KEY_X_FOR_KNOWN_SE: 20}, self.state.full_state())  # untouched
+        assert_equal(StateMerkleTree.root_of({someone: 20}), overlay.hash)
+        self.state.modify_many_balances([PUB_KEY_X_FOR_KNOWN_SE, someone], [-20, 20])
+        assert_equal(self.state.hash, overlay.hash)
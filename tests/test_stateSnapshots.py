@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+from database import Database, State, StateMerkleTree, StateSnapshots
+from structs import accounts_from_bytes, accounts_to_bytes
+from helpers import *
+
+
+class TestStateSnapshots(TestCase):
+    def setUp(self):
+        self.db = Database(db_num=15)
+        self.r = self.db.redis
+        self.r.flushall()
+        self.state = State(self.db)
+        self.state.reset()
+        self.state.modify_many_balances([PUB_KEY_X_FOR_KNOWN_SE, 5, 2**255 + 7, 2**200, 3], [20, 1, 2, 3, 4])
+        self.snapshots = StateSnapshots(self.db, keep=2, chunk_accounts=2)
+
+    def test_accounts_encoding(self):
+        pairs = [(1, 2), (2**256 - 1, 2**64 - 1)]
+        assert_equal(pairs, accounts_from_bytes(accounts_to_bytes(pairs)))
+        with self.assertRaises(ValueError):
+            accounts_from_bytes(b'\x00' * 41)
+
+    def test_chunks(self):
+        balances = self.state.full_state()
+        self.snapshots.take(1000, 123, balances)
+        assert_equal((1000, 123, 3), self.snapshots.latest())
+        accounts = [pair for i in range(3) for pair in accounts_from_bytes(self.snapshots.get_chunk(123, i))]
+        assert_equal(sorted(balances.items()), accounts)
+        assert_equal(self.state.hash, StateMerkleTree.root_of(dict(accounts)))
+        assert_equal(None, self.snapshots.get_chunk(123, 3))
+
+    def test_keep(self):
+        for height in (1000, 2000, 3000):
+            self.snapshots.take(height, height + 1, {1: 1})
+        assert_equal((3000, 3001, 1), self.snapshots.latest())
+        assert_equal(None, self.snapshots.get_chunk(1001, 0))
+        assert_equal(True, self.snapshots.get_chunk(2001, 0) is not None)
+
+    def test_load(self):
+        balances = self.state.full_state()
+        loaded = State(self.db, path='loaded_state')
+        loaded.modify_balance(99, 10)
+        loaded.load(balances)
+        assert_equal(balances, loaded.full_state())
+        assert_equal(self.state.hash, loaded.hash)
+
+    def test_load_without_placeholder(self):
+        balances = {PUB_KEY_X_FOR_KNOWN_SE: 20, 5: 1}
+        loaded = State(self.db, path='loaded_state')
+        loaded.load(balances)
+        assert_equal(balances, loaded.full_state())
+        assert_equal(StateMerkleTree.root_of(balances), loaded.hash)
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from structs import SimpleBlock
+from helpers import mark_signatures_verified
+
+
+def verify_encoded_block(encoded: bytes):
+    """ The stateless checks on one block, run in a worker process: decoding it checks the signature and check(),
+    then its proof of work is checked against its work_target.
+    :return: (ok, the signature tuple that was verified or None, reason if not ok)
+    """
+    try:
+        block = SimpleBlock.from_bytes(encoded)
+        if not block.acceptable_work:
+            return False, None, 'unacceptable work'
+    except Exception as e:
+        return False, None, repr(e)
+    signature = None
+    if block.tx is not None:
+        s = block.tx.signature
+        signature = (s.pub_x, s.pub_y, s.msg_hash, s.r, s.s)
+    return True, signature, ''
+
+
+class BlockVerifier:
+    """ Fans the stateless checks of incoming blocks out to a process pool so a batch is verified on every core,
+    off the event loop. Signatures verified by the pool aren't verified again when the blocks are decoded here.
+    """
+    def __init__(self, workers=None):
+        self._workers = workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(self._workers)
+
+    def verify(self, encoded_blocks):
+        """ Blocking.
+        :return: the blocks (decoded) that passed, in order; those that failed are dropped
+        """
+        chunk_size = max(1, len(encoded_blocks) // (self._workers * 4))
+        results = self._pool.map(verify_encoded_block, encoded_blocks, chunksize=chunk_size)
+        verified = []
+        for encoded, (ok, signature, reason) in zip(encoded_blocks, results):
+            if not ok:
+                print('Rejecting block in verification:', reason)
+                continue
+            if signature is not None:
+                mark_signatures_verified([signature])
+            verified.append(SimpleBlock.from_bytes(encoded))
+        return verified
+
+    def verify_all(self, encoded_blocks):
+        """ Blocking. For batches that only make sense whole, like headers.
+        :return: the blocks, decoded
+        :raises ValueError: if any block fails
+        """
+        chunk_size = max(1, len(encoded_blocks) // (self._workers * 4))
+        results = list(self._pool.map(verify_encoded_block, encoded_blocks, chunksize=chunk_size))
+        for ok, signature, reason in results:
+            if not ok:
+                raise ValueError('Block failed verification: %s' % reason)
+        mark_signatures_verified([signature for ok, signature, reason in results if signature is not None])
+        return [SimpleBlock.from_bytes(encoded) for encoded in encoded_blocks]
+
+    def shutdown(self):
+        self._pool.shutdown()